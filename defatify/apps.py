@@ -1,4 +1,5 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class DefatifyConfig(AppConfig):
@@ -7,3 +8,8 @@ class DefatifyConfig(AppConfig):
 
     def ready(self):
         import defatify.signals  # Import the signals
+        import defatify.checks  # Register the system checks
+        from defatify import metrics
+        metrics.install()
+        from defatify.search import restore_battle_fts_triggers
+        post_migrate.connect(restore_battle_fts_triggers, sender=self)
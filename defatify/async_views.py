@@ -0,0 +1,258 @@
+import asyncio
+from abc import ABC, abstractmethod
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.shortcuts import aget_object_or_404
+from django.views import View
+from rest_framework import status
+from rest_framework.exceptions import APIException, AuthenticationFailed, NotAuthenticated
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from .authentication import AsyncJWTAuthentication, aredeem_stream_ticket
+from .cache import AsyncBattleCacheMixin
+from .columnar import COLUMNAR_MAX_PAGE_SIZE, ColumnarJSONRenderer, columnar_requested, weight_columns
+from .live import (
+    hub, Subscriber, RESYNC, HEARTBEAT_SECONDS, LIVE_POLL_SECONDS, leaderboard_rows, aleaderboard_version, as_state,
+    format_event,
+)
+from .models import Profile, Battle, BattleStatistic, BattleInvitation
+from .pagination import LeaderboardPagination, KeysetPagination, WeightStatPagination
+from .serializers import sparse_fields, RowSerializer, ProfileSerializer, WeightStatSerializer, BattleSerializer, LeaderboardSerializer, BattleInvitationSerializer
+from .utils import UnitConverter
+from .views import weight_history
+
+# Async twins of the read-heavy GET endpoints, for deployments running the
+# ASGI app (defatify_project/asgi.py). They authenticate and query with the
+# async ORM, so a request waiting on the database holds no worker thread, and
+# answer with exactly the JSON of the DRF views they mirror.
+
+
+class AsyncAPIView(View, ABC):
+    """
+    Minimal DRF-like base for async GET views: JWT authentication, an
+    authenticated-only permission and JSON rendering. Handlers get a DRF
+    Request, so serializers, pagination and query_params work as usual.
+
+    Subclasses implement read() rather than get(): get() stays free for
+    mixins that wrap every GET, such as AsyncBattleCacheMixin, which a get()
+    defined on the view itself would bypass.
+    """
+    authenticator = AsyncJWTAuthentication()
+    renderer = JSONRenderer()
+
+    async def dispatch(self, request, *args, **kwargs):
+        self.request = request = Request(request, authenticators=())
+        try:
+            authenticated = await self.authenticate(request)
+            if authenticated is None:
+                raise NotAuthenticated()
+            request.user, request.auth = authenticated
+            return await super().dispatch(request, *args, **kwargs)
+        except APIException as exc:
+            headers = {}
+            if isinstance(exc, (AuthenticationFailed, NotAuthenticated)):
+                headers['WWW-Authenticate'] = self.authenticator.authenticate_header(request)
+            detail = exc.detail if isinstance(exc.detail, (list, dict)) else {'detail': exc.detail}
+            return self.render(detail, exc.status_code, headers)
+        except Http404 as exc:
+            return self.render({'detail': str(exc)}, status.HTTP_404_NOT_FOUND)
+
+    async def authenticate(self, request):
+        return await self.authenticator.aauthenticate(request)
+
+    async def get(self, request, *args, **kwargs):
+        return await self.read(request, *args, **kwargs)
+
+    @abstractmethod
+    async def read(self, request, *args, **kwargs):
+        """Answer the GET request: the view's handler, called once it is authenticated."""
+
+    def render(self, data, status_code=status.HTTP_200_OK, headers=None, renderer=None):
+        renderer = renderer or self.renderer
+        response = HttpResponse(renderer.render(data), status=status_code, headers=headers,
+                                content_type=renderer.media_type)
+        response.data = data
+        return response
+
+    def serialize(self, serializer_class, instance, many=False, fields=None):
+        # Only serializers with SparseFieldsMixin take `fields`
+        kwargs = {'fields': fields} if fields is not None else {}
+        return serializer_class(instance, many=many, context={'request': self.request}, **kwargs).data
+
+
+# PROFILE
+class AsyncProfileView(AsyncAPIView):
+    async def read(self, request):
+        profile = request.user.profile
+        if profile.pk is None:
+            # A stand-in holding the token's claims only (see authentication.py)
+            profile = await Profile.objects.aget(user_id=request.user.id)
+        return self.render(self.serialize(ProfileSerializer, profile))
+
+
+# WEIGHT HISTORY
+class AsyncWeightStatListView(AsyncAPIView):
+    columnar_renderer = ColumnarJSONRenderer()
+
+    async def read(self, request):
+        paginator = WeightStatPagination()
+        fields = sparse_fields(request, WeightStatSerializer)
+        readings = weight_history(request.user, request.query_params)
+        if columnar_requested(request):
+            paginator.max_page_size = COLUMNAR_MAX_PAGE_SIZE
+            rows = RowSerializer.for_class(WeightStatSerializer).rows(readings, fields, paginator.ordering_columns)
+            page = await paginator.apaginate_queryset(rows, request)
+            data = paginator.get_paginated_response(weight_columns(page, UnitConverter.for_request(request), fields)).data
+            return self.render(data, renderer=self.columnar_renderer)
+        if fields is not None:
+            readings = readings.only(*fields, *paginator.ordering_columns)
+        page = await paginator.apaginate_queryset(readings, request)
+        data = paginator.get_paginated_response(self.serialize(WeightStatSerializer, page, many=True, fields=fields)).data
+        return self.render(data)
+
+
+# BATTLES
+class AsyncBattleDetailView(AsyncBattleCacheMixin, AsyncAPIView):
+    cache_scope = 'detail'
+
+    async def read(self, request, pk):
+        fields = sparse_fields(request, BattleSerializer)
+        battle = await aget_object_or_404(Battle.objects.for_detail(fields), id=pk)
+        return self.render(self.serialize(BattleSerializer, battle, fields=fields))
+
+
+class AsyncBattleLeaderboardView(AsyncBattleCacheMixin, AsyncAPIView):
+    cache_scope = 'leaderboard'
+    max_neighbours = 50
+
+    def cache_per_user(self, request):
+        return bool(request.query_params.get('around_me'))
+
+    async def read(self, request, pk):
+        fields = sparse_fields(request, LeaderboardSerializer)
+        ranked = BattleStatistic.objects.filter(battle_id=pk).for_leaderboard(fields).ranked()
+        if request.query_params.get('around_me'):
+            return await self.around_me(request, pk, ranked, fields)
+
+        paginator = LeaderboardPagination()
+        page = await paginator.apaginate_queryset(ranked, request)
+        if not paginator.page.paginator.count:
+            await aget_object_or_404(Battle, id=pk)
+        return self.render(paginator.get_paginated_response(self.serialize(LeaderboardSerializer, page, many=True, fields=fields)).data)
+
+    async def around_me(self, request, pk, ranked, fields=None):
+        """The requesting user's row plus `neighbours` rows on either side of it."""
+        try:
+            neighbours = min(int(request.query_params.get('neighbours', 5)), self.max_neighbours)
+        except ValueError:
+            return self.render({"detail": "neighbours must be an integer."}, status.HTTP_400_BAD_REQUEST)
+        neighbours = max(neighbours, 0)
+
+        mine = await BattleStatistic.objects.filter(battle_id=pk).position_of(request.user.id).afirst()
+        if mine is None:
+            return self.render({"detail": "You are not on this leaderboard."}, status.HTTP_404_NOT_FOUND)
+
+        position = mine['position']
+        rows = [row async for row in ranked.around(position, neighbours)]
+        return self.render({
+            'count': rows[0].total_count if rows else 0,
+            'position': position,
+            'results': self.serialize(LeaderboardSerializer, rows, many=True, fields=fields),
+        })
+
+
+class AsyncLeaderboardStreamView(AsyncAPIView):
+    """
+    Server-Sent Events stream of a battle's leaderboard: a `snapshot` event
+    with the top rows, then `delta` events holding only the rows whose rank or
+    values changed (plus users who dropped out). Reconnecting clients send
+    Last-Event-ID and get the missed deltas replayed when still known.
+    Changes committed by other worker processes arrive within
+    LIVE_POLL_SECONDS (see live.py).
+
+    Browsers authenticate with `?ticket=` from LeaderboardStreamTicketView,
+    other clients with the usual Authorization header.
+    """
+    # Client reconnect delay, in milliseconds
+    retry = 3000
+
+    async def authenticate(self, request):
+        # Browsers' EventSource cannot set headers, so it brings a single-use ticket
+        ticket = request.query_params.get('ticket')
+        if ticket and self.authenticator.get_header(request) is None:
+            return await aredeem_stream_ticket(ticket, self.kwargs['pk']), None
+        return await super().authenticate(request)
+
+    async def read(self, request, pk):
+        await aget_object_or_404(Battle, id=pk)
+        unit_preference = request.user.profile.unit_preference
+
+        subscriber = Subscriber()
+        hub.subscribe(pk, subscriber)
+        try:
+            last_event_id = request.headers.get('Last-Event-ID') or request.query_params.get('last_event_id')
+            missed = hub.replay_since(pk, last_event_id) if last_event_id else None
+            if missed is None:
+                opening, last_seq = await self.snapshot(pk, unit_preference)
+            else:
+                opening = ''.join(self.delta(event, unit_preference) for event in missed)
+                last_seq = missed[-1].seq if missed else int(last_event_id.rsplit('-', 1)[1])
+        except BaseException:
+            hub.unsubscribe(pk, subscriber)
+            raise
+
+        response = StreamingHttpResponse(
+            self.stream(pk, subscriber, f'retry: {self.retry}\n\n' + opening, last_seq, unit_preference),
+            content_type='text/event-stream',
+        )
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'  # No proxy buffering of the stream
+        # response.close() runs when the server is done with the connection, even
+        # if the generator was never closed
+        response._resource_closers.append(lambda: hub.unsubscribe(pk, subscriber))
+        return response
+
+    async def snapshot(self, pk, unit_preference):
+        # Other viewers of the battle already keep its rows in the hub
+        state = version = None
+        if not hub.has_state(pk):
+            # Read the version first: a change racing the query is re-ranked on the next poll
+            version = await aleaderboard_version(pk)
+            state = as_state([row async for row in leaderboard_rows(pk)])
+        rows, seq = hub.snapshot(pk, state, version)
+        return format_event(hub.event_id(seq), 'snapshot', rows, unit_preference=unit_preference), seq
+
+    def delta(self, event, unit_preference):
+        return format_event(hub.event_id(event.seq), event.kind, event.rows, event.removed, unit_preference)
+
+    async def stream(self, pk, subscriber, opening, last_seq, unit_preference):
+        loop = asyncio.get_running_loop()
+        try:
+            yield opening
+            sent_at = loop.time()
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscriber.queue.get(), min(LIVE_POLL_SECONDS, HEARTBEAT_SECONDS))
+                except asyncio.TimeoutError:
+                    # Idle: pick up changes made in other processes, which queue their deltas
+                    await hub.afollow(pk)
+                    if loop.time() - sent_at >= HEARTBEAT_SECONDS:
+                        sent_at = loop.time()
+                        yield ': heartbeat\n\n'
+                    continue
+                sent_at = loop.time()
+                if event is RESYNC:
+                    chunk, last_seq = await self.snapshot(pk, unit_preference)
+                    yield chunk
+                elif event.seq > last_seq:
+                    last_seq = event.seq
+                    yield self.delta(event, unit_preference)
+        finally:
+            hub.unsubscribe(pk, subscriber)
+
+
+class AsyncPendingBattleInvitationsView(AsyncAPIView):
+    async def read(self, request):
+        invitations = BattleInvitation.objects.filter(invited_user=request.user, status='pending').select_related('inviting_user', 'battle')
+        paginator = KeysetPagination()
+        page = await paginator.apaginate_queryset(invitations, request)
+        return self.render(paginator.get_paginated_response(self.serialize(BattleInvitationSerializer, page, many=True)).data)
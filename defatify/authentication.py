@@ -0,0 +1,231 @@
+import secrets
+import time
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken, TokenError
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken, AccessToken
+from rest_framework_simplejwt.utils import get_md5_hash_password
+from .models import ClaimsUser, ClaimsProfile
+from .blacklist import is_blacklisted, announce_blacklisted
+
+# Claims-based users. Access tokens carry the username, active flag and unit
+# preference next to the user id, so authenticating a request reads no rows:
+# a read-only user and profile are rebuilt from the token. Access tokens are
+# short-lived; saving a profile, or saving or deleting a user (deactivation
+# and password changes included), also marks every token issued before it as
+# stale, which the client answers like an expired token, by refreshing.
+# Refreshing re-reads the claims. With CHECK_REVOKE_TOKEN on, the password
+# hash of the row must be compared, so requests load the user as stock
+# simplejwt does.
+
+USER_CLAIMS = ('username', 'is_active', 'unit_preference')
+
+
+def set_user_claims(token, user):
+    token['username'] = user.username
+    token['is_active'] = user.is_active
+    token['unit_preference'] = user.profile.unit_preference
+
+
+def access_token_for(user):
+    """A fresh access token with the claims of `user` and its (just saved) profile."""
+    token = AccessToken.for_user(user)
+    set_user_claims(token, user)
+    return token
+
+
+def _claims_key(user_id):
+    return f'user:{user_id}:claims_changed'
+
+
+def user_claims_changed(user_id):
+    """Make every token issued for the user so far stale; their clients refresh."""
+    # Tokens live no longer than the access lifetime, and neither does the mark
+    cache.set(_claims_key(user_id), int(time.time()), api_settings.ACCESS_TOKEN_LIFETIME.total_seconds())
+
+
+def _check_fresh(validated_token, changed_at):
+    # iat has second resolution: a token issued in the second of the change is fresh
+    if changed_at is not None and validated_token.get('iat', 0) < changed_at:
+        raise InvalidToken({'detail': _('Token claims are out of date; refresh the token.'), 'code': 'token_stale'})
+
+
+def claims_user(validated_token):
+    """
+    A read-only ClaimsUser (and ClaimsProfile) holding the token's claims. It
+    compares, filters and assigns like the real row; its other fields are
+    blank, and saving or deleting it raises. Inactive users are refused as
+    JWTAuthentication refuses them.
+    """
+    if api_settings.CHECK_USER_IS_ACTIVE and not validated_token['is_active']:
+        raise AuthenticationFailed(_('User is inactive'), code='user_inactive')
+    user = ClaimsUser(**{api_settings.USER_ID_FIELD: ClaimsUser._meta.pk.to_python(validated_token[api_settings.USER_ID_CLAIM])},
+                      username=validated_token['username'], is_active=validated_token['is_active'])
+    user._state.adding = False
+    user.profile = ClaimsProfile(user=user, unit_preference=validated_token['unit_preference'])
+    return user
+
+
+def has_user_claims(validated_token):
+    # The revoke check needs the row's password hash, so it always loads the user
+    return not api_settings.CHECK_REVOKE_TOKEN and all(claim in validated_token for claim in USER_CLAIMS)
+
+
+class ClaimsRefreshToken(RefreshToken):
+    """
+    A refresh token whose access tokens carry the user claims, checked
+    against the blacklist through the in-process filter.
+    """
+
+    def check_blacklist(self):
+        if is_blacklisted(self[api_settings.JTI_CLAIM]):
+            raise TokenError(_('Token is blacklisted'))
+
+    def blacklist(self):
+        blacklisted = super().blacklist()
+        announce_blacklisted(self[api_settings.JTI_CLAIM])
+        return blacklisted
+
+    @classmethod
+    def for_user(cls, user):
+        token = super().for_user(user)
+        token.load_claims(user)
+        return token
+
+    def load_claims(self, user):
+        """Take the claims of its access tokens from `user`, loaded with its profile."""
+        set_user_claims(self, user)
+        self.claims_loaded = True
+
+    @property
+    def access_token(self):
+        # A refresh token sent back by a client holds the claims of its login
+        if not getattr(self, 'claims_loaded', False):
+            self.load_claims(get_user_model().objects.select_related('profile').get(
+                **{api_settings.USER_ID_FIELD: self[api_settings.USER_ID_CLAIM]}
+            ))
+        return super().access_token
+
+
+class ClaimsTokenObtainPairSerializer(TokenObtainPairSerializer):
+    token_class = ClaimsRefreshToken
+
+
+class ClaimsTokenRefreshSerializer(TokenRefreshSerializer):
+    """
+    TokenRefreshSerializer that loads the user once, with its profile: the
+    active check and the claims of the new access token both use that row.
+    """
+    token_class = ClaimsRefreshToken
+
+    def validate(self, attrs):
+        refresh = self.token_class(attrs['refresh'])
+        user = get_user_model().objects.select_related('profile').filter(
+            **{api_settings.USER_ID_FIELD: refresh.payload.get(api_settings.USER_ID_CLAIM)}
+        ).first()
+        if not api_settings.USER_AUTHENTICATION_RULE(user):
+            raise exceptions.AuthenticationFailed(self.error_messages['no_active_account'], 'no_active_account')
+        refresh.load_claims(user)
+        data = {'access': str(refresh.access_token)}
+
+        if api_settings.ROTATE_REFRESH_TOKENS:
+            if api_settings.BLACKLIST_AFTER_ROTATION:
+                refresh.blacklist()
+            refresh.set_jti()
+            refresh.set_exp()
+            refresh.set_iat()
+            refresh.outstand()
+            data['refresh'] = str(refresh)
+        return data
+
+
+class ClaimsJWTAuthentication(JWTAuthentication):
+    """
+    JWTAuthentication that builds the user from the token's claims when it
+    has them. Tokens issued without claims still load the user row.
+    """
+
+    def get_user(self, validated_token):
+        if not has_user_claims(validated_token):
+            return super().get_user(validated_token)
+        _check_fresh(validated_token, cache.get(_claims_key(validated_token[api_settings.USER_ID_CLAIM])))
+        return claims_user(validated_token)
+
+
+class AsyncJWTAuthentication(ClaimsJWTAuthentication):
+    """
+    JWTAuthentication for the async views. Parsing and verifying the access
+    token is pure CPU work, so it runs right on the event loop; the user is
+    then built from the claims or loaded with one async query, together with
+    its profile.
+    """
+
+    async def aauthenticate(self, request):
+        header = self.get_header(request)
+        if header is None:
+            return None
+        raw_token = self.get_raw_token(header)
+        if raw_token is None:
+            return None
+        validated_token = self.get_validated_token(raw_token)
+        return await self.aget_user(validated_token), validated_token
+
+    async def aget_user(self, validated_token):
+        """get_user() on the async ORM, with the same checks."""
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError as e:
+            raise InvalidToken(_('Token contained no recognizable user identification')) from e
+
+        if has_user_claims(validated_token):
+            _check_fresh(validated_token, await cache.aget(_claims_key(user_id)))
+            return claims_user(validated_token)
+
+        try:
+            user = await self.user_model.objects.select_related('profile').aget(**{api_settings.USER_ID_FIELD: user_id})
+        except self.user_model.DoesNotExist as e:
+            raise AuthenticationFailed(_('User not found'), code='user_not_found') from e
+
+        if api_settings.CHECK_USER_IS_ACTIVE and not user.is_active:
+            raise AuthenticationFailed(_('User is inactive'), code='user_inactive')
+        if api_settings.CHECK_REVOKE_TOKEN:
+            if validated_token.get(api_settings.REVOKE_TOKEN_CLAIM) != get_md5_hash_password(user.password):
+                raise AuthenticationFailed(_("The user's password has been changed."), code='password_changed')
+        return user
+
+
+# Stream tickets. Browsers' EventSource cannot send an Authorization header,
+# and an access token in the URL would end up in access logs, browser history
+# and Referer headers. Clients POST for a ticket instead: random, good for one
+# battle's leaderboard stream, accepted once and only for
+# STREAM_TICKET_LIFETIME seconds.
+
+STREAM_TICKET_LIFETIME = 30
+
+
+def _ticket_key(ticket):
+    return f'stream_ticket:{ticket}'
+
+
+def issue_stream_ticket(user_id, battle_id):
+    ticket = secrets.token_urlsafe(32)
+    cache.set(_ticket_key(ticket), (user_id, battle_id), STREAM_TICKET_LIFETIME)
+    return ticket
+
+
+async def aredeem_stream_ticket(ticket, battle_id):
+    """The user, with profile, a ticket for `battle_id` was issued to. The ticket is spent either way."""
+    key = _ticket_key(ticket)
+    issued = await cache.aget(key)
+    # Only the request whose delete removed the entry gets to use it
+    if issued is None or not await cache.adelete(key) or issued[1] != battle_id:
+        raise AuthenticationFailed(_('Invalid or expired stream ticket.'), code='invalid_ticket')
+    try:
+        return await get_user_model().objects.select_related('profile').aget(id=issued[0])
+    except get_user_model().DoesNotExist as e:
+        raise AuthenticationFailed(_('User not found'), code='user_not_found') from e
@@ -0,0 +1,210 @@
+from datetime import timedelta
+from django.db import transaction
+from django.db.models import Case, When, Value, F, Q, OuterRef, Subquery, DecimalField, IntegerField
+from django.utils import timezone
+from .models import Battle, BattleStatistic, BattleInvitation, WeightStat
+from .cache import invalidate_battles
+from .popular import battles_changed
+from .live import leaderboards_changed
+
+# Every stat a battle can track is a WeightStat column of the same name
+STAT_FIELDS = ['weight', 'bmi', 'body_fat', 'muscle_mass', 'body_water', 'bone_mass']
+
+Participation = Battle.participants.through
+
+
+def latest_readings(readings):
+    """Reduce a batch of readings to the newest one per user."""
+    latest = {}
+    for reading in readings:
+        current = latest.get(reading.user_id)
+        if current is None or (reading.date, reading.pk or 0) > (current.date, current.pk or 0):
+            latest[reading.user_id] = reading
+    return latest
+
+
+def _value_case(latest, field_name):
+    # CASE WHEN user_id = .. AND stat_type = .. THEN <reading value> ... ELSE <column> END
+    whens = [
+        When(user_id=user_id, stat_type=stat, then=Value(getattr(reading, stat)))
+        for user_id, reading in latest.items()
+        for stat in STAT_FIELDS
+        if getattr(reading, stat) is not None
+    ]
+    if not whens:
+        return None
+    return Case(*whens, default=F(field_name), output_field=DecimalField(max_digits=5, decimal_places=2))
+
+
+def refresh_battles(readings, created=True):
+    """
+    Apply new weight readings to every battle their users take part in.
+
+    Runs a fixed number of set-based queries no matter how many battles or
+    participants are involved:
+      * not_started battles get their starting/current value reset,
+      * in_progress battles get their current value moved (new readings only),
+      * in_progress stat_goal battles whose goal was reached are finished.
+
+    Duration battles are finished by sweep_expired_battles() on a schedule
+    instead (see the finish_expired_battles command).
+    """
+    latest = latest_readings(readings)
+    if not latest:
+        return []
+
+    user_ids = list(latest)
+    participations = list(
+        Participation.objects.filter(
+            user_id__in=user_ids,
+            battle__status__in=['not_started', 'in_progress'],
+        ).values(
+            'user_id', 'battle_id', 'battle__status', 'battle__type', 'battle__weight_param', 'battle__goal_value',
+        )
+    )
+    if not participations:
+        return []
+
+    with transaction.atomic():
+        # Bulk updates send no signals, so cached battle responses are retired here
+        invalidate_battles(p['battle_id'] for p in participations)
+        leaderboards_changed(p['battle_id'] for p in participations)
+
+        not_started = [p for p in participations if p['battle__status'] == 'not_started']
+        if not_started:
+            _create_missing_statistics(latest, not_started)
+            starting_case = _value_case(latest, 'starting_value')
+            if starting_case is not None:
+                BattleStatistic.objects.filter(
+                    user_id__in=user_ids, battle__status='not_started',
+                ).update(starting_value=starting_case, current_value=_value_case(latest, 'current_value'))
+
+        in_progress = [p for p in participations if p['battle__status'] == 'in_progress']
+        if in_progress and created:
+            current_case = _value_case(latest, 'current_value')
+            if current_case is not None:
+                BattleStatistic.objects.filter(
+                    user_id__in=user_ids, battle__status='in_progress',
+                ).update(current_value=current_case)
+
+        return _finish_battles(latest, in_progress)
+
+
+def sync_user_battles(user_id, created=True):
+    """
+    refresh_battles() with the user's latest stored reading. Queued jobs run
+    this, so the outcome only depends on the data, however often it runs.
+    """
+    latest = WeightStat.objects.filter(user_id=user_id).order_by('-date', '-id').first()
+    return refresh_battles([latest], created=created) if latest else []
+
+
+def _create_missing_statistics(latest, participations):
+    existing = set(
+        BattleStatistic.objects.filter(
+            user_id__in=list(latest), battle__status='not_started',
+        ).values_list('battle_id', 'user_id')
+    )
+    missing = []
+    for p in participations:
+        key = (p['battle_id'], p['user_id'])
+        value = getattr(latest[p['user_id']], p['battle__weight_param'], None)
+        if key in existing or value is None:
+            continue
+        existing.add(key)
+        missing.append(BattleStatistic(
+            battle_id=p['battle_id'],
+            user_id=p['user_id'],
+            stat_type=p['battle__weight_param'],
+            starting_value=value,
+            current_value=value,
+        ))
+    if missing:
+        BattleStatistic.objects.bulk_create(missing)
+
+
+def _finish_battles(latest, participations):
+    goal_winners = {}
+    for p in participations:
+        if p['battle__type'] != 'stat_goal':
+            continue
+        goal = p['battle__goal_value']
+        reading = latest[p['user_id']]
+        value = getattr(reading, p['battle__weight_param'], None)
+        if goal is None or value is None:
+            continue
+        # Weight and body fat goals are reached by going down to them, the rest by going up
+        if p['battle__weight_param'] in Battle.LOWER_IS_BETTER_PARAMS:
+            if value > goal:
+                continue
+        elif value < goal:
+            continue
+        # The earliest qualifying reading in the batch takes the win
+        best = goal_winners.get(p['battle_id'])
+        if best is None or (reading.date, reading.pk or 0) < (latest[best].date, latest[best].pk or 0):
+            goal_winners[p['battle_id']] = p['user_id']
+    return finish_battles(goal_winners)
+
+
+def finish_battles(winners=None, battle_ids=()):
+    """
+    Finish in_progress battles with a single UPDATE.
+
+    `winners` maps battle id -> winning user id; battles listed only in
+    `battle_ids` are won by their best-scoring participant, chosen inside the
+    same statement. Scores are ranked like the leaderboard (see
+    BattleStatisticQuerySet.scored), so weight and body fat battles are won
+    by going down, the rest by going up; ties go to the lowest user id.
+    """
+    winners = winners or {}
+    finished = list(winners) + [battle_id for battle_id in battle_ids if battle_id not in winners]
+    if not finished:
+        return []
+
+    top_scorer = BattleStatistic.objects.filter(
+        battle=OuterRef('pk'),
+    ).scored().order_by('-score', 'user_id').values('user_id')[:1]
+    winner = Case(
+        *[When(id=battle_id, then=Value(user_id)) for battle_id, user_id in winners.items()],
+        default=Subquery(top_scorer),
+        output_field=IntegerField(),
+    )
+    with transaction.atomic():
+        Battle.objects.filter(id__in=finished, status='in_progress').update(status='finished', winner_id=winner)
+        # update() skips post_save, so clean up invitations and caches the way the signals would
+        BattleInvitation.objects.filter(battle_id__in=finished).delete()
+        invalidate_battles(finished)
+        battles_changed()
+    return finished
+
+
+def sweep_expired_battles(now=None, batch_size=1000):
+    """
+    Finish every in_progress duration battle whose time is up.
+
+    Battles are found through the partial in_progress index, one query per
+    distinct duration, and finished `batch_size` at a time. Returns the
+    number of battles finished.
+
+    Not one statement for the whole backlog: ids listed in a statement are
+    bind parameters, which both databases cap well below 100k, and one huge
+    UPDATE would hold its row locks for its whole run. Each batch picks its
+    winners with a subquery per battle, an index lookup on
+    (battle, user); precomputing them with one window query and passing them
+    back in a CASE was measured 5x slower, all of it in building the CASE.
+    """
+    now = now or timezone.now()
+    running = Battle.objects.filter(status='in_progress', type='duration', duration__isnull=False)
+    durations = running.order_by().values_list('duration', flat=True).distinct()
+    expired = Q()
+    for days in durations:
+        expired |= Q(duration=days, created_at__lte=now - timedelta(days=days))
+    if not expired:
+        return 0
+
+    total = 0
+    while True:
+        battle_ids = list(running.filter(expired).order_by('id').values_list('id', flat=True)[:batch_size])
+        if not battle_ids:
+            return total
+        total += len(finish_battles(battle_ids=battle_ids))
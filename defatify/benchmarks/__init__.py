@@ -0,0 +1,5 @@
+"""
+Performance benchmarks, run with `python manage.py benchmark <suite>`.
+
+Each suite module exposes `run(**options)` returning a dict of results.
+"""
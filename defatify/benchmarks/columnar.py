@@ -0,0 +1,46 @@
+"""
+Payload size and serialize-plus-render time of a page of readings in the
+regular JSON format, built by the ModelSerializer or by RowSerializer, and
+in the columnar format. Sizes are reported raw and gzipped, since most
+clients fetch compressed.
+"""
+import gzip
+import timeit
+from types import SimpleNamespace
+from rest_framework.renderers import JSONRenderer
+from defatify.benchmarks.rows import _populate
+from defatify.columnar import ColumnarJSONRenderer, weight_columns
+from defatify.models import WeightStat
+from defatify.serializers import RowSerializer, WeightStatSerializer
+from defatify.utils import UnitConverter
+
+USES_DATABASE = True
+
+
+def run(rows=1000, repeat=5, **options):
+    user = _populate(rows)
+    request = SimpleNamespace(user=user)
+    units = UnitConverter.for_request(request)
+    row_serializer = RowSerializer.for_class(WeightStatSerializer)
+    queryset = WeightStat.objects.filter(user=user).order_by('-date', '-id')
+    # Fetched once: this compares serializing and rendering, not the query
+    instances = list(queryset)
+    values = list(row_serializer.rows(queryset))
+
+    formats = {
+        'model_serializer': lambda: JSONRenderer().render(
+            WeightStatSerializer(instances, many=True, context={'request': request}).data),
+        'row_serializer': lambda: JSONRenderer().render(row_serializer.serialize(values, units)),
+        'columnar': lambda: ColumnarJSONRenderer().render(weight_columns(values, units)),
+    }
+    results = {}
+    for label, build in formats.items():
+        payload = build()
+        seconds = min(timeit.repeat(build, number=1, repeat=repeat))
+        results[label] = {
+            'rows': rows,
+            'bytes': len(payload),
+            'gzip_bytes': len(gzip.compress(payload)),
+            'ms': round(seconds * 1000, 3),
+        }
+    return results
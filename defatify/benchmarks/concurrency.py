@@ -0,0 +1,115 @@
+"""
+Concurrent-request throughput of the read endpoints: the DRF views behind the
+WSGI handler (one thread per in-flight request) against the same views and
+their async twins behind the ASGI handler.
+
+Requests go through Django's full handler and middleware stack in-process, via
+the test clients, so the numbers compare the two request models without any
+server or network in the way. Battle detail and leaderboard responses are
+cached after the first request in every mode alike.
+"""
+import asyncio
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from decimal import Decimal
+from django.contrib.auth.models import User
+from django.test import Client, AsyncClient
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework_simplejwt.tokens import RefreshToken
+from defatify.models import WeightStat, Battle, BattleStatistic, BattleInvitation
+
+USES_DATABASE = True
+
+
+def _populate(participants=50, readings=200):
+    user = User.objects.create(username='loadtest')
+    rivals = User.objects.bulk_create([User(username=f'loadtest{i}') for i in range(participants)])
+    now = timezone.now()
+    WeightStat.objects.bulk_create([
+        WeightStat(user=user, date=now - timedelta(hours=i), weight=Decimal('80.00') + Decimal(i % 100) / 10)
+        for i in range(readings)
+    ])
+    battle = Battle.objects.create(name='Load test', creator=user, type='stat_goal', weight_param='weight',
+                                   goal_value=Decimal('70.00'), status='in_progress')
+    battle.participants.add(user, *rivals)
+    BattleStatistic.objects.bulk_create([
+        BattleStatistic(battle=battle, user=person, stat_type='weight', starting_value=Decimal('90.00'),
+                        current_value=Decimal('90.00') - Decimal(i % 20) / 4)
+        for i, person in enumerate([user, *rivals])
+    ])
+    BattleInvitation.objects.bulk_create([
+        BattleInvitation(battle=battle, invited_user=user, inviting_user=rival) for rival in rivals[:20]
+    ])
+    return user, battle
+
+
+def _endpoints(battle):
+    """(label, sync url, async url) of every mirrored endpoint."""
+    detail = [battle.id]
+    return [
+        ('profile', reverse('get_profile'), reverse('async_get_profile')),
+        ('weight_history', reverse('weight_stat_list_create'), reverse('async_weight_stat_list')),
+        ('battle_detail', reverse('battle_detail', args=detail), reverse('async_battle_detail', args=detail)),
+        ('leaderboard', reverse('battle_leaderboard', args=detail), reverse('async_battle_leaderboard', args=detail)),
+        ('pending_invitations', reverse('pending_invitations'), reverse('async_pending_invitations')),
+    ]
+
+
+def _summary(latencies, elapsed):
+    latencies = sorted(latencies)
+    return {
+        'requests_per_second': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(statistics.median(latencies), 3),
+        'p95_ms': round(latencies[int(len(latencies) * 0.95) - 1], 3),
+    }
+
+
+def _run_wsgi(url, headers, requests, concurrency):
+    clients = threading.local()
+
+    def one(_):
+        if not hasattr(clients, 'client'):
+            clients.client = Client(headers=headers)
+        started = time.perf_counter()
+        response = clients.client.get(url)
+        assert response.status_code == 200, response.content
+        return (time.perf_counter() - started) * 1000
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = list(pool.map(one, range(requests)))
+    return _summary(latencies, time.perf_counter() - started)
+
+
+async def _run_asgi(url, headers, requests, concurrency):
+    client = AsyncClient()
+    slots = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with slots:
+            started = time.perf_counter()
+            response = await client.get(url, headers=headers)
+            assert response.status_code == 200, response.content
+            return (time.perf_counter() - started) * 1000
+
+    started = time.perf_counter()
+    latencies = await asyncio.gather(*[one() for _ in range(requests)])
+    return _summary(latencies, time.perf_counter() - started)
+
+
+def run(requests=500, concurrency=20, **options):
+    user, battle = _populate()
+    headers = {'Authorization': f'Bearer {RefreshToken.for_user(user).access_token}'}
+
+    results = {}
+    for label, sync_url, async_url in _endpoints(battle):
+        results[label] = {
+            'wsgi': _run_wsgi(sync_url, headers, requests, concurrency),
+            'asgi_sync_views': asyncio.run(_run_asgi(sync_url, headers, requests, concurrency)),
+            'asgi_async_views': asyncio.run(_run_asgi(async_url, headers, requests, concurrency)),
+        }
+    return {'requests': requests, 'concurrency': concurrency, 'endpoints': results}
@@ -0,0 +1,166 @@
+"""
+Synthetic data at production-like sizes, written with bulk_create().
+
+Sizes follow the shapes seen in real use rather than uniform ones: most
+battles have a handful of participants while a few have hundreds, and friend
+counts are heavy-tailed too. One user, the viewer, is wired to every kind of
+object the endpoints act on, so a harness can drive each route as them.
+"""
+import random
+from datetime import timedelta
+from decimal import Decimal
+from types import SimpleNamespace
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.utils import timezone
+from defatify.authentication import ClaimsRefreshToken
+from defatify.search import forget_user_search
+from defatify.models import Profile, WeightStat, FriendRequest, Friendship, Battle, BattleStatistic, BattleInvitation
+
+PASSWORD = 'benchmark-password'
+BATCH_SIZE = 5000
+
+VIEWER_FRIENDS = 50
+VIEWER_BATTLES = 20
+VIEWER_INVITATIONS = 30
+VIEWER_FRIEND_REQUESTS = 20
+
+
+def _heavy_tailed(rng, scale, limit):
+    """A Pareto-distributed size: mostly around `scale`, occasionally up to `limit`."""
+    return min(int(rng.paretovariate(1.2) * scale), limit)
+
+
+def _readings(rng, user, count, now):
+    weight = Decimal(rng.randint(6000, 12000)) / 100
+    body_fat = Decimal(rng.randint(1500, 3500)) / 100
+    rows = []
+    # Roughly daily, oldest first, drifting slowly downwards
+    for day in range(count, 0, -1):
+        weight = max(weight + Decimal(rng.randint(-60, 50)) / 100, Decimal('40.00'))
+        rows.append(WeightStat(
+            user=user, date=now - timedelta(days=day, minutes=rng.randint(0, 720)), weight=weight,
+            bmi=(weight / Decimal('3.1')).quantize(Decimal('0.01')), body_fat=body_fat,
+            muscle_mass=(weight * Decimal('0.42')).quantize(Decimal('0.01')),
+        ))
+    return rows
+
+
+def generate(users=1000, readings=100, battles=200, seed=7):
+    """
+    Users with profiles and `readings` readings each, heavy-tailed friendships,
+    `battles` battles with statistics for all participants, pending friend
+    requests and invitations. Returns the viewer and the ids routes need.
+    """
+    if users < VIEWER_FRIENDS + VIEWER_FRIEND_REQUESTS + 10 or battles < VIEWER_BATTLES + VIEWER_INVITATIONS + 5:
+        raise ValueError(f'Generate at least {VIEWER_FRIENDS + VIEWER_FRIEND_REQUESTS + 10} users '
+                         f'and {VIEWER_BATTLES + VIEWER_INVITATIONS + 5} battles.')
+    rng = random.Random(seed)
+    now = timezone.now()
+    password = make_password(PASSWORD)
+
+    people = User.objects.bulk_create([
+        User(username=f'bench{i:06d}', email=f'bench{i}@example.com', password=password) for i in range(users)
+    ], batch_size=BATCH_SIZE)
+    Profile.objects.bulk_create([
+        Profile(user=person, unit_preference='imperial' if rng.random() < 0.3 else 'metric') for person in people
+    ], batch_size=BATCH_SIZE)
+    viewer, others = people[0], people[1:]
+    # bulk_create() sends no signals, so the username search index learns of the users here
+    forget_user_search()
+
+    stats = []
+    for person in people:
+        stats.extend(_readings(rng, person, readings, now))
+        if len(stats) >= BATCH_SIZE:
+            WeightStat.objects.bulk_create(stats)
+            stats = []
+    WeightStat.objects.bulk_create(stats)
+
+    # Friendships are stored in both directions; the viewer's are fixed below
+    friend_of_viewer = others[:VIEWER_FRIENDS]
+    requesters = others[-VIEWER_FRIEND_REQUESTS:]
+    stranger = others[-VIEWER_FRIEND_REQUESTS - 1]
+    pairs = {(viewer.id, friend.id) for friend in friend_of_viewer}
+    for person in others:
+        for friend in rng.sample(others, _heavy_tailed(rng, 3, min(200, len(others)))):
+            if friend.id != person.id:
+                pairs.add((min(person.id, friend.id), max(person.id, friend.id)))
+    Friendship.objects.bulk_create([
+        Friendship(user_id=a, friend_id=b) for pair in pairs for a, b in (pair, pair[::-1])
+    ], batch_size=BATCH_SIZE)
+    FriendRequest.objects.bulk_create(
+        [FriendRequest(from_user=requester, to_user=viewer) for requester in requesters]
+        + [FriendRequest(from_user=rng.choice(others), to_user=rng.choice(others)) for _ in range(users)],
+        batch_size=BATCH_SIZE,
+    )
+
+    specs = []
+    for i in range(battles):
+        battle_type = 'duration' if rng.random() < 0.3 else 'stat_goal'
+        specs.append(Battle(
+            name=f'{rng.choice(["Summer", "Winter", "Office", "Family", "Marathon"])} cut {i}',
+            description=rng.choice(['Lose it together', 'Bulk season', 'Fat loss challenge', None]),
+            creator=rng.choice(others), type=battle_type,
+            weight_param=rng.choice(['weight', 'weight', 'weight', 'body_fat', 'muscle_mass']),
+            goal_value=Decimal(rng.randint(6000, 9000)) / 100 if battle_type == 'stat_goal' else None,
+            duration=rng.choice([7, 14, 30]) if battle_type == 'duration' else None,
+            is_private=rng.random() < 0.2,
+            status=rng.choices(['not_started', 'in_progress', 'finished', 'deleted'], [30, 50, 15, 5])[0],
+        ))
+    # A few targets the routes act on: a huge public battle the viewer is in,
+    # a public one to join and one the viewer created and can still edit
+    specs[0].is_private, specs[0].status = False, 'in_progress'
+    specs[1].is_private, specs[1].status = False, 'in_progress'
+    specs[2].creator, specs[2].status = viewer, 'not_started'
+    created = Battle.objects.bulk_create(specs, batch_size=BATCH_SIZE)
+    big, joinable, own = created[:3]
+
+    members = {}
+    for battle in created:
+        joined = rng.sample(others, max(_heavy_tailed(rng, 2, len(others)), 1))
+        members[battle.id] = {battle.creator_id, *(person.id for person in joined)}
+    members[big.id] |= {viewer.id, *(person.id for person in rng.sample(others, len(others) // 2))}
+    members[joinable.id].discard(viewer.id)
+    for battle in rng.sample(created[3:], VIEWER_BATTLES):
+        members[battle.id].add(viewer.id)
+
+    Battle.participants.through.objects.bulk_create([
+        Battle.participants.through(battle_id=battle_id, user_id=user_id)
+        for battle_id, user_ids in members.items() for user_id in user_ids
+    ], batch_size=BATCH_SIZE)
+    for battle in created:
+        battle.participant_count = len(members[battle.id])
+    Battle.objects.bulk_update(created, ['participant_count'], batch_size=BATCH_SIZE)
+    statistics = []
+    for battle in created:
+        for user_id in members[battle.id]:
+            start = Decimal(rng.randint(5000, 9000)) / 100
+            statistics.append(BattleStatistic(battle=battle, user_id=user_id, stat_type=battle.weight_param,
+                                              starting_value=start, current_value=start - Decimal(rng.randint(-200, 800)) / 100))
+    BattleStatistic.objects.bulk_create(statistics, batch_size=BATCH_SIZE)
+
+    open_battles = [battle for battle in created[3:]
+                    if battle.status in ('not_started', 'in_progress') and viewer.id not in members[battle.id]]
+    invitations = BattleInvitation.objects.bulk_create(
+        [BattleInvitation(battle=battle, invited_user=viewer, inviting_user_id=rng.choice(sorted(members[battle.id])))
+         for battle in rng.sample(open_battles, min(VIEWER_INVITATIONS, len(open_battles)))]
+        + [BattleInvitation(battle=battle, invited_user=rng.choice(others), inviting_user=battle.creator)
+           for battle in rng.choices(created, k=battles * 3)],
+        batch_size=BATCH_SIZE,
+    )
+    invited = {invitation.invited_user_id for invitation in invitations if invitation.battle_id == own.id}
+    invitee = next(person for person in others if person.id not in members[own.id] | invited)
+
+    refresh = ClaimsRefreshToken.for_user(viewer)
+    return SimpleNamespace(
+        viewer=viewer, password=PASSWORD, refresh=str(refresh), access=str(refresh.access_token),
+        friend_id=friend_of_viewer[0].id, stranger_id=stranger.id,
+        friend_request_id=FriendRequest.objects.get(from_user=requesters[0], to_user=viewer).id,
+        big_battle_id=big.id, joinable_battle_id=joinable.id, own_battle_id=own.id, invitee_id=invitee.id,
+        invitation_id=invitations[0].id, sizes={
+            'users': users, 'readings': users * readings, 'friendships': len(pairs) * 2,
+            'battles': battles, 'participants': sum(len(user_ids) for user_ids in members.values()),
+            'invitations': len(invitations),
+        },
+    )
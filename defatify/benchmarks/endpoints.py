@@ -0,0 +1,212 @@
+"""
+Latency, query count and rows fetched of every route in defatify/urls.py,
+driven through the test client as data.generate()'s viewer with a real JWT.
+
+Each request runs in a transaction that is rolled back afterwards, once its
+on_commit callbacks have run, so writes cost what they cost in production
+while every request still sees the same data. Battle updates the request
+queues (defatify/jobs.py) run right after it in the same transaction; their
+time is reported apart as deferred_ms. One unrecorded request per route
+warms the caches first. Keys and numbers are stable between runs of
+the same code, so two results files can be diffed to spot a regression.
+"""
+import math
+import statistics
+import subprocess
+import time
+from collections import namedtuple
+from unittest import mock
+from django.db import connection, transaction
+from django.test import TestCase
+from django.urls import reverse
+from rest_framework.test import APIClient
+from defatify import urls
+from defatify.battle_updates import sync_user_battles
+from defatify.jobs import battle_update_queue
+from defatify.benchmarks.data import generate
+
+USES_DATABASE = True
+
+Route = namedtuple('Route', ['label', 'name', 'method', 'args', 'data', 'status'], defaults=[(), None, 200])
+
+READING = {'weight': '80.50', 'bmi': '24.10', 'body_fat': '20.00', 'muscle_mass': '34.00',
+           'body_water': '55.00', 'bone_mass': '3.10'}
+
+# Routes the harness cannot time as a single request
+SKIPPED = {
+    'leaderboard_stream': 'An open-ended Server-Sent Events stream, not a request/response.',
+    'metrics': 'The Prometheus scrape endpoint, guarded by METRICS_TOKEN rather than a JWT.',
+}
+
+
+def routes(data):
+    """Every route with arguments that make it succeed as the viewer."""
+    viewer = data.viewer
+    return [
+        Route('POST register', 'register', 'post',
+              data={'username': 'bench_new', 'password': data.password, 'email': 'bench_new@example.com'}, status=201),
+        Route('POST login', 'login', 'post', data={'username': viewer.username, 'password': data.password}),
+        Route('POST token_refresh', 'token_refresh', 'post', data={'refresh': data.refresh}),
+        Route('POST logout', 'logout', 'post', data={'refresh': data.refresh}, status=205),
+        Route('GET get_profile', 'get_profile', 'get'),
+        Route('PATCH update_profile', 'update_profile', 'patch', data={'bio': 'Benchmarking'}),
+        Route('GET weight_stat_list_create', 'weight_stat_list_create', 'get'),
+        Route('GET weight_stat_list_create columns', 'weight_stat_list_create', 'get', data={'format': 'columns', 'page_size': 100}),
+        Route('POST weight_stat_list_create', 'weight_stat_list_create', 'post', data=READING, status=201),
+        Route('POST weight_stat_bulk_create', 'weight_stat_bulk_create', 'post', status=201, data=[
+            {**READING, 'date': f'2100-01-01T{hour:02d}:{minute:02d}:00Z'}
+            for hour in range(2) for minute in range(50)
+        ]),
+        Route('POST weight_stat_import', 'weight_stat_import', 'post', status=201, data=(
+            'date,weight,body_fat\n' + ''.join(f'2100-02-01T{hour:02d}:{minute:02d}:00Z,80.50,20.00\n'
+                                                for hour in range(10) for minute in range(50))
+        ).encode()),
+        Route('GET weight_stat_export', 'weight_stat_export', 'get'),
+        Route('GET weight_stat_export ndjson', 'weight_stat_export', 'get', data={'format': 'ndjson'}),
+        Route('GET weight_stat_rollups', 'weight_stat_rollups', 'get', data={'period': 'week'}),
+        Route('GET friends_list', 'friends_list', 'get'),
+        Route('POST friend_request_send', 'friend_request_send', 'post', data={'to_user': data.stranger_id}, status=201),
+        Route('GET friend_requests_list', 'friend_requests_list', 'get'),
+        Route('PUT friend_request_action', 'friend_request_action', 'put', (data.friend_request_id, 'accept')),
+        Route('DELETE remove_friend', 'remove_friend', 'delete', (data.friend_id,), status=204),
+        Route('GET user_search', 'user_search', 'get', data={'query': 'bench00001'}),
+        Route('GET battle_list', 'battle_list', 'get'),
+        Route('POST battle_list', 'battle_list', 'post', status=201, data={
+            'name': 'New battle', 'type': 'stat_goal', 'weight_param': 'weight', 'goal_value': '75.00',
+        }),
+        Route('GET battle_detail', 'battle_detail', 'get', (data.big_battle_id,)),
+        Route('POST battle_join', 'battle_join', 'post', (data.joinable_battle_id,)),
+        Route('DELETE battle_leave', 'battle_leave', 'delete', (data.big_battle_id,), status=204),
+        Route('GET battle_leaderboard', 'battle_leaderboard', 'get', (data.big_battle_id,)),
+        Route('GET battle_leaderboard around_me', 'battle_leaderboard', 'get', (data.big_battle_id,), {'around_me': 1}),
+        Route('POST leaderboard_stream_ticket', 'leaderboard_stream_ticket', 'post', (data.big_battle_id,), status=201),
+        Route('POST battle_invite', 'battle_invite', 'post', (data.own_battle_id,), {'invited_user': data.invitee_id}, 201),
+        Route('GET pending_invitations', 'pending_invitations', 'get'),
+        Route('POST accept_invitation', 'accept_invitation', 'post', (data.invitation_id,)),
+        Route('POST reject_invitation', 'reject_invitation', 'post', (data.invitation_id,)),
+        Route('POST start_battle', 'start_battle', 'post', (data.own_battle_id,)),
+        Route('DELETE battle_soft_delete', 'battle_soft_delete', 'delete', (data.own_battle_id,)),
+        Route('PUT battle_update', 'battle_update', 'put', (data.own_battle_id,), {'description': 'Updated'}),
+        Route('GET top_popular_battles', 'top_popular_battles', 'get'),
+        Route('GET battle_search', 'battle_search', 'get', data={'query': 'summer'}),
+        Route('GET async_get_profile', 'async_get_profile', 'get'),
+        Route('GET async_weight_stat_list', 'async_weight_stat_list', 'get'),
+        Route('GET async_battle_detail', 'async_battle_detail', 'get', (data.big_battle_id,)),
+        Route('GET async_battle_leaderboard', 'async_battle_leaderboard', 'get', (data.big_battle_id,)),
+        Route('GET async_pending_invitations', 'async_pending_invitations', 'get'),
+    ]
+
+
+class Meter:
+    """Database execute wrapper counting the queries of a request and the rows they fetched."""
+
+    def __init__(self):
+        self.queries = 0
+        self.rows = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries += 1
+        cursor = context['cursor']
+        if not getattr(cursor, 'metered', False):
+            # Instance attributes take precedence over CursorWrapper's delegation to the driver's cursor
+            cursor.fetchone = self._counting(cursor.fetchone, lambda row: row is not None)
+            cursor.fetchmany = self._counting(cursor.fetchmany, len)
+            cursor.fetchall = self._counting(cursor.fetchall, len)
+            cursor.metered = True
+        return execute(sql, params, many, context)
+
+    def _counting(self, fetch, count):
+        def counted(*args, **kwargs):
+            rows = fetch(*args, **kwargs)
+            self.rows += count(rows)
+            return rows
+        return counted
+
+
+def _request(client, route):
+    url = reverse(route.name, args=route.args)
+    if isinstance(route.data, bytes):
+        return getattr(client, route.method)(url, route.data, content_type='text/csv')
+    return getattr(client, route.method)(url, route.data, format=None if route.method == 'get' else 'json')
+
+
+def _timed(client, route):
+    """
+    (milliseconds, Meter, milliseconds of queued battle updates) of one
+    request, rolled back once its on_commit callbacks and jobs ran.
+    """
+    meter, jobs = Meter(), []
+    with transaction.atomic():
+        started = time.perf_counter()
+        # The patch outlives the on_commit callbacks that schedule the jobs
+        with mock.patch.object(battle_update_queue, '_schedule', lambda user_id, created: jobs.append((user_id, created))), \
+                connection.execute_wrapper(meter), TestCase.captureOnCommitCallbacks(execute=True):
+            response = _request(client, route)
+            if response.streaming:
+                b''.join(response.streaming_content)
+        elapsed = (time.perf_counter() - started) * 1000
+        started = time.perf_counter()
+        with TestCase.captureOnCommitCallbacks(execute=True):
+            # Coalesced per user, as the queue would
+            for user_id in dict.fromkeys(user_id for user_id, _ in jobs):
+                sync_user_battles(user_id, any(created for job_user_id, created in jobs if job_user_id == user_id))
+        deferred = (time.perf_counter() - started) * 1000
+        transaction.set_rollback(True)
+    assert response.status_code == route.status, (route.label, response.status_code, response.content)
+    if 'X-Access-Token' in response:
+        # Profile updates retire the current token, like a real client we switch over
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {response["X-Access-Token"]}')
+    return elapsed, meter, deferred
+
+
+def _percentile(ordered, percent):
+    """Nearest-rank percentile of an ascending list."""
+    return ordered[max(math.ceil(len(ordered) * percent / 100) - 1, 0)]
+
+
+def measure(client, route, requests):
+    _timed(client, route)
+    latencies, queries, rows, deferred = [], [], [], []
+    for _ in range(requests):
+        elapsed, meter, deferred_ms = _timed(client, route)
+        latencies.append(elapsed)
+        queries.append(meter.queries)
+        rows.append(meter.rows)
+        deferred.append(deferred_ms)
+    latencies.sort()
+    return {
+        'route': route.name,
+        'status': route.status,
+        'p50_ms': round(_percentile(latencies, 50), 3),
+        'p95_ms': round(_percentile(latencies, 95), 3),
+        'p99_ms': round(_percentile(latencies, 99), 3),
+        'queries': round(statistics.mean(queries), 1),
+        'rows_fetched': round(statistics.mean(rows), 1),
+        'deferred_ms': round(statistics.mean(deferred), 3),
+    }
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(users=1000, readings=100, battles=200, requests=100, **options):
+    data = generate(users=users, readings=readings, battles=battles)
+    plan = routes(data)
+    missing = {pattern.name for pattern in urls.urlpatterns} - {route.name for route in plan} - set(SKIPPED)
+    if missing:
+        raise ValueError(f'No benchmark route for: {", ".join(sorted(missing))}.')
+
+    client = APIClient()
+    client.credentials(HTTP_AUTHORIZATION=f'Bearer {data.access}')
+    return {
+        'commit': _commit(),
+        'database': connection.vendor,
+        'requests_per_route': requests,
+        'data': data.sizes,
+        'skipped': SKIPPED,
+        'endpoints': {route.label: measure(client, route, requests) for route in plan},
+    }
@@ -0,0 +1,150 @@
+"""
+Peak Python memory and rows per second of the weight history export, for a
+tenth of the rows and for all of them, through the WSGI-style test client and
+through Django's ASGI handler (the `-asgi` results). A streamed export keeps
+its peak flat while the row count grows tenfold; one that buffers grows with it.
+
+Measured with the default 1,000,000 rows on SQLite (`manage.py benchmark export`):
+
+    format        peak at 100k rows   peak at 1M rows   rows/s at 1M   body at 1M
+    csv           4473 KiB            4686 KiB          26.5k          54 MiB
+    ndjson        4277 KiB            4279 KiB          23.9k          148 MiB
+    csv-asgi      4702 KiB            4920 KiB          26.2k          54 MiB
+    ndjson-asgi   4696 KiB            4700 KiB          24.8k          148 MiB
+
+The unit test runs the suite with a few thousand rows; run the command after
+touching exports.py.
+"""
+import asyncio
+import time
+import tracemalloc
+from urllib.parse import urlencode
+from asgiref.sync import async_to_sync
+from django.core.handlers.asgi import ASGIHandler
+from django.core.signals import request_started, request_finished
+from django.db import close_old_connections
+from datetime import timedelta
+from decimal import Decimal
+from django.contrib.auth.models import User
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+from defatify.authentication import access_token_for
+from defatify.models import Profile, WeightStat
+
+USES_DATABASE = True
+BATCH_SIZE = 5000
+
+
+def _populate(user, start, stop, now):
+    for batch in range(start, stop, BATCH_SIZE):
+        WeightStat.objects.bulk_create([
+            WeightStat(user=user, date=now - timedelta(minutes=i), weight=Decimal('80.00') + Decimal(i % 500) / 100,
+                       bmi=Decimal('24.50'), body_fat=Decimal('20.00'))
+            for i in range(batch, min(batch + BATCH_SIZE, stop))
+        ])
+
+
+def _traced(consume, traced):
+    if traced:
+        tracemalloc.start()
+    started = time.perf_counter()
+    size = consume()
+    elapsed = time.perf_counter() - started
+    peak = 0
+    if traced:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return size, elapsed, peak
+
+
+def _export(client, export_format, traced):
+    response = client.get(reverse('weight_stat_export'), {'format': export_format})
+    assert response.status_code == 200, response.status_code
+    return _traced(lambda: sum(len(chunk) for chunk in response.streaming_content), traced)
+
+
+async def _asgi_get(path, query, headers):
+    """Bytes of the body Django's ASGI handler sends for a GET, counted as it is sent."""
+    scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+             'path': path, 'raw_path': path.encode(), 'query_string': urlencode(query).encode(), 'root_path': '',
+             'headers': [(name.encode(), value.encode()) for name, value in headers.items()],
+             'client': ('127.0.0.1', 0), 'server': ('testserver', 80)}
+    received = False
+    status = None
+    size = 0
+
+    async def receive():
+        nonlocal received
+        if not received:
+            received = True
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        # The client never disconnects
+        await asyncio.Event().wait()
+
+    async def send(message):
+        nonlocal status, size
+        if message['type'] == 'http.response.start':
+            status = message['status']
+        elif message['type'] == 'http.response.body':
+            size += len(message.get('body', b''))
+
+    await ASGIHandler()(scope, receive, send)
+    assert status == 200, status
+    return size
+
+
+def _asgi_export(user, export_format, traced):
+    # A fresh token per export: measuring a million rows outlasts its lifetime
+    headers = {'host': 'testserver', 'authorization': f'Bearer {access_token_for(user)}'}
+    # Like the test client, keep the handler from closing the benchmark's database connection
+    request_started.disconnect(close_old_connections)
+    request_finished.disconnect(close_old_connections)
+    try:
+        return _traced(lambda: async_to_sync(_asgi_get)(reverse('weight_stat_export'), {'format': export_format}, headers),
+                       traced)
+    finally:
+        request_started.connect(close_old_connections)
+        request_finished.connect(close_old_connections)
+
+
+def measure(export, rows):
+    results = {}
+    for export_format in ('csv', 'ndjson'):
+        size, elapsed, _ = export(export_format, traced=False)
+        _, _, peak = export(export_format, traced=True)
+        results[export_format] = {
+            'rows': rows,
+            'bytes': size,
+            'rows_per_second': round(rows / elapsed),
+            'peak_python_kib': round(peak / 1024),
+        }
+    return results
+
+
+def run(rows=1000000, **options):
+    user = User.objects.create(username='exportbench')
+    Profile.objects.filter(user=user).update(unit_preference='imperial')
+    user.refresh_from_db()
+    client = APIClient()
+    client.force_authenticate(user)
+    now = timezone.now()
+
+    def both(rows):
+        results = measure(lambda export_format, traced: _export(client, export_format, traced), rows)
+        asgi = measure(lambda export_format, traced: _asgi_export(user, export_format, traced), rows)
+        results.update({f'{export_format}-asgi': result for export_format, result in asgi.items()})
+        return results
+
+    _populate(user, 0, rows // 10, now)
+    tenth = both(rows // 10)
+    _populate(user, rows // 10, rows, now)
+    full = both(rows)
+    return {
+        export_format: {
+            'tenth': tenth[export_format],
+            'full': full[export_format],
+            'peak_growth': round(full[export_format]['peak_python_kib'] / max(tenth[export_format]['peak_python_kib'], 1), 2),
+        }
+        for export_format in full
+    }
@@ -0,0 +1,70 @@
+"""Latency of shallow vs deep pages of the weight history, offset vs keyset pagination."""
+import statistics
+import time
+from datetime import timedelta
+from decimal import Decimal
+from django.contrib.auth.models import User
+from django.utils import timezone
+from rest_framework.pagination import PageNumberPagination
+from rest_framework.test import APIRequestFactory, force_authenticate
+from defatify.models import WeightStat
+from defatify.views import WeightStatListCreateView
+
+USES_DATABASE = True
+
+PAGE_SIZE = 10
+
+
+class LegacyWeightStatListView(WeightStatListCreateView):
+    """The endpoint as it was paginated before: PAGE_SIZE rows per ?page=N."""
+    pagination_class = PageNumberPagination
+
+    def get_queryset(self):
+        return super().get_queryset().order_by('-date', '-id')
+
+
+def _timed(view, request, user):
+    force_authenticate(request, user)
+    started = time.perf_counter()
+    response = view(request)
+    elapsed = time.perf_counter() - started
+    assert response.status_code == 200, response.data
+    return elapsed * 1000, response.data
+
+
+def run(pages=1000, **options):
+    user = User.objects.create(username='paginator')
+    now = timezone.now()
+    WeightStat.objects.bulk_create([
+        WeightStat(user=user, date=now - timedelta(hours=i), weight=Decimal('80.00') + Decimal(i % 500) / 100)
+        for i in range((pages + 1) * PAGE_SIZE)
+    ], batch_size=5000)
+    factory = APIRequestFactory()
+    sample = range(1, 11), range(pages - 9, pages + 1)
+
+    legacy = LegacyWeightStatListView.as_view()
+    offset_ms = {}
+    for label, numbers in zip(('first_10_pages', 'last_10_pages'), sample):
+        offset_ms[label] = statistics.median(
+            _timed(legacy, factory.get('/api/weight-stats/', {'page': n}), user)[0] for n in numbers
+        )
+
+    keyset = WeightStatListCreateView.as_view()
+    timings = []
+    url = '/api/weight-stats/'
+    for _ in range(pages):
+        elapsed, data = _timed(keyset, factory.get(url), user)
+        timings.append(elapsed)
+        url = data['next']
+    keyset_ms = {
+        'first_10_pages': statistics.median(timings[:10]),
+        'last_10_pages': statistics.median(timings[-10:]),
+    }
+
+    return {
+        'rows': (pages + 1) * PAGE_SIZE,
+        'page_size': PAGE_SIZE,
+        'deepest_page': pages,
+        'offset_median_ms': {key: round(value, 3) for key, value in offset_ms.items()},
+        'keyset_median_ms': {key: round(value, 3) for key, value in keyset_ms.items()},
+    }
@@ -0,0 +1,75 @@
+"""
+Rows per second of the hot list shapes: fetching model instances and running
+their ModelSerializers, against RowSerializer's values_list() path. Both sides
+fetch and serialize the same rows; the model path gets select_related() for
+its relations, so neither pays per-row queries.
+"""
+import timeit
+from datetime import timedelta
+from decimal import Decimal
+from types import SimpleNamespace
+from django.contrib.auth.models import User
+from django.utils import timezone
+from defatify.models import Profile, WeightStat, FriendRequest, Friendship, Battle, BattleInvitation
+from defatify.serializers import (RowSerializer, WeightStatSerializer, FriendshipSerializer,
+                                  FriendRequestSerializer, BattleInvitationSerializer)
+from defatify.utils import UnitConverter
+
+USES_DATABASE = True
+
+
+def _populate(rows):
+    user = User.objects.create(username='rowbench')
+    Profile.objects.update_or_create(user=user, defaults={'unit_preference': 'imperial'})
+    others = User.objects.bulk_create([User(username=f'rowbench{i}') for i in range(rows)])
+    now = timezone.now()
+    WeightStat.objects.bulk_create([
+        WeightStat(user=user, date=now - timedelta(hours=i), weight=Decimal('80.00') + Decimal(i % 100) / 10,
+                   bmi=Decimal('24.50'), body_fat=Decimal('20.00'))
+        for i in range(rows)
+    ])
+    Friendship.objects.bulk_create([Friendship(user=user, friend=other) for other in others])
+    FriendRequest.objects.bulk_create([FriendRequest(from_user=other, to_user=user) for other in others])
+    battle = Battle.objects.create(name='Row bench', creator=user, type='stat_goal', weight_param='weight',
+                                   goal_value=Decimal('70.00'))
+    BattleInvitation.objects.bulk_create([
+        BattleInvitation(battle=battle, invited_user=user, inviting_user=other) for other in others
+    ])
+    return user
+
+
+def _shapes(user):
+    """(label, serializer class, queryset, relations to select for the model path)."""
+    return [
+        ('weight_history', WeightStatSerializer, WeightStat.objects.filter(user=user), ()),
+        ('friends', FriendshipSerializer, Friendship.objects.filter(user=user), ('friend',)),
+        ('friend_requests', FriendRequestSerializer, FriendRequest.objects.filter(to_user=user), ()),
+        ('pending_invitations', BattleInvitationSerializer,
+         BattleInvitation.objects.filter(invited_user=user, status='pending'), ('inviting_user', 'battle')),
+    ]
+
+
+def run(rows=1000, repeat=5, **options):
+    user = _populate(rows)
+    request = SimpleNamespace(user=user)
+    results = {}
+    for label, serializer_class, queryset, related in _shapes(user):
+        rows_serializer = RowSerializer(serializer_class)
+        units = UnitConverter.for_request(request) if rows_serializer.unit_fields else None
+
+        def models():
+            return serializer_class(queryset.select_related(*related), many=True, context={'request': request}).data
+
+        def values():
+            return rows_serializer.serialize(rows_serializer.rows(queryset), units)
+
+        assert [dict(row) for row in models()] == values(), label
+        model_time = min(timeit.repeat(models, number=1, repeat=repeat))
+        values_time = min(timeit.repeat(values, number=1, repeat=repeat))
+        results[label] = {
+            'rows': rows,
+            'model_serializer_rows_per_second': round(rows / model_time),
+            'row_serializer_rows_per_second': round(rows / values_time),
+            'speedup': round(model_time / values_time, 2),
+        }
+    return results
@@ -0,0 +1,47 @@
+"""Runtime of finishing a large backlog of expired duration battles."""
+import random
+import time
+from datetime import timedelta
+from decimal import Decimal
+from django.contrib.auth.models import User
+from django.utils import timezone
+from defatify.battle_updates import sweep_expired_battles
+from defatify.models import Battle, BattleStatistic
+
+USES_DATABASE = True
+
+
+def _populate(battles, participants, users=1000):
+    rng = random.Random(7)
+    people = User.objects.bulk_create([User(username=f'sweep{i}') for i in range(users)], batch_size=1000)
+    created = Battle.objects.bulk_create([
+        Battle(name=f'Sweep {i}', creator=people[i % users], type='duration', weight_param='weight',
+               duration=rng.choice([7, 14, 30]), status='in_progress')
+        for i in range(battles)
+    ], batch_size=1000)
+    # created_at is auto_now_add, so age the battles afterwards
+    Battle.objects.update(created_at=timezone.now() - timedelta(days=31))
+
+    through, stats = [], []
+    for battle in created:
+        for user in rng.sample(people, participants):
+            start = Decimal(rng.randint(6000, 12000)) / 100
+            through.append(Battle.participants.through(battle_id=battle.id, user_id=user.id))
+            stats.append(BattleStatistic(battle_id=battle.id, user_id=user.id, stat_type='weight',
+                                         starting_value=start, current_value=start - Decimal(rng.randint(0, 800)) / 100))
+    Battle.participants.through.objects.bulk_create(through, batch_size=5000)
+    BattleStatistic.objects.bulk_create(stats, batch_size=5000)
+
+
+def run(battles=100000, participants=3, batch_size=1000, **options):
+    _populate(battles, participants)
+    started = time.perf_counter()
+    finished = sweep_expired_battles(batch_size=batch_size)
+    elapsed = time.perf_counter() - started
+    return {
+        'battles': battles,
+        'participants_per_battle': participants,
+        'finished': finished,
+        'seconds': round(elapsed, 2),
+        'battles_per_second': round(finished / elapsed) if elapsed else None,
+    }
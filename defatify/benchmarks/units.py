@@ -0,0 +1,83 @@
+"""Per-row cost of unit conversion while serializing a leaderboard page."""
+import timeit
+from decimal import Decimal, ROUND_HALF_UP
+from types import SimpleNamespace
+from django.contrib.auth.models import User
+from rest_framework import serializers
+from defatify.models import Profile, BattleStatistic
+from defatify.serializers import LeaderboardSerializer
+
+
+def _legacy_convert_kg_to_lb(value_in_kg):
+    pounds = value_in_kg * Decimal(2.20462)
+    return pounds.quantize(Decimal('0.0'), rounding=ROUND_HALF_UP)
+
+
+class LegacyLeaderboardSerializer(serializers.ModelSerializer):
+    """The serializer as it was before UnitConverter: one profile walk per field per row."""
+    user = serializers.ReadOnlyField(source='user.username')
+    rank = serializers.IntegerField(read_only=True)
+    progress = serializers.SerializerMethodField()
+    starting_value = serializers.SerializerMethodField()
+    current_value = serializers.SerializerMethodField()
+
+    class Meta:
+        model = BattleStatistic
+        fields = ['rank', 'user', 'stat_type', 'starting_value', 'current_value', 'progress']
+
+    def _convert(self, obj, value):
+        unit_preference = self.context['request'].user.profile.unit_preference
+        if obj.stat_type == 'weight' and unit_preference == 'imperial':
+            return _legacy_convert_kg_to_lb(value)
+        return value
+
+    def get_starting_value(self, obj):
+        return self._convert(obj, obj.starting_value)
+
+    def get_current_value(self, obj):
+        return self._convert(obj, obj.current_value)
+
+    def get_progress(self, obj):
+        return self._convert(obj, obj.progress)
+
+
+def _rows(count):
+    rows = []
+    for i in range(count):
+        stat = BattleStatistic(
+            user=User(username=f'user{i}'), stat_type='weight',
+            starting_value=Decimal('95.40'), current_value=Decimal('95.40') - Decimal(i % 200) / 10,
+        )
+        stat.progress = stat.current_value - stat.starting_value
+        stat.rank = i + 1
+        rows.append(stat)
+    return rows
+
+
+def _request(unit_preference):
+    # Real model instances, so the profile walk goes through Django's related descriptors
+    user = User(username='viewer')
+    user.profile = Profile(user=user, unit_preference=unit_preference)
+    return SimpleNamespace(user=user)
+
+
+def _best(serializer_class, rows, unit_preference, repeat):
+    def serialize():
+        # A fresh request per run, as UnitConverter is resolved once per request
+        return serializer_class(rows, many=True, context={'request': _request(unit_preference)}).data
+    return min(timeit.repeat(serialize, number=1, repeat=repeat))
+
+
+def run(rows=1000, repeat=5, **options):
+    data = _rows(rows)
+    results = {}
+    for unit_preference in ('metric', 'imperial'):
+        legacy = _best(LegacyLeaderboardSerializer, data, unit_preference, repeat)
+        current = _best(LeaderboardSerializer, data, unit_preference, repeat)
+        results[unit_preference] = {
+            'rows': rows,
+            'legacy_us_per_row': round(legacy / rows * 1e6, 2),
+            'current_us_per_row': round(current / rows * 1e6, 2),
+            'reduction_pct': round((1 - current / legacy) * 100, 1),
+        }
+    return results
@@ -0,0 +1,177 @@
+import hashlib
+import math
+import threading
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from rest_framework_simplejwt.token_blacklist.models import OutstandingToken, BlacklistedToken
+
+# Refresh token blacklist. Every refresh and logout checks the token's jti
+# against BlacklistedToken; almost always it is not there. A Bloom filter of
+# the blacklisted jtis, held in each process, answers that common case without
+# a query. A hit may be a false positive, so hits are confirmed in the
+# database. Every blacklisting bumps a generation counter in the shared cache
+# once it commits; each check reads that one key, so a process sees the
+# counter move as soon as the blacklisting is visible, whichever process made
+# it, and first adds the rows blacklisted since its last sync. Should the
+# cache lose a bump (an eviction, an outage), a process still re-syncs from
+# the database every `sync_interval` seconds: that bounds how long a revoked
+# token can go unnoticed. The filter is rebuilt from scratch every
+# `rebuild_interval` seconds, which drops expired tokens, and the rows
+# themselves are deleted by prune_expired_tokens().
+
+BLACKLIST_REBUILD_INTERVAL = getattr(settings, 'TOKEN_BLACKLIST_REBUILD_INTERVAL', 600)
+BLACKLIST_SYNC_INTERVAL = getattr(settings, 'TOKEN_BLACKLIST_SYNC_INTERVAL', 30)
+# Filter false positives (each costing one query) per negative lookup
+BLACKLIST_FALSE_POSITIVE_RATE = 0.01
+
+# Rows are picked up by their blacklisted_at, set on insert: going back this far
+# covers rows whose transaction committed after a sync that began later
+BLACKLIST_SYNC_OVERLAP = timedelta(minutes=1)
+
+BLACKLIST_GENERATION_KEY = 'token_blacklist:generation'
+
+
+def blacklist_generation():
+    """The shared count of blacklistings, or None when the cache has lost it."""
+    return cache.get(BLACKLIST_GENERATION_KEY)
+
+
+def _bump_generation():
+    try:
+        cache.incr(BLACKLIST_GENERATION_KEY)
+    except ValueError:
+        # Lost: restart from a value no process can have synced at
+        cache.add(BLACKLIST_GENERATION_KEY, time.time_ns(), timeout=None)
+
+
+def bump_blacklist_generation():
+    """Count a blacklisting once its transaction commits, so no process syncs before the row is visible."""
+    transaction.on_commit(_bump_generation)
+
+
+class BloomFilter:
+    """A fixed-size Bloom filter of strings: no false negatives, `error_rate` false positives at `capacity`."""
+
+    def __init__(self, capacity, error_rate=BLACKLIST_FALSE_POSITIVE_RATE):
+        capacity = max(capacity, 1)
+        self.size = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hashes = max(round(self.size / capacity * math.log(2)), 1)
+        self.capacity = capacity
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, value):
+        # Double hashing: k positions from the two halves of one digest
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'big'), int.from_bytes(digest[8:], 'big') | 1
+        return ((first + i * second) % self.size for i in range(self.hashes))
+
+    def add(self, value):
+        for position in self._positions(value):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value):
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+
+class BlacklistFilter:
+    """
+    The blacklisted jtis of unexpired refresh tokens, as a Bloom filter sized
+    for twice the rows at its last build. Grown past that, it rebuilds early.
+    """
+
+    def __init__(self, rebuild_interval=BLACKLIST_REBUILD_INTERVAL, sync_interval=BLACKLIST_SYNC_INTERVAL):
+        self.rebuild_interval = rebuild_interval
+        self.sync_interval = sync_interval
+        self._filter = None
+        self._generation = None
+        self._synced_at = None
+        self._built_at = self._checked_at = 0
+        self._lock = threading.Lock()
+        self.lookups = {'filtered': 0, 'confirmed': 0, 'false_positives': 0}
+
+    def _build(self):
+        # Read the generation first: a bump during the build triggers a catch-up
+        self._generation = blacklist_generation()
+        self._synced_at = timezone.now()
+        jtis = list(BlacklistedToken.objects.filter(token__expires_at__gt=self._synced_at).values_list('token__jti', flat=True))
+        self._filter = BloomFilter(capacity=len(jtis) * 2 or 1024)
+        for jti in jtis:
+            self._filter.add(jti)
+        self._built_at = self._checked_at = time.monotonic()
+
+    def _catch_up(self, generation):
+        self._generation = generation
+        self._checked_at = time.monotonic()
+        since, self._synced_at = self._synced_at - BLACKLIST_SYNC_OVERLAP, timezone.now()
+        for jti in BlacklistedToken.objects.filter(blacklisted_at__gte=since).values_list('token__jti', flat=True):
+            self._filter.add(jti)
+
+    def _ensure_current(self):
+        if (self._filter is None or self._filter.count > self._filter.capacity
+                or time.monotonic() - self._built_at >= self.rebuild_interval):
+            self._build()
+            return
+        generation = blacklist_generation()
+        if generation != self._generation or time.monotonic() - self._checked_at >= self.sync_interval:
+            self._catch_up(generation)
+
+    def might_contain(self, jti):
+        """False when `jti` is certainly not blacklisted; True when it may be."""
+        with self._lock:
+            self._ensure_current()
+            return jti in self._filter
+
+    def add(self, jti):
+        with self._lock:
+            if self._filter is not None:
+                self._filter.add(jti)
+
+    def clear(self):
+        with self._lock:
+            self._filter = None
+            for name in self.lookups:
+                self.lookups[name] = 0
+
+
+blacklist_filter = BlacklistFilter()
+
+
+def is_blacklisted(jti):
+    """Whether the refresh token `jti` is blacklisted; a query only when the filter cannot rule it out."""
+    if not blacklist_filter.might_contain(jti):
+        blacklist_filter.lookups['filtered'] += 1
+        return False
+    blacklisted = BlacklistedToken.objects.filter(token__jti=jti).exists()
+    blacklist_filter.lookups['confirmed' if blacklisted else 'false_positives'] += 1
+    return blacklisted
+
+
+def announce_blacklisted(jti):
+    """Add a just blacklisted jti to this process's filter; the others sync through the generation."""
+    blacklist_filter.add(jti)
+
+
+def prune_expired_tokens(now=None, batch_size=1000):
+    """
+    Delete outstanding tokens that expired, with their blacklist entries,
+    `batch_size` at a time so no delete holds locks for long. An expired
+    token fails verification before the blacklist matters. Returns the
+    number of outstanding tokens deleted.
+    """
+    now = now or timezone.now()
+    total = 0
+    while True:
+        token_ids = list(OutstandingToken.objects.filter(expires_at__lte=now).order_by('id').values_list('id', flat=True)[:batch_size])
+        if not token_ids:
+            return total
+        with transaction.atomic():
+            BlacklistedToken.objects.filter(token_id__in=token_ids).delete()
+            OutstandingToken.objects.filter(id__in=token_ids).delete()
+        total += len(token_ids)
@@ -0,0 +1,143 @@
+import hashlib
+import threading
+import uuid
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from rest_framework.response import Response
+from .utils import UnitConverter
+
+# Seconds a cached battle response may live; version bumps retire entries much sooner
+BATTLE_CACHE_TIMEOUT = getattr(settings, 'BATTLE_CACHE_TIMEOUT', 300)
+
+_stats_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+
+def cache_stats():
+    """Hit/miss/invalidation counters of the battle response cache in this process."""
+    with _stats_lock:
+        stats = dict(_stats)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+    return stats
+
+
+def _count(name, amount=1):
+    with _stats_lock:
+        _stats[name] += amount
+
+
+def _version_key(battle_id):
+    return f'battle:{battle_id}:version'
+
+
+def battle_version(battle_id):
+    version = cache.get(_version_key(battle_id))
+    if version is None:
+        version = uuid.uuid4().hex
+        # add() so two processes racing on a cold key agree on one version
+        if not cache.add(_version_key(battle_id), version, timeout=None):
+            version = cache.get(_version_key(battle_id), version)
+    return version
+
+
+async def abattle_version(battle_id):
+    version = await cache.aget(_version_key(battle_id))
+    if version is None:
+        version = uuid.uuid4().hex
+        if not await cache.aadd(_version_key(battle_id), version, timeout=None):
+            version = await cache.aget(_version_key(battle_id), version)
+    return version
+
+
+def bump_battle_versions(battle_ids):
+    """Retire every cached response of the given battles."""
+    battle_ids = set(battle_ids)
+    if not battle_ids:
+        return
+    # A fresh random token rather than an increment, so concurrent bumps can never collide
+    cache.set_many({_version_key(battle_id): uuid.uuid4().hex for battle_id in battle_ids}, timeout=None)
+    _count('invalidations', len(battle_ids))
+
+
+def invalidate_battles(battle_ids):
+    """
+    Bump battle versions now and again once the surrounding transaction commits,
+    so a reader cannot re-cache pre-commit data in between.
+    """
+    battle_ids = set(battle_ids)
+    if not battle_ids:
+        return
+    bump_battle_versions(battle_ids)
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(lambda: bump_battle_versions(battle_ids))
+
+
+def _battle_cache_key(scope, battle_id, version, request, per_user):
+    unit_preference = UnitConverter.for_request(request).unit_preference
+    url = hashlib.md5(request.build_absolute_uri().encode()).hexdigest()
+    user_part = f':{request.user.id}' if per_user else ''
+    return f'battle:{battle_id}:{version}:{scope}:{unit_preference}{user_part}:{url}'
+
+
+def battle_cache_key(scope, battle_id, request, per_user=False):
+    return _battle_cache_key(scope, battle_id, battle_version(battle_id), request, per_user)
+
+
+async def abattle_cache_key(scope, battle_id, request, per_user=False):
+    return _battle_cache_key(scope, battle_id, await abattle_version(battle_id), request, per_user)
+
+
+class BattleCacheMixin:
+    """
+    Serve GET responses of a battle view from the cache.
+
+    Keys embed the battle's current version and the user's unit preference;
+    writes to the battle bump the version (see signals.py), so stale entries are
+    simply never looked up again and expire on their own.
+    """
+    cache_scope = None
+    battle_url_kwarg = 'pk'
+
+    def cache_per_user(self, request):
+        return False
+
+    def get(self, request, *args, **kwargs):
+        key = battle_cache_key(self.cache_scope, kwargs[self.battle_url_kwarg], request,
+                               per_user=self.cache_per_user(request))
+        data = cache.get(key)
+        if data is not None:
+            _count('hits')
+            return Response(data, headers={'X-Cache': 'HIT'})
+
+        _count('misses')
+        response = super().get(request, *args, **kwargs)
+        if response.status_code == 200:
+            cache.set(key, response.data, BATTLE_CACHE_TIMEOUT)
+        response['X-Cache'] = 'MISS'
+        return response
+
+
+class AsyncBattleCacheMixin:
+    """BattleCacheMixin for the async views, going through the cache's async API."""
+    cache_scope = None
+    battle_url_kwarg = 'pk'
+
+    def cache_per_user(self, request):
+        return False
+
+    async def get(self, request, *args, **kwargs):
+        key = await abattle_cache_key(self.cache_scope, kwargs[self.battle_url_kwarg], request,
+                                      per_user=self.cache_per_user(request))
+        data = await cache.aget(key)
+        if data is not None:
+            _count('hits')
+            return self.render(data, headers={'X-Cache': 'HIT'})
+
+        _count('misses')
+        response = await super().get(request, *args, **kwargs)
+        if response.status_code == 200:
+            await cache.aset(key, response.data, BATTLE_CACHE_TIMEOUT)
+        response['X-Cache'] = 'MISS'
+        return response
@@ -0,0 +1,22 @@
+from django.conf import settings
+from django.core.checks import Error, Tags, register
+
+# Cache backends whose entries live inside one process
+PROCESS_LOCAL_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+@register(Tags.caches, deploy=True)
+def check_shared_cache(app_configs, **kwargs):
+    """Invalidation goes through the cache, so a deployment needs one shared by every worker."""
+    backend = settings.CACHES.get('default', {}).get('BACKEND')
+    if backend in PROCESS_LOCAL_CACHES:
+        return [Error(
+            f'The default cache ({backend}) is local to each process.',
+            hint='Battle, rollup, token claim and live leaderboard invalidations would only reach the process that made them. '
+                 'Set REDIS_URL, or configure another cache shared by every worker such as PyMemcacheCache.',
+            id='defatify.E001',
+        )]
+    return []
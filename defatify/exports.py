@@ -0,0 +1,114 @@
+import csv
+import io
+import json
+from itertools import islice
+from rest_framework.renderers import BaseRenderer
+from .serializers import RowSerializer, WeightStatSerializer
+
+# Weight history exports. Rows are read with a chunked iterator (a server-side
+# cursor on PostgreSQL) and serialized a chunk at a time through
+# RowSerializer, so a response holds one chunk in memory however long the
+# history is, and every value reads exactly as in the JSON API. Under ASGI
+# the rows come from the async ORM instead (aexport_chunks), since that
+# handler only streams async iterators.
+
+EXPORT_CHUNK_SIZE = 2000
+
+
+def _export_rows(queryset):
+    serializer = RowSerializer.for_class(WeightStatSerializer)
+    return serializer, serializer.rows(queryset.order_by('date', 'id'))
+
+
+def export_chunks(queryset, units=None, chunk_size=None):
+    """Serialized rows of `queryset` (of WeightStat), oldest first, in lists of up to `chunk_size`."""
+    chunk_size = chunk_size or EXPORT_CHUNK_SIZE
+    serializer, rows = _export_rows(queryset)
+    rows = rows.iterator(chunk_size=chunk_size)
+    while chunk := list(islice(rows, chunk_size)):
+        yield serializer.serialize(chunk, units)
+
+
+async def aexport_chunks(queryset, units=None, chunk_size=None):
+    """export_chunks() on the async ORM, for responses sent by the ASGI handler."""
+    chunk_size = chunk_size or EXPORT_CHUNK_SIZE
+    serializer, rows = _export_rows(queryset)
+    chunk = []
+    async for row in rows.aiterator(chunk_size=chunk_size):
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            yield serializer.serialize(chunk, units)
+            chunk = []
+    if chunk:
+        yield serializer.serialize(chunk, units)
+
+
+def csv_format():
+    """A header line, and the function writing a chunk as CSV lines."""
+    names = RowSerializer.for_class(WeightStatSerializer).plan[0]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def write(rows):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(rows)
+        return buffer.getvalue()
+
+    return write([names]), lambda chunk: write([item[name] for name in names] for item in chunk)
+
+
+def ndjson_format():
+    """No header, and the function writing a chunk as one JSON object per line; decimals stay strings."""
+    encode = json.JSONEncoder(separators=(',', ':'), default=str).encode
+    return '', lambda chunk: ''.join(encode(item) + '\n' for item in chunk)
+
+
+EXPORT_FORMATS = {
+    'csv': csv_format,
+    'ndjson': ndjson_format,
+}
+
+
+def export_stream(export_format, chunks):
+    """The body of an export: its header, then one string per chunk."""
+    header, write = EXPORT_FORMATS[export_format]()
+    if header:
+        yield header
+    for chunk in chunks:
+        yield write(chunk)
+
+
+async def aexport_stream(export_format, chunks):
+    """
+    export_stream() over async `chunks`. Under ASGI a streaming response
+    needs an async iterator: Django would read a sync one to the end into a
+    list before sending the first byte.
+    """
+    header, write = EXPORT_FORMATS[export_format]()
+    if header:
+        yield header
+    async for chunk in chunks:
+        yield write(chunk)
+
+
+class CSVRenderer(BaseRenderer):
+    """Selects CSV exports; renders only error bodies, as a header and a value line."""
+    media_type = 'text/csv'
+    format = 'csv'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows([list(data), list(data.values())] if data else [])
+        return buffer.getvalue()
+
+
+class NDJSONRenderer(BaseRenderer):
+    """Selects NDJSON exports; renders only error bodies, as one JSON line."""
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return json.dumps(data, default=str) + '\n' if data is not None else ''
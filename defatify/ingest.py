@@ -0,0 +1,240 @@
+import codecs
+import csv
+import time
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload
+from django.db import transaction
+from rest_framework.exceptions import ValidationError
+from .models import WeightStat
+from .jobs import battle_update_queue
+from .rollups import invalidate_rollups, touches_closed_buckets
+from .serializers import WeightStatImportSerializer
+
+# Rows per INSERT transaction when readings arrive in bulk
+BULK_CHUNK_SIZE = 200
+# Rows per batch of a CSV import: deduplicated with one query, written with one bulk_create()
+IMPORT_BATCH_SIZE = 1000
+# Invalid rows an import report lists; the rest are only counted
+IMPORT_MAX_ERRORS = 100
+
+
+def _latest_date(user):
+    return WeightStat.objects.filter(user=user).order_by('-date').values_list('date', flat=True).first()
+
+
+def _readings_added(user, touched_closed_buckets, extended_history):
+    """Rollups and battles of `user` after readings were inserted without signals."""
+    if touched_closed_buckets:
+        invalidate_rollups([user.id])
+    # Backfilled readings older than the stored history never touch battles
+    if extended_history:
+        battle_update_queue.enqueue(user.id)
+
+
+def ingest_readings(user, readings, chunk_size=BULK_CHUNK_SIZE):
+    """
+    Insert unsaved WeightStat readings for `user` with bulk_create.
+
+    Each chunk is written in its own transaction and no post_save signals are
+    sent; one battle update is queued for the whole batch afterwards. Backfilled
+    readings older than the user's latest stored reading never touch battles.
+    """
+    previous_latest = _latest_date(user)
+
+    created = []
+    for start in range(0, len(readings), chunk_size):
+        with transaction.atomic():
+            created.extend(WeightStat.objects.bulk_create(readings[start:start + chunk_size]))
+
+    _readings_added(
+        user,
+        any(touches_closed_buckets(reading.date) for reading in created),
+        any(previous_latest is None or reading.date > previous_latest for reading in created),
+    )
+    return created
+
+
+def csv_lines(source, encoding='utf-8-sig'):
+    """Decoded lines of a binary file, upload or request body, read incrementally."""
+    return codecs.iterdecode(source, encoding)
+
+
+class CSVImportError(ValueError):
+    """The file cannot be imported at all, e.g. it has no `date` column."""
+
+
+class ReadingImport:
+    """
+    An import of readings for `user` from CSV records, fed one at a time: a
+    header row with a `date` column and any of the stat columns, in
+    kilograms, then the readings. Rows are validated against the WeightStat
+    columns and skipped when their timestamp is already stored or repeats an
+    earlier row. Readings are written a batch at a time; battles are updated
+    once, by finish().
+    """
+
+    def __init__(self, user, batch_size=None):
+        self.started = time.perf_counter()
+        self.user = user
+        self.batch_size = batch_size or IMPORT_BATCH_SIZE
+        self.fields = WeightStatImportSerializer().fields
+        self.header = None
+        self.columns = []
+        self.report = {'rows': 0, 'created': 0, 'duplicates': 0, 'invalid': 0, 'errors': []}
+        self.previous_latest = _latest_date(user)
+        # Timestamps of the file so far: one datetime per row is all an import keeps
+        self.seen, self.batch = set(), []
+        self.touched_closed_buckets = self.extended_history = False
+
+    def _check_header(self, header):
+        if 'date' not in header:
+            raise CSVImportError(f'The CSV header must have a date column and may have {", ".join(list(self.fields)[1:])}.')
+
+    def add(self, record, line):
+        """Import one parsed CSV record, `line` being its (last) line number in the file."""
+        if not record:
+            return
+        if self.header is None:
+            self.header = [name.strip().lower() for name in record]
+            self._check_header(self.header)
+            self.columns = [name for name in self.fields if name in self.header]
+            return
+        self.report['rows'] += 1
+        row = dict(zip(self.header, record))
+        values, errors = {}, {}
+        # Fields are validated one by one: a serializer per row would cost more than the insert
+        for name in self.columns:
+            value = (row.get(name) or '').strip()
+            try:
+                values[name] = self.fields[name].run_validation(value or None)
+            except ValidationError as exc:
+                errors[name] = exc.detail
+        if errors:
+            self.report['invalid'] += 1
+            if len(self.report['errors']) < IMPORT_MAX_ERRORS:
+                self.report['errors'].append({'line': line, 'errors': errors})
+            return
+        if values['date'] in self.seen:
+            self.report['duplicates'] += 1
+            return
+        self.seen.add(values['date'])
+        self.batch.append(WeightStat(user=self.user, **values))
+        if len(self.batch) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        stored = set(WeightStat.objects.filter(user=self.user, date__in=[reading.date for reading in self.batch])
+                     .values_list('date', flat=True))
+        fresh = [reading for reading in self.batch if reading.date not in stored]
+        with transaction.atomic():
+            WeightStat.objects.bulk_create(fresh)
+        self.report['created'] += len(fresh)
+        self.report['duplicates'] += len(self.batch) - len(fresh)
+        self.touched_closed_buckets |= any(touches_closed_buckets(reading.date) for reading in fresh)
+        self.extended_history |= any(self.previous_latest is None or reading.date > self.previous_latest
+                                     for reading in fresh)
+        self.batch.clear()
+
+    def finish(self):
+        """
+        Write the last batch, update battles and return the report: rows read,
+        created, duplicates, invalid with the first IMPORT_MAX_ERRORS errors by
+        line, seconds and rows per second.
+        """
+        if self.header is None:
+            self._check_header(())
+        if self.batch:
+            self._flush()
+        _readings_added(self.user, self.touched_closed_buckets, self.extended_history)
+        elapsed = time.perf_counter() - self.started
+        self.report['seconds'] = round(elapsed, 3)
+        self.report['rows_per_second'] = round(self.report['rows'] / elapsed) if elapsed else self.report['rows']
+        return self.report
+
+
+def import_readings(user, lines, batch_size=None):
+    """Import readings for `user` from CSV `lines`, consumed a batch at a time; see ReadingImport."""
+    importer = ReadingImport(user, batch_size)
+    reader = csv.reader(lines)
+    for record in reader:
+        importer.add(record, reader.line_num)
+    return importer.finish()
+
+
+class CSVRecords:
+    """
+    Splits decoded text, fed a chunk at a time, into whole CSV records with
+    their terminators. A newline only ends a record outside quotes, which an
+    even count of quote characters so far tells apart ("" escapes count two).
+    """
+
+    def __init__(self):
+        self.pending = []
+        self.quoted = False
+
+    def feed(self, text):
+        records = []
+        *lines, rest = text.split('\n')
+        for line in lines:
+            self.pending.append(line + '\n')
+            self.quoted ^= line.count('"') % 2 == 1
+            if not self.quoted:
+                records.append(''.join(self.pending))
+                self.pending.clear()
+        if rest:
+            self.pending.append(rest)
+            self.quoted ^= rest.count('"') % 2 == 1
+        return records
+
+    def close(self):
+        """The last record, when the text does not end with a newline."""
+        record = ''.join(self.pending)
+        self.pending.clear()
+        return [record] if record else []
+
+
+class CSVImportUploadHandler(FileUploadHandler):
+    """
+    Imports the `file` part of a multipart upload while it is received: every
+    chunk is decoded and its whole records imported, so nothing is spooled to
+    memory or disk. After the upload, `report` holds the import report, or
+    `error` why the file could not be imported.
+    """
+
+    def __init__(self, user, encoding='utf-8-sig'):
+        super().__init__()
+        self.user = user
+        self.encoding = encoding
+        self.importer = None
+        self.report = self.error = None
+
+    def new_file(self, field_name, *args, **kwargs):
+        super().new_file(field_name, *args, **kwargs)
+        if field_name == 'file' and self.importer is None and self.report is None and self.error is None:
+            self.importer = ReadingImport(self.user)
+            self.decoder = codecs.getincrementaldecoder(self.encoding)()
+            self.records = CSVRecords()
+            self.line = 0
+
+    def _import(self, records):
+        for text in records:
+            self.line += text.count('\n') + (not text.endswith('\n'))
+            for record in csv.reader([text]):
+                self.importer.add(record, self.line)
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.importer is not None:
+            try:
+                self._import(self.records.feed(self.decoder.decode(raw_data)))
+            except (CSVImportError, csv.Error, UnicodeDecodeError) as exc:
+                self.importer, self.error = None, exc
+                raise StopUpload()
+        # Nothing is passed on: the upload is not stored anywhere
+
+    def file_complete(self, file_size):
+        if self.importer is not None and self.report is None:
+            try:
+                self._import(self.records.feed(self.decoder.decode(b'', final=True)) + self.records.close())
+                self.report = self.importer.finish()
+            except (CSVImportError, csv.Error, UnicodeDecodeError) as exc:
+                self.error = exc
+            self.importer = None
@@ -0,0 +1,115 @@
+import heapq
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from .battle_updates import sync_user_battles
+
+# Battle updates triggered by new readings run off the request path. Saving a
+# WeightStat queues a job for its user once the transaction commits; a
+# dispatcher thread hands due jobs to a small worker pool. Jobs are
+# coalesced per user: readings arriving while a job is queued fold into it,
+# so a burst of readings is applied in one pass. A job re-reads the user's
+# latest reading, so running it twice does no harm, and failures are retried
+# with backoff. Queued jobs live in this process only; one lost in a restart
+# is redone by the user's next reading, and duration battles are finished by
+# the finish_expired_battles sweep either way.
+#
+# With BATTLE_UPDATES_EAGER on (defatify_project/test_settings.py) jobs run inline instead.
+
+BATTLE_UPDATE_WORKERS = getattr(settings, 'BATTLE_UPDATE_WORKERS', 4)
+# Seconds a job waits for more readings of the same user before it runs
+BATTLE_UPDATE_DELAY = getattr(settings, 'BATTLE_UPDATE_DELAY', 0.5)
+BATTLE_UPDATE_ATTEMPTS = 5
+
+log = logging.getLogger('defatify.jobs')
+
+
+class BattleUpdateQueue:
+    def __init__(self, workers=BATTLE_UPDATE_WORKERS, delay=BATTLE_UPDATE_DELAY, attempts=BATTLE_UPDATE_ATTEMPTS):
+        self.workers = workers
+        self.delay = delay
+        self.attempts = attempts
+        self._pending = {}  # user id -> (created, attempt)
+        self._due = []  # heap of (run at, user id)
+        self._running = set()
+        self._condition = threading.Condition()
+        self._dispatcher = None
+        self._executor = None
+        self.stats = {'queued': 0, 'coalesced': 0, 'completed': 0, 'retried': 0, 'failed': 0}
+
+    def enqueue(self, user_id, created=True):
+        """Apply the user's latest reading to their battles once the current transaction commits."""
+        if getattr(settings, 'BATTLE_UPDATES_EAGER', False):
+            sync_user_battles(user_id, created=created)
+            return
+        transaction.on_commit(lambda: self._schedule(user_id, created))
+
+    def _schedule(self, user_id, created, attempt=1, delay=None):
+        with self._condition:
+            if user_id in self._pending:
+                queued_created, queued_attempt = self._pending[user_id]
+                self._pending[user_id] = (queued_created or created, min(queued_attempt, attempt))
+                self.stats['coalesced'] += 1
+                return
+            self._pending[user_id] = (created, attempt)
+            heapq.heappush(self._due, (time.monotonic() + (self.delay if delay is None else delay), user_id))
+            self.stats['queued'] += 1
+            if self._dispatcher is None:
+                self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='battle-updates')
+                self._dispatcher = threading.Thread(target=self._dispatch, name='battle-updates-dispatcher', daemon=True)
+                self._dispatcher.start()
+            self._condition.notify()
+
+    def _dispatch(self):
+        while True:
+            with self._condition:
+                while not self._due or self._due[0][0] > time.monotonic():
+                    self._condition.wait(self._due[0][0] - time.monotonic() if self._due else None)
+                run_at, user_id = heapq.heappop(self._due)
+                if user_id in self._running:
+                    # One job per user at a time; this one runs after the current one
+                    heapq.heappush(self._due, (run_at + self.delay, user_id))
+                    continue
+                created, attempt = self._pending.pop(user_id)
+                self._running.add(user_id)
+            self._executor.submit(self._run, user_id, created, attempt)
+
+    def _run(self, user_id, created, attempt):
+        try:
+            sync_user_battles(user_id, created=created)
+        except Exception:
+            if attempt >= self.attempts:
+                self.stats['failed'] += 1
+                log.exception('Battle update for user %s failed after %d attempts', user_id, attempt)
+            else:
+                self.stats['retried'] += 1
+                log.warning('Battle update for user %s failed (attempt %d), retrying', user_id, attempt, exc_info=True)
+                self._finished(user_id)
+                self._schedule(user_id, created, attempt + 1, delay=self.delay * 2 ** attempt)
+                return
+        else:
+            self.stats['completed'] += 1
+        finally:
+            close_old_connections()
+        self._finished(user_id)
+
+    def _finished(self, user_id):
+        with self._condition:
+            self._running.discard(user_id)
+            self._condition.notify()
+
+    def join(self, timeout=10):
+        """Wait until every queued job has run. Returns whether the queue drained in time."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self._condition:
+                if not self._pending and not self._running:
+                    return True
+            time.sleep(0.01)
+        return False
+
+
+battle_update_queue = BattleUpdateQueue()
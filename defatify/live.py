@@ -0,0 +1,243 @@
+import asyncio
+import json
+import threading
+import time
+import uuid
+from collections import deque, namedtuple
+from django.core.cache import cache
+from django.db import transaction
+from rest_framework.utils.encoders import JSONEncoder
+from .models import BattleStatistic
+from .utils import UnitConverter
+
+# Live leaderboards pushed over Server-Sent Events (see the stream view in
+# async_views.py). Weight readings change BattleStatistic rows; once that
+# commits, every battle with live subscribers in this process is re-ranked in
+# one query and only the rows whose rank or values moved are pushed. Streams
+# may be connected to any worker process, so the commit also stores a new
+# version of each changed battle in the shared cache; a process whose
+# subscribers watch a battle checks that version every LIVE_POLL_SECONDS and
+# re-ranks and pushes when another process moved it.
+
+# Rows of a battle tracked and pushed live; the rest of the board is paged as usual
+LIVE_LEADERBOARD_SIZE = 100
+# Events waiting per connection; a client that falls further behind gets a fresh snapshot
+LIVE_QUEUE_SIZE = 64
+# Recent events per battle kept to resume reconnecting clients (Last-Event-ID)
+LIVE_REPLAY_SIZE = 256
+HEARTBEAT_SECONDS = 15
+# How often a process checks for leaderboard changes made by other processes
+LIVE_POLL_SECONDS = 1
+# Lifetime of the shared versions; a watched battle whose version expired is re-ranked once
+LIVE_VERSION_TIMEOUT = 24 * 60 * 60
+
+LIVE_VALUE_FIELDS = ('starting_value', 'current_value', 'progress')
+
+Event = namedtuple('Event', ['seq', 'kind', 'rows', 'removed'])
+
+# Queued in place of the events a subscriber could not keep up with
+RESYNC = object()
+
+
+def _version_key(battle_id):
+    return f'battle:{battle_id}:leaderboard_version'
+
+
+async def aleaderboard_version(battle_id):
+    """The shared version of a battle's leaderboard, new on every committed change."""
+    return await cache.aget(_version_key(battle_id))
+
+
+def leaderboard_rows(battle_id):
+    """The top of a battle's leaderboard, as values() rows for as_state()."""
+    return (
+        BattleStatistic.objects.filter(battle_id=battle_id).ranked()
+        .values('user_id', 'user__username', 'rank', 'stat_type', *LIVE_VALUE_FIELDS)[:LIVE_LEADERBOARD_SIZE]
+    )
+
+
+def as_state(values):
+    return {
+        row['user_id']: {
+            'user': row['user__username'], 'rank': row['rank'], 'stat_type': row['stat_type'],
+            **{field: row[field] for field in LIVE_VALUE_FIELDS},
+        }
+        for row in values
+    }
+
+
+class Subscriber:
+    """One SSE connection: a bounded queue filled from any thread, drained on its event loop."""
+
+    def __init__(self, loop=None):
+        self.loop = loop or asyncio.get_running_loop()
+        self.queue = asyncio.Queue(LIVE_QUEUE_SIZE)
+
+    def offer(self, event):
+        # Runs on self.loop
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # Drop the backlog: the stream sends one snapshot instead
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(RESYNC)
+
+
+class Channel:
+    def __init__(self):
+        self.state = None  # {user_id: row} as last pushed
+        self.version = None  # Shared version the state reflects
+        self.checked_at = 0
+        self.seq = 0
+        self.replay = deque(maxlen=LIVE_REPLAY_SIZE)
+        self.subscribers = set()
+
+
+class LeaderboardHub:
+    """
+    In-process pub/sub of leaderboard changes, one channel per watched battle.
+
+    Event ids are `<epoch>-<seq>`: the epoch is random per process, so a client
+    resuming against another process (or after a restart) gets a snapshot
+    rather than a wrong replay.
+    """
+
+    def __init__(self):
+        self.epoch = uuid.uuid4().hex[:8]
+        self._channels = {}
+        self._lock = threading.Lock()
+
+    def event_id(self, seq):
+        return f'{self.epoch}-{seq}'
+
+    def subscribe(self, battle_id, subscriber):
+        with self._lock:
+            self._channels.setdefault(battle_id, Channel()).subscribers.add(subscriber)
+
+    def unsubscribe(self, battle_id, subscriber):
+        with self._lock:
+            channel = self._channels.get(battle_id)
+            if channel is None:
+                return
+            channel.subscribers.discard(subscriber)
+            if not channel.subscribers:
+                del self._channels[battle_id]
+
+    def watched(self, battle_ids):
+        with self._lock:
+            return [battle_id for battle_id in set(battle_ids) if battle_id in self._channels]
+
+    def snapshot(self, battle_id, state=None, version=None):
+        """
+        (rows ordered by rank, seq) of a watched battle. `state` is a freshly
+        queried baseline, and `version` the shared version read before it,
+        used only if no change has been published yet.
+        """
+        with self._lock:
+            channel = self._channels[battle_id]
+            if channel.state is None:
+                channel.state, channel.version = state, version
+            rows = sorted(channel.state.values(), key=lambda row: (row['rank'], row['user']))
+            return rows, channel.seq
+
+    def has_state(self, battle_id):
+        with self._lock:
+            channel = self._channels.get(battle_id)
+            return channel is not None and channel.state is not None
+
+    def replay_since(self, battle_id, last_event_id):
+        """Events after `last_event_id`, or None if they are no longer all known."""
+        epoch, _, seq = (last_event_id or '').partition('-')
+        if epoch != self.epoch or not seq.isdigit():
+            return None
+        seq = int(seq)
+        with self._lock:
+            channel = self._channels[battle_id]
+            if channel.state is None or seq > channel.seq:
+                return None
+            events = [event for event in channel.replay if event.seq > seq]
+            if (events[0].seq if events else channel.seq + 1) != seq + 1:
+                return None
+            return events
+
+    def publish(self, battle_id, state, version=None):
+        """Diff a battle's freshly ranked rows against the last pushed ones and fan out the delta."""
+        with self._lock:
+            channel = self._channels.get(battle_id)
+            if channel is None:
+                return None
+            previous = channel.state
+            channel.state, channel.version = state, version
+            if previous is None:
+                return None
+            changed = [row for user_id, row in state.items() if previous.get(user_id) != row]
+            removed = [row['user'] for user_id, row in previous.items() if user_id not in state]
+            if not changed and not removed:
+                return None
+            channel.seq += 1
+            event = Event(channel.seq, 'delta', sorted(changed, key=lambda row: (row['rank'], row['user'])), removed)
+            channel.replay.append(event)
+            subscribers = list(channel.subscribers)
+
+        for subscriber in subscribers:
+            try:
+                subscriber.loop.call_soon_threadsafe(subscriber.offer, event)
+            except RuntimeError:
+                # Its event loop is gone; the connection is already dead
+                self.unsubscribe(battle_id, subscriber)
+        return event
+
+    def publish_changes(self, battle_ids, version=None):
+        for battle_id in self.watched(battle_ids):
+            self.publish(battle_id, as_state(leaderboard_rows(battle_id)), version)
+
+    def due(self, battle_id):
+        """The shared version a watched battle was last seen at, if its check is due; else False."""
+        with self._lock:
+            channel = self._channels.get(battle_id)
+            if channel is None or channel.state is None or time.monotonic() - channel.checked_at < LIVE_POLL_SECONDS:
+                return False
+            channel.checked_at = time.monotonic()
+            return channel.version
+
+    async def afollow(self, battle_id):
+        """
+        Publish the changes other processes made to a watched battle. Each
+        of its streams calls this while idle; one check per LIVE_POLL_SECONDS
+        reads the cache, and only a moved version costs a query.
+        """
+        known = self.due(battle_id)
+        if known is False:
+            return
+        version = await aleaderboard_version(battle_id)
+        if version != known:
+            state = as_state([row async for row in leaderboard_rows(battle_id)])
+            self.publish(battle_id, state, version)
+
+
+hub = LeaderboardHub()
+
+
+def leaderboards_changed(battle_ids):
+    """
+    Once the change commits, give these battles a new shared version, for
+    the other processes, and push their deltas to this process's subscribers.
+    """
+    battle_ids = set(battle_ids)
+
+    def announce():
+        version = uuid.uuid4().hex
+        cache.set_many({_version_key(battle_id): version for battle_id in battle_ids}, LIVE_VERSION_TIMEOUT)
+        watched = hub.watched(battle_ids)
+        if watched:
+            hub.publish_changes(watched, version)
+
+    if battle_ids:
+        transaction.on_commit(announce)
+
+
+def format_event(event_id, kind, rows, removed=(), unit_preference='metric'):
+    rows = UnitConverter(unit_preference).convert_rows([dict(row) for row in rows], LIVE_VALUE_FIELDS, 'stat_type')
+    data = json.dumps({'rows': rows, 'removed': list(removed)}, cls=JSONEncoder, separators=(',', ':'))
+    return f'id: {event_id}\nevent: {kind}\ndata: {data}\n\n'
@@ -0,0 +1,46 @@
+import importlib
+import json
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import setup_databases, teardown_databases, setup_test_environment, teardown_test_environment
+
+SUITES = ['units', 'sweeper', 'pagination', 'concurrency', 'rows', 'endpoints', 'export', 'columnar']
+
+
+class Command(BaseCommand):
+    help = ('Run a performance benchmark suite from defatify.benchmarks and print its results as JSON. '
+            'Suites that need data run against a throwaway test database, never the configured one.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('suite', choices=SUITES)
+        parser.add_argument('--rows', type=int, help='Rows per serialized list (units, rows, columnar; default 1000) or exported (export; default 1000000).')
+        parser.add_argument('--repeat', type=int, default=5, help='Runs per measurement; the best one is kept (units, rows, columnar).')
+        parser.add_argument('--users', type=int, help='Users to generate (endpoints, default 1000).')
+        parser.add_argument('--readings', type=int, help='Readings per user (endpoints, default 100).')
+        parser.add_argument('--battles', type=int,
+                            help='Battles to generate (sweeper: expired ones, default 100000; endpoints: default 200).')
+        parser.add_argument('--pages', type=int, default=1000, help='Depth of the deepest page (pagination).')
+        parser.add_argument('--requests', type=int,
+                            help='Requests per endpoint (concurrency: per mode, default 500; endpoints: default 100).')
+        parser.add_argument('--concurrency', type=int, default=20, help='Requests in flight at once (concurrency).')
+        parser.add_argument('--output', help='Also write the results to this file, e.g. to diff two commits.')
+
+    def handle(self, *args, **options):
+        suite = importlib.import_module(f'defatify.benchmarks.{options["suite"]}')
+        old_config = None
+        setup_test_environment()
+        if getattr(suite, 'USES_DATABASE', False):
+            old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            # Options left unset fall back to the suite's own defaults
+            results = suite.run(**{name: value for name, value in options.items() if value is not None})
+        except ValueError as exc:
+            raise CommandError(str(exc))
+        finally:
+            if old_config is not None:
+                teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+        output = json.dumps(results, indent=2, default=str)
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                file.write(output + '\n')
+        self.stdout.write(output)
@@ -0,0 +1,15 @@
+import time
+from django.core.management.base import BaseCommand
+from defatify.battle_updates import sweep_expired_battles
+
+
+class Command(BaseCommand):
+    help = 'Finish every in-progress duration battle whose duration has run out. Meant to run periodically (e.g. cron).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Battles finished per UPDATE.')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        finished = sweep_expired_battles(batch_size=options['batch_size'])
+        self.stdout.write(f'Finished {finished} expired battles in {time.perf_counter() - started:.2f}s')
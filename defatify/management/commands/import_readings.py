@@ -0,0 +1,27 @@
+import csv
+import json
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from defatify.ingest import CSVImportError, csv_lines, import_readings
+
+
+class Command(BaseCommand):
+    help = ("Import a user's historical readings from a CSV file with a date column and any of weight, bmi, "
+            "body_fat, muscle_mass, body_water and bone_mass (kilograms). Prints the import report as JSON.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('username')
+        parser.add_argument('path', help='CSV file to import.')
+        parser.add_argument('--batch-size', type=int, help='Rows per bulk insert (default 1000).')
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['username'])
+        except User.DoesNotExist:
+            raise CommandError(f'No user named {options["username"]}.')
+        try:
+            with open(options['path'], 'rb') as file:
+                report = import_readings(user, csv_lines(file), batch_size=options['batch_size'])
+        except (OSError, CSVImportError, csv.Error, UnicodeDecodeError) as exc:
+            raise CommandError(str(exc))
+        self.stdout.write(json.dumps(report, indent=2, default=str))
@@ -0,0 +1,15 @@
+import time
+from django.core.management.base import BaseCommand
+from defatify.blacklist import prune_expired_tokens
+
+
+class Command(BaseCommand):
+    help = 'Delete expired outstanding refresh tokens and their blacklist entries. Meant to run periodically (e.g. cron).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Tokens deleted per transaction.')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        deleted = prune_expired_tokens(batch_size=options['batch_size'])
+        self.stdout.write(f'Deleted {deleted} expired tokens in {time.perf_counter() - started:.2f}s')
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from defatify.popular import reconcile_participant_counts
+
+
+class Command(BaseCommand):
+    help = 'Repair Battle.participant_count wherever it drifted from the actual participants.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Battles repaired per UPDATE.')
+
+    def handle(self, *args, **options):
+        repaired = reconcile_participant_counts(batch_size=options['batch_size'])
+        self.stdout.write(f'Repaired {repaired} participant counts')
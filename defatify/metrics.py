@@ -0,0 +1,249 @@
+import hmac
+import logging
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.http import Http404, HttpResponse
+from .cache import cache_stats
+
+# Per-request performance metrics. MetricsMiddleware times every request; a
+# database execute wrapper installed on each connection (see install())
+# attributes queries to the request running in the current context, sync or
+# async, and the repo's serializers time their .data with serializing()
+# (MeasuredSerializerMixin, RowSerializer). Totals go into in-process histograms per route name, served in the
+# Prometheus text format by metrics_view. Each process reports its own numbers.
+
+# Requests slower than this are logged with their SQL to `defatify.slow_requests`
+SLOW_REQUEST_MS = getattr(settings, 'SLOW_REQUEST_MS', 500)
+# Statements kept per request for the slow-request log
+SLOW_REQUEST_MAX_QUERIES = 50
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 250)
+
+slow_log = logging.getLogger('defatify.slow_requests')
+
+
+class Histogram:
+    """A thread-safe Prometheus histogram, one series per label values."""
+
+    def __init__(self, name, help_text, buckets, labels=('route', 'method')):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.labels = labels
+        self._series = {}  # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, label_values, value):
+        with self._lock:
+            series = self._series.setdefault(label_values, [0] * (len(self.buckets) + 2))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+    def exposition(self):
+        with self._lock:
+            series = {labels: list(values) for labels, values in sorted(self._series.items())}
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        for label_values, values in series.items():
+            labels = _labels(self.labels, label_values)
+            for bound, count in zip(self.buckets, values):
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {values[-1]}')
+            lines.append(f'{self.name}_sum{{{labels}}} {round(values[-2], 6)}')
+            lines.append(f'{self.name}_count{{{labels}}} {values[-1]}')
+        return lines
+
+
+def _labels(names, values):
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values)
+    return ','.join(f'{name}="{value}"' for name, value in zip(names, escaped))
+
+
+REQUEST_SECONDS = Histogram('defatify_request_duration_seconds', 'Wall time of requests.', SECONDS_BUCKETS)
+DB_SECONDS = Histogram('defatify_request_db_seconds', 'Time spent executing SQL per request.', SECONDS_BUCKETS)
+SERIALIZER_SECONDS = Histogram('defatify_request_serializer_seconds', 'Time spent serializing response data per request.',
+                               SECONDS_BUCKETS)
+QUERIES = Histogram('defatify_request_queries', 'SQL statements executed per request.', COUNT_BUCKETS)
+DUPLICATE_QUERIES = Histogram('defatify_request_duplicate_queries',
+                              'Statements per request repeating an earlier one with the same parameters.', COUNT_BUCKETS)
+HISTOGRAMS = (REQUEST_SECONDS, DB_SECONDS, SERIALIZER_SECONDS, QUERIES, DUPLICATE_QUERIES)
+
+_responses = Counter()  # (route, method, status) -> requests
+_responses_lock = threading.Lock()
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.db_seconds = 0.0
+        self.serializer_seconds = 0.0
+        self.queries = 0
+        self.statements = Counter()
+        self.sql = []  # (milliseconds, sql) of the first SLOW_REQUEST_MAX_QUERIES statements
+        self._depth = 0
+
+    @property
+    def duplicate_queries(self):
+        return sum(count - 1 for count in self.statements.values())
+
+
+_current = ContextVar('defatify_request_metrics', default=None)
+
+
+def record_query(execute, sql, params, many, context):
+    """Execute wrapper attributing each statement to the request of the current context."""
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.db_seconds += elapsed
+        metrics.queries += 1
+        metrics.statements[(sql, repr(params))] += 1
+        if len(metrics.sql) < SLOW_REQUEST_MAX_QUERIES:
+            metrics.sql.append((round(elapsed * 1000, 3), sql))
+
+
+@contextmanager
+def serializing():
+    """Count the enclosed block as serializer time of the current request; nested blocks count once."""
+    metrics = _current.get()
+    if metrics is None or metrics._depth:
+        yield
+        return
+    metrics._depth += 1
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics._depth -= 1
+        metrics.serializer_seconds += time.perf_counter() - started
+
+
+def install():
+    """Hook the metrics into every database connection. Called from AppConfig.ready()."""
+    from django.db.backends.signals import connection_created
+    connection_created.connect(_watch_connection, dispatch_uid='defatify_metrics')
+
+
+def _watch_connection(sender, connection, **kwargs):
+    # execute_wrapper() blocks pop from the end, so stay first in the list
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, record_query)
+
+
+def _route(request):
+    match = getattr(request, 'resolver_match', None)
+    return match.url_name or match.view_name if match else 'unmatched'
+
+
+def _finish(request, response, metrics, started):
+    elapsed = time.perf_counter() - started
+    labels = (_route(request), request.method)
+    REQUEST_SECONDS.observe(labels, elapsed)
+    DB_SECONDS.observe(labels, metrics.db_seconds)
+    SERIALIZER_SECONDS.observe(labels, metrics.serializer_seconds)
+    QUERIES.observe(labels, metrics.queries)
+    DUPLICATE_QUERIES.observe(labels, metrics.duplicate_queries)
+    status = response.status_code if response is not None else 500
+    with _responses_lock:
+        _responses[(*labels, status)] += 1
+
+    if elapsed * 1000 >= SLOW_REQUEST_MS:
+        slow_log.warning(
+            'Slow request %s %s (%s): %.1f ms, %d queries (%d duplicates) taking %.1f ms, serializers %.1f ms\n%s',
+            request.method, request.get_full_path(), labels[0], elapsed * 1000, metrics.queries,
+            metrics.duplicate_queries, metrics.db_seconds * 1000, metrics.serializer_seconds * 1000,
+            '\n'.join(f'  [{ms} ms] {sql}' for ms, sql in metrics.sql),
+            extra={'route': labels[0], 'status_code': status},
+        )
+
+
+class MetricsMiddleware:
+    """Records wall, database and serializer time, queries and duplicates of every request."""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        metrics, started = RequestMetrics(), time.perf_counter()
+        token = _current.set(metrics)
+        response = None
+        try:
+            response = self.get_response(request)
+            return response
+        finally:
+            _current.reset(token)
+            _finish(request, response, metrics, started)
+
+    async def __acall__(self, request):
+        metrics, started = RequestMetrics(), time.perf_counter()
+        token = _current.set(metrics)
+        response = None
+        try:
+            response = await self.get_response(request)
+            return response
+        finally:
+            _current.reset(token)
+            _finish(request, response, metrics, started)
+
+
+def exposition():
+    """Every metric of this process in the Prometheus text format."""
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.exposition())
+
+    with _responses_lock:
+        responses = sorted(_responses.items())
+    lines += ['# HELP defatify_requests_total Requests served.', '# TYPE defatify_requests_total counter']
+    lines += [f'defatify_requests_total{{{_labels(("route", "method", "status"), key)}}} {count}' for key, count in responses]
+
+    stats = cache_stats()
+    for name in ('hits', 'misses', 'invalidations'):
+        lines += [f'# TYPE defatify_battle_cache_{name}_total counter', f'defatify_battle_cache_{name}_total {stats[name]}']
+    return '\n'.join(lines) + '\n'
+
+
+def reset():
+    for histogram in HISTOGRAMS:
+        histogram.clear()
+    with _responses_lock:
+        _responses.clear()
+
+
+def metrics_view(request):
+    """
+    Prometheus scrape endpoint. Scrapers authenticate with
+    `Authorization: Token <METRICS_TOKEN>`; without a token configured the
+    metrics are only served with DEBUG on.
+    """
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    if token:
+        scheme, _, credentials = request.headers.get('Authorization', '').partition(' ')
+        if scheme != 'Token' or not hmac.compare_digest(credentials.encode(), token.encode()):
+            return HttpResponse('Unauthorized\n', status=401, content_type='text/plain', headers={'WWW-Authenticate': 'Token'})
+    elif not settings.DEBUG:
+        raise Http404()
+    return HttpResponse(exposition(), content_type='text/plain; version=0.0.4; charset=utf-8')
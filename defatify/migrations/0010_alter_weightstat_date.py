@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-17 07:23
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('defatify', '0009_alter_battlestatistic_current_value_and_more'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='weightstat',
+            name='date',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,98 @@
+# Generated by Django 5.2.18 on 2026-10-17 07:28
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def remove_duplicates(apps, schema_editor):
+    # Keep the newest row of every pair the new unique constraints cover
+    for model_name, fields in [('BattleStatistic', ('battle', 'user')), ('Friendship', ('user', 'friend'))]:
+        model = apps.get_model('defatify', model_name)
+        duplicates = model.objects.values(*fields).annotate(keep=Max('id'), rows=models.Count('id')).filter(rows__gt=1)
+        for duplicate in duplicates:
+            model.objects.filter(**{field: duplicate[field] for field in fields}).exclude(id=duplicate['keep']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('defatify', '0010_alter_weightstat_date'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='battleinvitation',
+            name='invited_user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='battle_invitations', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='battlestatistic',
+            name='battle',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='statistics', to='defatify.battle'),
+        ),
+        migrations.AlterField(
+            model_name='battlestatistic',
+            name='user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='friendrequest',
+            name='from_user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='sent_requests', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='friendrequest',
+            name='to_user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='received_requests', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='friendship',
+            name='user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='friends', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='weightstat',
+            name='user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='weight_stats', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='battle',
+            index=models.Index(fields=['is_private', 'status'], name='battle_private_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='battle',
+            index=models.Index(condition=models.Q(('status', 'in_progress')), fields=['type', 'created_at'], name='battle_in_progress_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='battleinvitation',
+            index=models.Index(fields=['invited_user', 'status'], name='invitation_user_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='battlestatistic',
+            index=models.Index(fields=['user', 'battle'], name='battlestat_user_battle_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='friendrequest',
+            index=models.Index(fields=['to_user', 'status'], name='friendrequest_to_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='friendrequest',
+            index=models.Index(fields=['from_user', 'status'], name='friendrequest_from_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='weightstat',
+            index=models.Index(fields=['user', '-date'], name='weightstat_user_date_idx'),
+        ),
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='battlestatistic',
+            constraint=models.UniqueConstraint(fields=('battle', 'user'), name='unique_battle_statistic'),
+        ),
+        migrations.AddConstraint(
+            model_name='friendship',
+            constraint=models.UniqueConstraint(fields=('user', 'friend'), name='unique_friendship'),
+        ),
+    ]
@@ -0,0 +1,61 @@
+from django.db import migrations
+
+# Kept in step with defatify.search.PG_BATTLE_VECTOR, so the planner can match the index
+PG_BATTLE_VECTOR = (
+    "(setweight(to_tsvector('simple', coalesce(name, '')), 'A') || "
+    "setweight(to_tsvector('simple', coalesce(description, '')), 'B'))"
+)
+
+POSTGRES_FORWARD = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    f"CREATE INDEX IF NOT EXISTS battle_search_vector_idx ON defatify_battle USING GIN ({PG_BATTLE_VECTOR})",
+    "CREATE INDEX IF NOT EXISTS battle_name_trgm_idx ON defatify_battle USING GIN (name gin_trgm_ops)",
+]
+POSTGRES_BACKWARD = [
+    "DROP INDEX IF EXISTS battle_name_trgm_idx",
+    "DROP INDEX IF EXISTS battle_search_vector_idx",
+]
+
+# External-content FTS5 table: the text lives in defatify_battle, triggers keep the index current
+SQLITE_FORWARD = [
+    "CREATE VIRTUAL TABLE defatify_battle_fts USING fts5("
+    "name, description, content='defatify_battle', content_rowid='id', prefix='2 3')",
+    "CREATE TRIGGER defatify_battle_fts_insert AFTER INSERT ON defatify_battle BEGIN "
+    "INSERT INTO defatify_battle_fts(rowid, name, description) VALUES (new.id, new.name, new.description); END",
+    "CREATE TRIGGER defatify_battle_fts_delete AFTER DELETE ON defatify_battle BEGIN "
+    "INSERT INTO defatify_battle_fts(defatify_battle_fts, rowid, name, description) "
+    "VALUES ('delete', old.id, old.name, old.description); END",
+    "CREATE TRIGGER defatify_battle_fts_update AFTER UPDATE OF name, description ON defatify_battle BEGIN "
+    "INSERT INTO defatify_battle_fts(defatify_battle_fts, rowid, name, description) "
+    "VALUES ('delete', old.id, old.name, old.description); "
+    "INSERT INTO defatify_battle_fts(rowid, name, description) VALUES (new.id, new.name, new.description); END",
+    "INSERT INTO defatify_battle_fts(defatify_battle_fts) VALUES ('rebuild')",
+]
+SQLITE_BACKWARD = [
+    "DROP TRIGGER IF EXISTS defatify_battle_fts_update",
+    "DROP TRIGGER IF EXISTS defatify_battle_fts_delete",
+    "DROP TRIGGER IF EXISTS defatify_battle_fts_insert",
+    "DROP TABLE IF EXISTS defatify_battle_fts",
+]
+
+
+def run_for_vendor(postgres, sqlite):
+    def run(apps, schema_editor):
+        statements = {'postgresql': postgres, 'sqlite': sqlite}.get(schema_editor.connection.vendor, [])
+        for statement in statements:
+            schema_editor.execute(statement)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('defatify', '0011_performance_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run_for_vendor(POSTGRES_FORWARD, SQLITE_FORWARD),
+            run_for_vendor(POSTGRES_BACKWARD, SQLITE_BACKWARD),
+        ),
+    ]
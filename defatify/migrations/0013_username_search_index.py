@@ -0,0 +1,36 @@
+from django.conf import settings
+from django.db import migrations
+
+# Username search (defatify.search.search_users) on PostgreSQL: a trigram index
+# serves the ranked substring match, and a pattern-ops index on UPPER(username)
+# serves the exact/prefix lookups Django emits for iexact/istartswith.
+# SQLite keeps an in-process sorted index instead, so nothing is created there.
+POSTGRES_FORWARD = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS auth_user_username_trgm_idx ON auth_user USING GIN (username gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS auth_user_username_upper_idx ON auth_user (UPPER(username::text) text_pattern_ops)",
+]
+POSTGRES_BACKWARD = [
+    "DROP INDEX IF EXISTS auth_user_username_upper_idx",
+    "DROP INDEX IF EXISTS auth_user_username_trgm_idx",
+]
+
+
+def run_on_postgres(statements):
+    def run(apps, schema_editor):
+        if schema_editor.connection.vendor == 'postgresql':
+            for statement in statements:
+                schema_editor.execute(statement)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('defatify', '0012_battle_search_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(run_on_postgres(POSTGRES_FORWARD), run_on_postgres(POSTGRES_BACKWARD)),
+    ]
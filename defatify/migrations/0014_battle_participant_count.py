@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-17 07:42
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_participants(apps, schema_editor):
+    Battle = apps.get_model('defatify', 'Battle')
+    counts = (
+        Battle.participants.through.objects.filter(battle=OuterRef('pk'))
+        .values('battle').annotate(count=Count('*')).values('count')
+    )
+    Battle.objects.update(participant_count=Coalesce(Subquery(counts), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('defatify', '0013_username_search_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        # On SQLite this remakes defatify_battle, dropping its FTS triggers;
+        # defatify.search.restore_battle_fts_triggers recreates them after migrate
+        migrations.AddField(
+            model_name='battle',
+            name='participant_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_participants, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='battle',
+            index=models.Index(condition=models.Q(('is_private', False), ('status__in', ['not_started', 'in_progress'])), fields=['-participant_count', '-id'], name='battle_popular_idx'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-17 09:08
+
+from django.db import migrations, models
+
+
+def create_generation(apps, schema_editor):
+    apps.get_model('defatify', 'TokenBlacklistGeneration').objects.create(pk=1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('defatify', '0014_battle_participant_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TokenBlacklistGeneration',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('value', models.PositiveBigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(create_generation, migrations.RunPython.noop),
+    ]
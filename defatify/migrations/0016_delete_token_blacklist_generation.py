@@ -0,0 +1,16 @@
+# Generated by Django 5.2.18 on 2026-10-17 09:41
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('defatify', '0015_token_blacklist_generation'),
+    ]
+
+    operations = [
+        migrations.DeleteModel(
+            name='TokenBlacklistGeneration',
+        ),
+    ]
@@ -0,0 +1,35 @@
+from django.conf import settings
+from django.db import migrations
+
+# Django compiles username__icontains to UPPER("auth_user"."username"::text)
+# LIKE UPPER(%s), which the trigram index of migration 0013 on the raw column
+# cannot serve. Index the expression the query actually uses instead.
+POSTGRES_FORWARD = [
+    "CREATE INDEX IF NOT EXISTS auth_user_username_upper_trgm_idx ON auth_user "
+    "USING GIN (UPPER(username::text) gin_trgm_ops)",
+    "DROP INDEX IF EXISTS auth_user_username_trgm_idx",
+]
+POSTGRES_BACKWARD = [
+    "CREATE INDEX IF NOT EXISTS auth_user_username_trgm_idx ON auth_user USING GIN (username gin_trgm_ops)",
+    "DROP INDEX IF EXISTS auth_user_username_upper_trgm_idx",
+]
+
+
+def run_on_postgres(statements):
+    def run(apps, schema_editor):
+        if schema_editor.connection.vendor == 'postgresql':
+            for statement in statements:
+                schema_editor.execute(statement)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('defatify', '0016_delete_token_blacklist_generation'),
+    ]
+
+    operations = [
+        migrations.RunPython(run_on_postgres(POSTGRES_FORWARD), run_on_postgres(POSTGRES_BACKWARD)),
+    ]
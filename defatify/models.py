@@ -1,5 +1,8 @@
 from django.db import models
+from django.db.models import F, Q, Case, When, Count, Func, OuterRef, Subquery, Window, Prefetch
+from django.db.models.functions import Rank, RowNumber
 from django.contrib.auth.models import User
+from django.utils import timezone
 
 # PROFILE MODEL
 class Profile(models.Model):
@@ -17,9 +20,31 @@ class Profile(models.Model):
     def __str__(self):
         return self.user.username
 
+# Read-only stand-ins for the user and profile an access token's claims
+# describe (authentication.py); saving one would overwrite the real row
+class ClaimsUser(User):
+    class Meta:
+        proxy = True
+
+    def save(self, *args, **kwargs):
+        raise NotImplementedError('Users built from token claims are read-only; load the row to change it.')
+
+    def delete(self, *args, **kwargs):
+        raise NotImplementedError('Users built from token claims are read-only; load the row to delete it.')
+
+class ClaimsProfile(Profile):
+    class Meta:
+        proxy = True
+
+    def save(self, *args, **kwargs):
+        raise NotImplementedError('Profiles built from token claims are read-only; load the row to change it.')
+
+    def delete(self, *args, **kwargs):
+        raise NotImplementedError('Profiles built from token claims are read-only; load the row to delete it.')
+
 class WeightStat(models.Model):
-    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='weight_stats')
-    date = models.DateTimeField(auto_now_add=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='weight_stats', db_index=False)  # Covered by the (user, date) index
+    date = models.DateTimeField(default=timezone.now)  # Bulk syncs supply their own timestamps
     weight = models.DecimalField(max_digits=5, decimal_places=2, blank=True, null=True)
     bmi = models.DecimalField(max_digits=5, decimal_places=2, blank=True, null=True)
     body_fat = models.DecimalField(max_digits=5, decimal_places=2, blank=True, null=True)
@@ -27,49 +52,82 @@ class WeightStat(models.Model):
     body_water = models.DecimalField(max_digits=5, decimal_places=2, blank=True, null=True)
     bone_mass = models.DecimalField(max_digits=5, decimal_places=2, blank=True, null=True)
 
-    def save(self, *args, **kwargs):
-        super().save(*args, **kwargs)
-
-        # Update BattleStatistic starting_value for not_started battles
-        from .models import BattleStatistic, Battle  # Avoid circular imports
-
-        # Retrieve battles where the user is participating and the status is "not_started"
-        battles = Battle.objects.filter(participants=self.user, status='not_started')
-        
-        # Loop through each battle and update the starting value in BattleStatistic
-        for battle in battles:
-            battle_stat, created = BattleStatistic.objects.get_or_create(
-                battle=battle,
-                user=self.user,
-                stat_type=battle.weight_param  # Ensure this matches the weight param type
-            )
-            # Update the starting value based on the latest weight stat for the relevant parameter
-            setattr(battle_stat, 'starting_value', getattr(self, battle.weight_param, None))
-            setattr(battle_stat, 'current_value', getattr(self, battle.weight_param, None))
-            battle_stat.save()
+    class Meta:
+        indexes = [
+            # Latest reading and date-range history of a user
+            models.Index(fields=['user', '-date'], name='weightstat_user_date_idx'),
+        ]
 
     def __str__(self):
         return f"{self.user.username} - {self.date}"
     
 # FRIENDS MODEL
 class FriendRequest(models.Model):
-    from_user = models.ForeignKey(User, related_name='sent_requests', on_delete=models.CASCADE)
-    to_user = models.ForeignKey(User, related_name='received_requests', on_delete=models.CASCADE)
+    from_user = models.ForeignKey(User, related_name='sent_requests', on_delete=models.CASCADE, db_index=False)
+    to_user = models.ForeignKey(User, related_name='received_requests', on_delete=models.CASCADE, db_index=False)
     status = models.CharField(max_length=10, choices=[('pending', 'Pending'), ('accepted', 'Accepted'), ('rejected', 'Rejected')], default='pending')
     timestamp = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['to_user', 'status'], name='friendrequest_to_status_idx'),
+            models.Index(fields=['from_user', 'status'], name='friendrequest_from_status_idx'),
+        ]
+
     def __str__(self):
         return f"{self.from_user.username} -> {self.to_user.username} ({self.status})"
 
 class Friendship(models.Model):
-    user = models.ForeignKey(User, related_name='friends', on_delete=models.CASCADE)
+    user = models.ForeignKey(User, related_name='friends', on_delete=models.CASCADE, db_index=False)  # Covered by unique_friendship
     friend = models.ForeignKey(User, related_name='_friends', on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'friend'], name='unique_friendship'),
+        ]
+
     def __str__(self):
         return f"{self.user.username} & {self.friend.username}"
     
 # BATTLES MODEL
+class BattleQuerySet(models.QuerySet):
+    # BattleSerializer fields that read each related user
+    PEOPLE_FIELDS = {'creator': ('creator',), 'winner': ('winner_id', 'winner_name')}
+    # Columns loaded whatever the fields: the key and the keyset pagination ordering
+    ALWAYS_LOADED = ('id', 'created_at')
+
+    def _with_people(self, fields=None):
+        # Creator and winner come in the same query, without the rest of their user rows.
+        # With `fields` (BattleSerializer field names), only the columns and people those read.
+        people = [name for name, read_by in self.PEOPLE_FIELDS.items()
+                  if fields is None or not set(read_by).isdisjoint(fields)]
+        battle_fields = [field.name for field in self.model._meta.concrete_fields
+                         if fields is None or field.name in fields or field.name in people
+                         or field.name in self.ALWAYS_LOADED]
+        queryset = self.select_related(*people) if people else self
+        return queryset.only(*battle_fields, *(f'{name}__username' for name in people))
+
+    def for_detail(self, fields=None):
+        """Everything BattleSerializer reads, in two queries: battles and their participants."""
+        queryset = self._with_people(fields)
+        if fields is not None and 'participants' not in fields:
+            return queryset
+        return queryset.prefetch_related(
+            Prefetch('participants', queryset=User.objects.only('id', 'username').order_by('username'))
+        )
+
+    def for_list(self, fields=None):
+        """Like for_detail, but only the first few participants of each battle are loaded (`participant_preview`)."""
+        queryset = self._with_people(fields)
+        if fields is not None and 'participants_preview' not in fields:
+            return queryset
+        preview = User.objects.only('id', 'username').order_by('username', 'id')[:self.model.PARTICIPANT_PREVIEW_SIZE]
+        return queryset.prefetch_related(
+            Prefetch('participants', queryset=preview, to_attr='participant_preview')
+        )
+
+
 class Battle(models.Model):
     STATUS_CHOICES = [
         ('not_started', 'Not Started'),
@@ -90,10 +148,17 @@ class Battle(models.Model):
         # Add other parameters as needed
     ]
 
+    # Battles on these parameters are won by going down, the rest by going up
+    LOWER_IS_BETTER_PARAMS = ['weight', 'body_fat']
+
+    # Participant names shown per battle by list endpoints
+    PARTICIPANT_PREVIEW_SIZE = 5
+
     name = models.CharField(max_length=100)
     description = models.TextField(blank=True, null=True)
     creator = models.ForeignKey(User, related_name="created_battles", on_delete=models.CASCADE)
     participants = models.ManyToManyField(User, related_name="battles", blank=True)
+    participant_count = models.PositiveIntegerField(default=0)  # Kept in step with participants by signals.py
     type = models.CharField(max_length=10, choices=TYPE_CHOICES)  # "stat_goal" or "duration"
     weight_param = models.CharField(max_length=20, choices=PARAM_CHOICES)
     goal_value = models.DecimalField(max_digits=5, decimal_places=2, blank=True, null=True)  # For stat goal type
@@ -104,16 +169,91 @@ class Battle(models.Model):
     deleted_at = models.DateTimeField(blank=True, null=True)
     winner = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='won_battles')
 
+    objects = BattleQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Public battle feeds (popular, search) filter on visibility and status
+            models.Index(fields=['is_private', 'status'], name='battle_private_status_idx'),
+            # Battles still running, for the completion checks
+            models.Index(fields=['type', 'created_at'], name='battle_in_progress_idx', condition=models.Q(status='in_progress')),
+            # The popular feed: open public battles by participant count
+            models.Index(
+                fields=['-participant_count', '-id'], name='battle_popular_idx',
+                condition=models.Q(is_private=False, status__in=['not_started', 'in_progress']),
+            ),
+        ]
+
     def __str__(self):
         return self.name
     
+class BattleStatisticQuerySet(models.QuerySet):
+    def scored(self):
+        """Annotate `progress` (current - starting) and `score`, where a higher score is always better."""
+        progress = F('current_value') - F('starting_value')
+        return self.annotate(
+            progress=models.ExpressionWrapper(progress, output_field=models.DecimalField(max_digits=6, decimal_places=2)),
+            score=Case(
+                When(battle__weight_param__in=Battle.LOWER_IS_BETTER_PARAMS, then=F('starting_value') - F('current_value')),
+                default=progress,
+                output_field=models.DecimalField(max_digits=6, decimal_places=2),
+            ),
+        )
+
+    def for_leaderboard(self, fields=None):
+        """
+        The columns LeaderboardSerializer reads, with the user's name joined in;
+        with `fields`, only those the kept field names read.
+        """
+        columns = [name for name in ('stat_type', 'starting_value', 'current_value')
+                   if fields is None or name in fields]
+        if fields is not None and 'user' not in fields:
+            return self.only('id', *columns)
+        return self.select_related('user').only('id', 'user', 'user__username', *columns)
+
+    def ranked(self):
+        """Leaderboard order with `rank`, `position` and `total_count` computed by window functions."""
+        order = [F('score').desc(), F('user_id').asc()]
+        return self.scored().annotate(
+            rank=Window(Rank(), order_by=F('score').desc()),
+            position=Window(RowNumber(), order_by=order),
+            total_count=Window(Count('id')),
+        ).order_by(*order)
+
+    def position_of(self, user_id):
+        """
+        The user's 1-based `position` in ranked() order, as a one-row values()
+        queryset counting the rows ahead of theirs; empty if they have no row.
+        """
+        ahead = self.scored().filter(
+            Q(score__gt=OuterRef('score')) | Q(score=OuterRef('score'), user_id__lt=user_id)
+        ).order_by().annotate(count=Func('id', function='COUNT')).values('count')
+        return self.scored().filter(user_id=user_id).annotate(position=Subquery(ahead) + 1).values('position')
+
+    def around(self, position, neighbours):
+        """The rows of a ranked() queryset within `neighbours` positions of `position`."""
+        return self[max(position - 1 - neighbours, 0):position + neighbours]
+
+
 class BattleStatistic(models.Model):
-    battle = models.ForeignKey(Battle, on_delete=models.CASCADE, related_name="statistics")
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    # Both foreign keys are covered by the composite index and unique constraint below
+    battle = models.ForeignKey(Battle, on_delete=models.CASCADE, related_name="statistics", db_index=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_index=False)
     stat_type = models.CharField(max_length=20)  # E.g., "weight"
     starting_value = models.DecimalField(max_digits=5, decimal_places=2, default=0.0)
     current_value = models.DecimalField(max_digits=5, decimal_places=2, default=0.0)
 
+    objects = BattleStatisticQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['battle', 'user'], name='unique_battle_statistic'),
+        ]
+        indexes = [
+            # A user's statistics across battles, joined to Battle for status filters
+            models.Index(fields=['user', 'battle'], name='battlestat_user_battle_idx'),
+        ]
+
     def __str__(self):
         return f"{self.user.username} - {self.stat_type} in {self.battle.name}"
     
@@ -125,10 +265,15 @@ class BattleInvitation(models.Model):
     ]
 
     battle = models.ForeignKey(Battle, on_delete=models.CASCADE, related_name="invitations")
-    invited_user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="battle_invitations")
+    invited_user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="battle_invitations", db_index=False)
     inviting_user = models.ForeignKey(User, on_delete=models.CASCADE)
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['invited_user', 'status'], name='invitation_user_status_idx'),
+        ]
+
     def __str__(self):
-        return f"Invitation for {self.invited_user.username} to join {self.battle.name}"
\ No newline at end of file
+        return f"Invitation for {self.invited_user.username} to join {self.battle.name}"
@@ -0,0 +1,131 @@
+from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger, InvalidPage
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import PageNumberPagination, CursorPagination
+
+
+class WindowCountPaginator(Paginator):
+    """
+    Paginator for querysets that carry their total row count as a window
+    annotation (`total_count`), so a page costs one query instead of
+    COUNT(*) followed by the page SELECT.
+    """
+    count_attribute = 'total_count'
+
+    def _bounds(self, number):
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger('That page number is not an integer')
+        if number < 1:
+            raise EmptyPage('That page number is less than 1')
+        bottom = (number - 1) * self.per_page
+        return number, bottom, bottom + self.per_page
+
+    def page(self, number):
+        number, bottom, top = self._bounds(number)
+        return self._page_of(list(self.object_list[bottom:top]), number)
+
+    async def apage(self, number):
+        number, bottom, top = self._bounds(number)
+        return self._page_of([row async for row in self.object_list[bottom:top]], number)
+
+    def _page_of(self, rows, number):
+        if rows:
+            self.count = getattr(rows[0], self.count_attribute)
+        elif number > 1:
+            raise EmptyPage('That page contains no results')
+        else:
+            self.count = 0
+        return self._get_page(rows, number, self)
+
+
+class LeaderboardPagination(PageNumberPagination):
+    django_paginator_class = WindowCountPaginator
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+    async def apaginate_queryset(self, queryset, request):
+        """paginate_queryset() for the async views: the page is read with `async for`."""
+        self.request = request
+        page_size = self.get_page_size(request)
+        paginator = self.django_paginator_class(queryset, page_size)
+        page_number = request.query_params.get(self.page_query_param) or 1
+        if page_number in self.last_page_strings:
+            paginator.count = await queryset.acount()
+            page_number = paginator.num_pages
+        try:
+            self.page = await paginator.apage(page_number)
+        except InvalidPage as exc:
+            raise NotFound(self.invalid_page_message.format(page_number=page_number, message=str(exc)))
+        return list(self.page)
+
+
+def reverse_ordering(ordering):
+    """`ordering` with every direction flipped, for walking back from a cursor."""
+    return tuple(name[1:] if name.startswith('-') else f'-{name}' for name in ordering)
+
+
+def position_of(row, ordering):
+    """The cursor position of `row` (an instance or a values_list() named tuple): its first ordering column."""
+    value = getattr(row, ordering[0].lstrip('-'))
+    return None if value is None else str(value)
+
+
+class KeysetPagination(CursorPagination):
+    """
+    Cursor pagination for lists that only ever grow. Pages are found by seeking
+    past the last row on a stable (timestamp, id) ordering with an opaque
+    cursor, so deep pages cost the same as the first one: no COUNT(*) and no
+    OFFSET scan.
+    """
+    ordering = ('-created_at', '-id')
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+    @property
+    def ordering_columns(self):
+        """The columns cursors are made of: values_list() pages must select them."""
+        return [name.lstrip('-') for name in self.ordering]
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        """
+        paginate_queryset() for the async views: the same cursors and links,
+        with the page read by `async for`.
+        """
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+
+        self.cursor = self.decode_cursor(request)
+        offset, reverse, current_position = self.cursor or (0, False, None)
+        queryset = queryset.order_by(*(reverse_ordering(self.ordering) if reverse else self.ordering))
+        if current_position is not None:
+            order = self.ordering[0]
+            lookup = 'lt' if reverse != order.startswith('-') else 'gt'
+            queryset = queryset.filter(**{f"{order.lstrip('-')}__{lookup}": current_position})
+
+        # One extra row tells whether a following page exists
+        results = [row async for row in queryset[offset:offset + self.page_size + 1]]
+        self.page = results[:self.page_size]
+        following_position = None
+        if len(results) > len(self.page):
+            following_position = position_of(results[-1], self.ordering)
+
+        moved = current_position is not None or offset > 0
+        if reverse:
+            self.page.reverse()
+            self.has_next, self.has_previous = moved, following_position is not None
+            self.next_position, self.previous_position = current_position, following_position
+        else:
+            self.has_next, self.has_previous = following_position is not None, moved
+            self.next_position, self.previous_position = following_position, current_position
+        return self.page
+
+
+class WeightStatPagination(KeysetPagination):
+    ordering = ('-date', '-id')
+
+
+class FriendRequestPagination(KeysetPagination):
+    ordering = ('-timestamp', '-id')
@@ -0,0 +1,78 @@
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Subquery, Case, When, IntegerField
+from django.db.models.functions import Coalesce
+from .models import Battle
+from .cache import invalidate_battles
+
+Participation = Battle.participants.through
+
+POPULAR_BATTLES_LIMIT = 10
+POPULAR_BATTLES_KEY = 'battles:popular'
+# Refreshes on change keep the feed current; the timeout only bounds a missed one
+POPULAR_BATTLES_TIMEOUT = 60 * 60
+
+
+def open_public_battles():
+    return Battle.objects.filter(is_private=False, status__in=['not_started', 'in_progress'])
+
+
+def _actual_counts():
+    return Coalesce(Subquery(
+        Participation.objects.filter(battle=OuterRef('pk')).values('battle').annotate(count=Count('*')).values('count')
+    ), 0)
+
+
+def add_participant_counts(battle_ids, amount):
+    """Add `amount` to the counters of the given battles in one UPDATE."""
+    Battle.objects.filter(id__in=battle_ids).update(participant_count=F('participant_count') + amount)
+    battles_changed()
+
+
+def recount_participants(battle_ids):
+    """Reset the counters of the given battles from their participant rows."""
+    Battle.objects.filter(id__in=battle_ids).update(participant_count=_actual_counts())
+    battles_changed()
+
+
+def reconcile_participant_counts(batch_size=1000):
+    """Repair every counter that drifted from the participant rows; returns the battles fixed."""
+    drifted = list(
+        Battle.objects.annotate(actual=_actual_counts()).exclude(participant_count=F('actual')).values_list('id', flat=True)
+    )
+    for start in range(0, len(drifted), batch_size):
+        batch = drifted[start:start + batch_size]
+        with transaction.atomic():
+            Battle.objects.filter(id__in=batch).update(participant_count=_actual_counts())
+            invalidate_battles(batch)
+    if drifted:
+        battles_changed()
+    return len(drifted)
+
+
+def refresh_popular_battles():
+    battle_ids = list(
+        open_public_battles().order_by('-participant_count', '-id').values_list('id', flat=True)[:POPULAR_BATTLES_LIMIT]
+    )
+    cache.set(POPULAR_BATTLES_KEY, battle_ids, POPULAR_BATTLES_TIMEOUT)
+    return battle_ids
+
+
+def battles_changed():
+    """
+    A battle's popularity or visibility changed: drop the cached feed now, so
+    no reader keeps seeing it, and precompute it again once the change commits.
+    """
+    cache.delete(POPULAR_BATTLES_KEY)
+    transaction.on_commit(refresh_popular_battles)
+
+
+def popular_battles():
+    """The most joined open public battles, most participants first."""
+    battle_ids = cache.get(POPULAR_BATTLES_KEY)
+    if battle_ids is None:
+        battle_ids = refresh_popular_battles()
+    if not battle_ids:
+        return Battle.objects.none()
+    position = Case(*[When(id=battle_id, then=index) for index, battle_id in enumerate(battle_ids)], output_field=IntegerField())
+    return Battle.objects.filter(id__in=battle_ids).order_by(position)
@@ -0,0 +1,143 @@
+import uuid
+from datetime import datetime, time, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from django.core.cache import cache
+from django.db.models import Q, Min, Max, Avg, Count
+from django.db.models.functions import TruncDay, TruncWeek, TruncMonth
+from django.utils import timezone
+from .models import WeightStat
+from .battle_updates import STAT_FIELDS
+
+PERIODS = {'day': TruncDay, 'week': TruncWeek, 'month': TruncMonth}
+
+# Closed buckets never change unless history is backfilled, which bumps the user's version
+CLOSED_BUCKETS_TIMEOUT = 24 * 60 * 60
+
+AVG_QUANTUM = Decimal('0.01')
+
+
+def bucket_start(moment, period):
+    """Start (UTC) of the bucket containing `moment`, matching Trunc* in the database."""
+    moment = moment.astimezone(dt_timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    if period == 'week':
+        return moment - timedelta(days=moment.weekday())
+    if period == 'month':
+        return moment.replace(day=1)
+    return moment
+
+
+def next_bucket(start, period):
+    if period == 'week':
+        return start + timedelta(days=7)
+    if period == 'month':
+        return (start + timedelta(days=32)).replace(day=1)
+    return start + timedelta(days=1)
+
+
+def _version_key(user_id):
+    return f'rollup:{user_id}:version'
+
+
+def rollup_version(user_id):
+    version = cache.get(_version_key(user_id))
+    if version is None:
+        version = uuid.uuid4().hex
+        if not cache.add(_version_key(user_id), version, timeout=None):
+            version = cache.get(_version_key(user_id), version)
+    return version
+
+
+def invalidate_rollups(user_ids):
+    """Forget the cached closed buckets of these users (their past history changed)."""
+    cache.set_many({_version_key(user_id): uuid.uuid4().hex for user_id in set(user_ids)}, timeout=None)
+
+
+def touches_closed_buckets(date):
+    # Today's bucket is open for every period, so anything older may sit in a cached one
+    return date < bucket_start(timezone.now(), 'day')
+
+
+def _aggregate(user, period, condition):
+    """Bucket rows (min/max/avg/last of every stat) for the user's readings matching `condition`."""
+    readings = WeightStat.objects.filter(condition, user=user)
+    aggregates = {}
+    for stat in STAT_FIELDS:
+        aggregates[f'{stat}__min'] = Min(stat)
+        aggregates[f'{stat}__max'] = Max(stat)
+        aggregates[f'{stat}__avg'] = Avg(stat)
+    grouped = list(
+        readings.annotate(bucket=PERIODS[period]('date', tzinfo=dt_timezone.utc))
+        .values('bucket')
+        .annotate(count=Count('id'), last_date=Max('date'), **aggregates)
+        .order_by('bucket')
+    )
+    if not grouped:
+        return {}
+
+    # The newest reading of each bucket supplies its `last` values
+    last = {}
+    for row in readings.filter(date__in=[row['last_date'] for row in grouped]).order_by('date', 'id').values('date', *STAT_FIELDS):
+        last[row['date']] = row
+
+    buckets = {}
+    for row in grouped:
+        bucket = {'bucket': row['bucket'], 'count': row['count']}
+        for stat in STAT_FIELDS:
+            avg = row[f'{stat}__avg']
+            bucket[stat] = {
+                'min': row[f'{stat}__min'],
+                'max': row[f'{stat}__max'],
+                'avg': Decimal(avg).quantize(AVG_QUANTUM) if avg is not None else None,
+                'last': last[row['last_date']][stat],
+            }
+        buckets[row['bucket']] = bucket
+    return buckets
+
+
+def _closed_buckets(user, period, current):
+    key = f'rollup:{user.id}:{rollup_version(user.id)}:{period}:{current.isoformat()}'
+    buckets = cache.get(key)
+    if buckets is None:
+        buckets = _aggregate(user, period, Q(date__lt=current))
+        cache.set(key, buckets, CLOSED_BUCKETS_TIMEOUT)
+    return buckets
+
+
+def weight_rollups(user, period, start_date=None, end_date=None):
+    """
+    Bucketed min/max/avg/last of the user's readings between two dates (both
+    inclusive), in kilograms.
+
+    Complete closed buckets come from the cache; the open bucket and buckets
+    cut by the date range are aggregated live in a single query.
+    """
+    range_start = datetime.combine(start_date, time.min, dt_timezone.utc) if start_date else None
+    range_end = datetime.combine(end_date + timedelta(days=1), time.min, dt_timezone.utc) if end_date else None
+
+    current = bucket_start(timezone.now(), period)
+    # [cached_start, cached_end) holds only complete, closed buckets inside the range
+    cached_start = None
+    if range_start is not None:
+        cached_start = bucket_start(range_start, period)
+        if cached_start != range_start:
+            cached_start = next_bucket(cached_start, period)
+    cached_end = current
+    if range_end is not None:
+        cached_end = min(current, bucket_start(range_end, period))
+
+    buckets = {}
+    if cached_start is None or cached_start < cached_end:
+        buckets.update(
+            (start, row) for start, row in _closed_buckets(user, period, current).items()
+            if (cached_start is None or start >= cached_start) and start < cached_end
+        )
+        live = ~Q(date__lt=cached_end) if cached_start is None else ~Q(date__gte=cached_start, date__lt=cached_end)
+    else:
+        live = Q()
+
+    if range_start is not None:
+        live &= Q(date__gte=range_start)
+    if range_end is not None:
+        live &= Q(date__lt=range_end)
+    buckets.update(_aggregate(user, period, live))
+    return [buckets[start] for start in sorted(buckets)]
@@ -0,0 +1,272 @@
+import re
+import threading
+import time
+from bisect import bisect_left
+from django.contrib.auth.models import User
+from django.db import connection, connections
+from django.db.models import Q, BooleanField, FloatField, IntegerField, Case, When, Exists, OuterRef
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Lower
+from .models import Friendship, FriendRequest
+from .utils import TTLCache
+
+# Battle search is backed by a database-specific full-text index, created in
+# migration 0012:
+#   * PostgreSQL: a GIN index on the weighted tsvector below plus a pg_trgm
+#     index on the name, so substring matches on names stay indexed too.
+#   * SQLite: an FTS5 table over name/description kept in sync by triggers.
+# Any other backend falls back to the original icontains scan.
+
+PG_BATTLE_VECTOR = (
+    "(setweight(to_tsvector('simple', coalesce(name, '')), 'A') || "
+    "setweight(to_tsvector('simple', coalesce(description, '')), 'B'))"
+)
+
+SQLITE_BATTLE_FTS = 'defatify_battle_fts'
+# bm25 column weights: a hit in the name counts ten times one in the description
+SQLITE_BM25 = f'bm25({SQLITE_BATTLE_FTS}, 10.0, 1.0)'
+
+
+# The triggers of migration 0012 that keep the FTS5 table current. SQLite drops
+# them whenever a migration remakes defatify_battle (adding or altering a
+# column does), so restore_battle_fts_triggers puts them back after migrate.
+SQLITE_BATTLE_FTS_TRIGGERS = {
+    'defatify_battle_fts_insert':
+        "CREATE TRIGGER defatify_battle_fts_insert AFTER INSERT ON defatify_battle BEGIN "
+        "INSERT INTO defatify_battle_fts(rowid, name, description) VALUES (new.id, new.name, new.description); END",
+    'defatify_battle_fts_delete':
+        "CREATE TRIGGER defatify_battle_fts_delete AFTER DELETE ON defatify_battle BEGIN "
+        "INSERT INTO defatify_battle_fts(defatify_battle_fts, rowid, name, description) "
+        "VALUES ('delete', old.id, old.name, old.description); END",
+    'defatify_battle_fts_update':
+        "CREATE TRIGGER defatify_battle_fts_update AFTER UPDATE OF name, description ON defatify_battle BEGIN "
+        "INSERT INTO defatify_battle_fts(defatify_battle_fts, rowid, name, description) "
+        "VALUES ('delete', old.id, old.name, old.description); "
+        "INSERT INTO defatify_battle_fts(rowid, name, description) VALUES (new.id, new.name, new.description); END",
+}
+
+
+def restore_battle_fts_triggers(using='default', **kwargs):
+    """
+    post_migrate receiver: recreate the FTS triggers a migration dropped and
+    reindex, since battles written without them are missing from the index.
+    """
+    connection = connections[using]
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT name FROM sqlite_master WHERE name LIKE 'defatify_battle_fts%'")
+        present = {name for name, in cursor.fetchall()}
+        missing = [statement for name, statement in SQLITE_BATTLE_FTS_TRIGGERS.items() if name not in present]
+        # Without the table, migrations are unapplied past 0012 and there is nothing to restore
+        if SQLITE_BATTLE_FTS not in present or not missing:
+            return
+        for statement in missing:
+            cursor.execute(statement)
+        cursor.execute(f"INSERT INTO {SQLITE_BATTLE_FTS}({SQLITE_BATTLE_FTS}) VALUES ('rebuild')")
+
+
+def search_terms(query):
+    return re.findall(r'\w+', query.lower())
+
+
+def search_battles(queryset, query):
+    """
+    Filter `queryset` (of Battle) to battles matching every word of `query`,
+    each word also matching as a prefix, best matches first.
+    """
+    terms = search_terms(query)
+    if not terms:
+        return queryset.order_by('-created_at', '-id')
+
+    if connection.vendor == 'postgresql':
+        tsquery = ' & '.join(f'{term}:*' for term in terms)
+        pattern = '%' + re.sub(r'([\\%_])', r'\\\1', query) + '%'
+        matches = RawSQL(
+            f"{PG_BATTLE_VECTOR} @@ to_tsquery('simple', %s) OR name ILIKE %s",
+            (tsquery, pattern), output_field=BooleanField(),
+        )
+        rank = RawSQL(
+            f"ts_rank({PG_BATTLE_VECTOR}, to_tsquery('simple', %s)) + similarity(name, %s)",
+            (tsquery, query), output_field=FloatField(),
+        )
+        return queryset.filter(matches).annotate(search_rank=rank).order_by('-search_rank', '-id')
+
+    if connection.vendor == 'sqlite':
+        match = ' '.join(f'"{term}"*' for term in terms)
+        matching_ids = RawSQL(f'SELECT rowid FROM {SQLITE_BATTLE_FTS} WHERE {SQLITE_BATTLE_FTS} MATCH %s', (match,))
+        # bm25 is lower-is-better; negate it so every backend ranks descending
+        rank = RawSQL(
+            f'SELECT -{SQLITE_BM25} FROM {SQLITE_BATTLE_FTS} '
+            f'WHERE {SQLITE_BATTLE_FTS} MATCH %s AND {SQLITE_BATTLE_FTS}.rowid = defatify_battle.id',
+            (match,), output_field=FloatField(),
+        )
+        return queryset.filter(id__in=matching_ids).annotate(search_rank=rank).order_by('-search_rank', '-id')
+
+    return queryset.filter(Q(name__icontains=query) | Q(description__icontains=query)).order_by('-created_at', '-id')
+
+
+# Username search. PostgreSQL ranks matches in the database on the indexes of
+# migrations 0013 and 0017. SQLite, for development only, answers from the
+# in-process UsernameIndex below, whose substring pass scans every username.
+# Either way the first USER_SEARCH_LIMIT ranked ids of a viewer's recent
+# queries sit in a short-lived LRU cache, so a friend-search box firing on
+# every keystroke mostly skips the lookup. A query matching more users than
+# that is ranked and paginated in the database instead, so no page is cut off.
+
+# Ids kept per cached query
+USER_SEARCH_LIMIT = 50
+USER_SEARCH_CACHE_TTL = 30
+
+
+class UsernameIndex:
+    """
+    Development stand-in for the PostgreSQL indexes, used on SQLite only.
+    Lowercased usernames kept sorted next to their user ids, so prefix matches
+    are a binary search; substring matches are a linear scan of every name. Kept current by the User signals of this process and
+    rebuilt from the database every `rebuild_interval` seconds to pick up
+    users registered through other processes.
+    """
+
+    def __init__(self, rebuild_interval=300):
+        self.rebuild_interval = rebuild_interval
+        self._names = None
+        self._ids = None
+        self._built_at = 0
+        self._lock = threading.Lock()
+
+    def _ensure_built(self):
+        if self._names is not None and time.monotonic() - self._built_at < self.rebuild_interval:
+            return
+        entries = sorted((username.lower(), user_id) for user_id, username in User.objects.values_list('id', 'username'))
+        self._names = [name for name, _ in entries]
+        self._ids = [user_id for _, user_id in entries]
+        self._built_at = time.monotonic()
+
+    def _remove(self, user_id):
+        try:
+            position = self._ids.index(user_id)
+        except ValueError:
+            return
+        del self._names[position]
+        del self._ids[position]
+
+    def update(self, user_id, username):
+        with self._lock:
+            if self._names is None:
+                return
+            self._remove(user_id)
+            name = username.lower()
+            position = bisect_left(self._names, name)
+            self._names.insert(position, name)
+            self._ids.insert(position, user_id)
+
+    def discard(self, user_id):
+        with self._lock:
+            if self._names is not None:
+                self._remove(user_id)
+
+    def clear(self):
+        with self._lock:
+            self._names = self._ids = None
+
+    def search(self, query, limit=USER_SEARCH_LIMIT, exclude_id=None):
+        """
+        Ids of users whose username contains `query`, other than `exclude_id`:
+        exact match, then prefix, then substring matches.
+        """
+        query = query.lower()
+        with self._lock:
+            self._ensure_built()
+            names, ids = self._names, self._ids
+            # Everything starting with the query sits in one run, the exact match first
+            position, matches = bisect_left(names, query), []
+            while position < len(names) and len(matches) < limit and names[position].startswith(query):
+                if ids[position] != exclude_id:
+                    matches.append(ids[position])
+                position += 1
+            if len(matches) < limit:
+                for name, user_id in zip(names, ids):
+                    if query in name and not name.startswith(query) and user_id != exclude_id:
+                        matches.append(user_id)
+                        if len(matches) == limit:
+                            break
+        return matches
+
+
+username_index = UsernameIndex()
+_user_search_results = TTLCache(ttl=USER_SEARCH_CACHE_TTL)
+
+
+def ranked_users(query):
+    """Users whose username contains `query`: exact match, then prefix, then substring matches."""
+    match_rank = Case(
+        When(username__iexact=query, then=0),
+        When(username__istartswith=query, then=1),
+        default=2, output_field=IntegerField(),
+    )
+    return (User.objects.filter(username__icontains=query).annotate(match_rank=match_rank)
+            .order_by('match_rank', Lower('username'), 'id'))
+
+
+def _db_user_ids(query, limit=USER_SEARCH_LIMIT, exclude_id=None):
+    users = ranked_users(query)
+    if exclude_id is not None:
+        users = users.exclude(id=exclude_id)
+    return list(users.values_list('id', flat=True)[:limit])
+
+
+def matching_user_ids(query, limit=USER_SEARCH_LIMIT, exclude_id=None):
+    """
+    Ranked ids of the users matching `query` other than `exclude_id` (the
+    viewer, so a full page holds `limit` others), from the result cache when recent.
+    """
+    key = (query.lower(), limit, exclude_id)
+    user_ids = _user_search_results.get(key)
+    if user_ids is None:
+        if connection.vendor == 'sqlite':
+            user_ids = username_index.search(query, limit, exclude_id)
+        else:
+            user_ids = _db_user_ids(query, limit, exclude_id)
+        _user_search_results.set(key, user_ids)
+    return user_ids
+
+
+def forget_user_search(user_id=None, username=None):
+    """Drop cached results after a user was added, renamed or deleted (`username` None)."""
+    _user_search_results.clear()
+    if user_id is None:
+        username_index.clear()
+    elif username is None:
+        username_index.discard(user_id)
+    else:
+        username_index.update(user_id, username)
+
+
+def search_users(viewer, query):
+    """
+    Users other than `viewer` matching `query`, best matches first, annotated
+    with the viewer's friendship and pending friend requests in the same query.
+    """
+    query = query.strip()
+    users = User.objects.exclude(id=viewer.id).only('id', 'username')
+    if query:
+        user_ids = matching_user_ids(query, USER_SEARCH_LIMIT, exclude_id=viewer.id)
+        if len(user_ids) >= USER_SEARCH_LIMIT:
+            # There may be more: rank them all, and let the paginator count and slice
+            users = ranked_users(query).exclude(id=viewer.id).only('id', 'username')
+        elif user_ids:
+            users = users.filter(id__in=user_ids).order_by(
+                Case(*[When(id=user_id, then=position) for position, user_id in enumerate(user_ids)], output_field=IntegerField())
+            )
+        else:
+            users = users.none()
+    else:
+        users = users.order_by(Lower('username'), 'id')
+
+    pending = FriendRequest.objects.filter(status='pending')
+    return users.annotate(
+        is_friend=Exists(Friendship.objects.filter(user=viewer, friend=OuterRef('pk'))),
+        request_sent=Exists(pending.filter(from_user=viewer, to_user=OuterRef('pk'))),
+        request_received=Exists(pending.filter(from_user=OuterRef('pk'), to_user=viewer)),
+    )
@@ -1,146 +1,327 @@
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.functional import cached_property
 from rest_framework import serializers
+from rest_framework.exceptions import ParseError
 from .models import Profile, WeightStat, FriendRequest, Friendship, Battle, BattleStatistic, BattleInvitation
 from django.contrib.auth.models import User
-from .utils import convert_kg_to_lb
-from decimal import Decimal
+from .utils import UnitConverter
+from .metrics import serializing
 
-class ProfileSerializer(serializers.ModelSerializer):
+class MeasuredSerializerMixin:
+    """Counts building .data as serializer time of the current request (metrics.py)."""
+    @property
+    def data(self):
+        with serializing():
+            return super().data
+
+class MeasuredListSerializer(MeasuredSerializerMixin, serializers.ListSerializer):
+    """The list_serializer_class of measured serializers, so many=True results are timed too."""
+
+class UnitListSerializer(MeasuredListSerializer):
+    """Serializes every row first, then converts the kilogram columns of the whole list in one pass."""
+    def to_representation(self, data):
+        rows = super().to_representation(data)
+        if self.child.converts_units:
+            self.child.units.convert_rows(rows, self.child.unit_fields, self.child.unit_stat_field)
+        return rows
+
+class UnitConversionMixin:
+    """Unit handling shared by every serializer that returns kilogram values."""
+    unit_fields = ()  # Representation keys holding kilograms
+    unit_stat_field = None  # If set, only rows whose stat is 'weight' hold kilograms
+
+    @property
+    def units(self):
+        return UnitConverter.for_request(self.context['request'])
+
+    @property
+    def converts_units(self):
+        # A sparse fieldset may keep no kilogram field, and then needs no unit preference
+        return any(name in self.fields for name in self.unit_fields)
+
+    def to_representation(self, instance):
+        representation = super().to_representation(instance)
+        # Lists are converted by UnitListSerializer once all rows are built
+        if self.converts_units and not isinstance(self.parent, UnitListSerializer):
+            self.units.convert_rows([representation], self.unit_fields, self.unit_stat_field)
+        return representation
+
+def _names(value):
+    return {name.strip() for name in value.split(',') if name.strip()} if value else set()
+
+_readable_fields = {}
+
+def readable_fields(serializer_class):
+    """Names of the fields `serializer_class` outputs, in declaration order."""
+    if serializer_class not in _readable_fields:
+        _readable_fields[serializer_class] = tuple(
+            name for name, field in serializer_class().fields.items() if not field.write_only)
+    return _readable_fields[serializer_class]
+
+def sparse_fields(request, serializer_class):
+    """
+    The fields of `serializer_class` a request keeps with `?fields=` and/or
+    `?exclude=` (comma-separated names), in declaration order and together
+    with the fields their units depend on; None when it keeps them all.
+    """
+    requested = _names(request.query_params.get('fields'))
+    excluded = _names(request.query_params.get('exclude'))
+    if not requested and not excluded:
+        return None
+    available = readable_fields(serializer_class)
+    unknown = (requested | excluded).difference(available)
+    if unknown:
+        raise ParseError(f'Unknown fields: {", ".join(sorted(unknown))}. Available: {", ".join(available)}.')
+    kept = {name for name in available if (not requested or name in requested) and name not in excluded}
+    dependencies = getattr(serializer_class, 'field_dependencies', {})
+    for name in list(kept):
+        kept.update(dependencies.get(name, ()))
+    return tuple(name for name in available if name in kept)
+
+class SparseFieldsMixin:
+    """
+    Takes `fields`, the names returned by sparse_fields(), and serializes only
+    those. Querysets are built for the same names (see BattleQuerySet), so the
+    dropped fields are never fetched either.
+    """
+    # Fields kept whenever the key is kept: the key's units depend on them
+    field_dependencies = {}
+
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields).difference(fields):
+                self.fields.pop(name)
+
+class RowSerializer:
+    """
+    Fast read path for flat list shapes. The fields of `serializer_class` are
+    compiled once into columns and converters; rows are then fetched as tuples
+    with values_list() and zipped into dicts, with no model instances and no
+    per-row field machinery. The output equals serializer_class(many=True).data.
+    """
+    # Fields whose database values already are their representation
+    passthrough_fields = (
+        serializers.ReadOnlyField, serializers.CharField, serializers.IntegerField,
+        serializers.BooleanField, serializers.ChoiceField, serializers.PrimaryKeyRelatedField,
+    )
+    _instances = {}
+
+    def __init__(self, serializer_class):
+        self.serializer_class = serializer_class
+        self._plans = {}
+        self.unit_fields = getattr(serializer_class, 'unit_fields', ())
+        self.unit_stat_field = getattr(serializer_class, 'unit_stat_field', None)
+
+    @classmethod
+    def for_class(cls, serializer_class):
+        """The shared, compiled-once instance for `serializer_class`."""
+        if serializer_class not in cls._instances:
+            cls._instances[serializer_class] = cls(serializer_class)
+        return cls._instances[serializer_class]
+
+    @cached_property
+    def plan(self):
+        """(names, values_list columns, (name, converter) of fields needing conversion)."""
+        names, columns, converters = [], [], []
+        for name, field in self.serializer_class().fields.items():
+            if field.write_only:
+                continue
+            if field.source == '*' or isinstance(field, (serializers.SerializerMethodField, serializers.BaseSerializer,
+                                                         serializers.ManyRelatedField)):
+                raise ImproperlyConfigured(f'{self.serializer_class.__name__}.{name} is not a flat column.')
+            names.append(name)
+            columns.append('__'.join(field.source_attrs))
+            if not isinstance(field, self.passthrough_fields):
+                converters.append((name, field.to_representation))
+        return names, columns, converters
+
+    def plan_for(self, fields=None):
+        """`plan` limited to the field names `fields` (None for all of them)."""
+        if fields is None:
+            return self.plan
+        fields = tuple(fields)
+        if fields not in self._plans:
+            names, columns, converters = self.plan
+            kept = [index for index, name in enumerate(names) if name in fields]
+            self._plans[fields] = (
+                [names[index] for index in kept],
+                [columns[index] for index in kept],
+                [(name, convert) for name, convert in converters if name in fields],
+            )
+        return self._plans[fields]
+
+    def rows(self, queryset, fields=None, extra=()):
+        """
+        `queryset` as named tuples of the columns of `fields`, followed by any
+        `extra` columns not among them, e.g. the ones cursor pagination reads.
+        """
+        columns = self.plan_for(fields)[1]
+        return queryset.values_list(*columns, *(column for column in extra if column not in columns), named=True)
+
+    def serialize(self, rows, units=None, fields=None):
+        names, _, converters = self.plan_for(fields)
+        rows = list(rows)  # Fetch first: serializer time excludes the query
+        data = []
+        with serializing():
+            for row in rows:
+                item = dict(zip(names, row))
+                for name, convert in converters:
+                    value = item[name]
+                    if value is not None:
+                        item[name] = convert(value)
+                data.append(item)
+            if units is not None:
+                units.convert_rows(data, self.unit_fields, self.unit_stat_field)
+        return data
+
+class ProfileSerializer(MeasuredSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Profile
         fields = ['bio', 'date_of_birth', 'pronouns', 'unit_preference']
 
-class WeightStatSerializer(serializers.ModelSerializer):
+class WeightStatSerializer(SparseFieldsMixin, UnitConversionMixin, MeasuredSerializerMixin, serializers.ModelSerializer):
     bmi = serializers.DecimalField(max_digits=5, decimal_places=2)
     body_fat = serializers.DecimalField(max_digits=5, decimal_places=2)
     muscle_mass = serializers.DecimalField(max_digits=5, decimal_places=2)
     body_water = serializers.DecimalField(max_digits=5, decimal_places=2)
     bone_mass = serializers.DecimalField(max_digits=5, decimal_places=2)
 
+    unit_fields = ('weight',)
+
     class Meta:
         model = WeightStat
         fields = ['id', 'date', 'weight', 'bmi', 'body_fat', 'muscle_mass', 'body_water', 'bone_mass']
         read_only_fields = ['date']
-    
-    def to_representation(self, instance):
-        """Convert units in the response based on user's preference."""
-        representation = super().to_representation(instance)
-        
-        # Convert weight to imperial if the user preference is imperial
-        unit_preference = self.context['request'].user.profile.unit_preference
-        if unit_preference == 'imperial' and instance.weight is not None:
-            representation['weight'] = convert_kg_to_lb(instance.weight)
-        
-        return representation
+        list_serializer_class = UnitListSerializer
+
+class WeightStatBulkItemSerializer(WeightStatSerializer):
+    """A single reading of a bulk upload; the client supplies the timestamp."""
+    date = serializers.DateTimeField()
+
+class WeightStatImportSerializer(serializers.ModelSerializer):
+    """A CSV row of an import: a timestamp and any stats, each checked against its model column."""
+    date = serializers.DateTimeField()
+
+    class Meta:
+        model = WeightStat
+        fields = ['date', 'weight', 'bmi', 'body_fat', 'muscle_mass', 'body_water', 'bone_mass']
 
-class FriendRequestSerializer(serializers.ModelSerializer):
+class FriendRequestSerializer(SparseFieldsMixin, MeasuredSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = FriendRequest
         fields = ['id', 'from_user', 'to_user', 'status', 'timestamp']
         read_only_fields = ['status', 'timestamp']
+        list_serializer_class = MeasuredListSerializer
 
-class FriendshipSerializer(serializers.ModelSerializer):
+class FriendshipSerializer(SparseFieldsMixin, MeasuredSerializerMixin, serializers.ModelSerializer):
     friend_username = serializers.CharField(source='friend.username', read_only=True)
 
     class Meta:
         model = Friendship
         fields = ['id', 'friend', 'friend_username', 'created_at']
+        list_serializer_class = MeasuredListSerializer
+
+class UserSearchSerializer(MeasuredSerializerMixin, serializers.ModelSerializer):
+    is_friend = serializers.ReadOnlyField()
+    friend_request = serializers.SerializerMethodField()
 
-class UserSearchSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
-        fields = ['id', 'username']
+        fields = ['id', 'username', 'is_friend', 'friend_request']
+        list_serializer_class = MeasuredListSerializer
+
+    def get_friend_request(self, obj):
+        # Pending request between the viewer and this user, annotated by search_users
+        if obj.request_sent:
+            return 'sent'
+        if obj.request_received:
+            return 'received'
+        return None
 
-class BattleSerializer(serializers.ModelSerializer):
+class BattleSerializer(SparseFieldsMixin, UnitConversionMixin, MeasuredSerializerMixin, serializers.ModelSerializer):
     creator = serializers.ReadOnlyField(source='creator.username')
     participants = serializers.StringRelatedField(many=True, read_only=True)
     winner_id = serializers.ReadOnlyField(source='winner.id')
     winner_name = serializers.ReadOnlyField(source='winner.username')
 
+    unit_fields = ('goal_value',)
+    unit_stat_field = 'weight_param'
+    field_dependencies = {'goal_value': ('weight_param',)}
+
     class Meta:
         model = Battle
         fields = [
             'id', 'name', 'description', 'creator', 'type', 'weight_param', 
             'goal_value', 'duration', 'is_private', 'status', 'created_at', 'deleted_at',
-            'participants', 'winner_id', 'winner_name'
+            'participants', 'participant_count', 'winner_id', 'winner_name'
         ]
-        read_only_fields = ['id', 'status', 'created_at', 'participants', 'winner_id', 'winner_name', 'deleted_at']
+        read_only_fields = ['id', 'status', 'created_at', 'participants', 'participant_count', 'winner_id', 'winner_name', 'deleted_at']
+        list_serializer_class = UnitListSerializer
 
-  
     def to_representation(self, instance):
         """Convert goal_value based on user's unit preference."""
         representation = super().to_representation(instance)
-        
-        # Check the user's unit preference
-        unit_preference = self.context['request'].user.profile.unit_preference
 
-        # Convert goal_value to lbs if the user prefers imperial units
-        if unit_preference == 'imperial' and instance.weight_param == 'weight':
-            representation['goal_value'] = Decimal(convert_kg_to_lb(instance.goal_value))
-        elif instance.weight_param == 'weight':
-            # Ensure goal_value is returned as Decimal for metric users
-            representation['goal_value'] = Decimal(instance.goal_value)
+        # Weight goals of metric users are returned as Decimal, like converted ones
+        if 'goal_value' in representation and instance.weight_param == 'weight' and instance.goal_value is not None and not self.units.imperial:
+            representation['goal_value'] = instance.goal_value
 
         return representation
 
-class BattleStatisticSerializer(serializers.ModelSerializer):
+class BattleListSerializer(BattleSerializer):
+    """
+    Battle rows of list endpoints: `participant_count` and the first few
+    names (Battle.objects.for_list()) instead of every participant.
+    """
+    participants_preview = serializers.SerializerMethodField()
+
+    class Meta(BattleSerializer.Meta):
+        fields = [
+            'id', 'name', 'description', 'creator', 'type', 'weight_param',
+            'goal_value', 'duration', 'is_private', 'status', 'created_at', 'deleted_at',
+            'participant_count', 'participants_preview', 'winner_id', 'winner_name'
+        ]
+
+    def get_participants_preview(self, obj):
+        return [user.username for user in obj.participant_preview]
+
+class BattleStatisticSerializer(UnitConversionMixin, MeasuredSerializerMixin, serializers.ModelSerializer):
     user = serializers.ReadOnlyField(source='user.username')
-    starting_value = serializers.SerializerMethodField()
-    current_value = serializers.SerializerMethodField()
+    starting_value = serializers.ReadOnlyField()
+    current_value = serializers.ReadOnlyField()
+
+    unit_fields = ('starting_value', 'current_value')
+    unit_stat_field = 'stat_type'
 
     class Meta:
         model = BattleStatistic
         fields = ['user', 'stat_type', 'starting_value', 'current_value']
+        list_serializer_class = UnitListSerializer
 
-    def get_starting_value(self, obj):
-        unit_preference = self.context['request'].user.profile.unit_preference
-        value = obj.starting_value
-        if obj.stat_type == 'weight' and unit_preference == 'imperial':
-            return convert_kg_to_lb(value)
-        return value
-
-    def get_current_value(self, obj):
-        unit_preference = self.context['request'].user.profile.unit_preference
-        value = obj.current_value
-        if obj.stat_type == 'weight' and unit_preference == 'imperial':
-            return convert_kg_to_lb(value)
-        return value
-
-class LeaderboardSerializer(serializers.ModelSerializer):
+class LeaderboardSerializer(SparseFieldsMixin, UnitConversionMixin, MeasuredSerializerMixin, serializers.ModelSerializer):
+    """Serializes rows of BattleStatistic.objects.ranked()."""
     user = serializers.ReadOnlyField(source='user.username')
-    progress = serializers.SerializerMethodField()
-    starting_value = serializers.SerializerMethodField()
-    current_value = serializers.SerializerMethodField()
+    rank = serializers.IntegerField(read_only=True)
+    progress = serializers.ReadOnlyField()
+    starting_value = serializers.ReadOnlyField()
+    current_value = serializers.ReadOnlyField()
+
+    unit_fields = ('starting_value', 'current_value', 'progress')
+    unit_stat_field = 'stat_type'
+    field_dependencies = {name: ('stat_type',) for name in unit_fields}
 
     class Meta:
         model = BattleStatistic
-        fields = ['user', 'stat_type', 'starting_value', 'current_value', 'progress']
-
-    def get_starting_value(self, obj):
-        unit_preference = self.context['request'].user.profile.unit_preference
-        value = obj.starting_value
-        if obj.stat_type == 'weight' and unit_preference == 'imperial':
-            return convert_kg_to_lb(value)
-        return value
-
-    def get_current_value(self, obj):
-        unit_preference = self.context['request'].user.profile.unit_preference
-        value = obj.current_value
-        if obj.stat_type == 'weight' and unit_preference == 'imperial':
-            return convert_kg_to_lb(value)
-        return value
-
-    def get_progress(self, obj):
-        unit_preference = self.context['request'].user.profile.unit_preference
-        progress = obj.current_value - obj.starting_value
-        if obj.stat_type == 'weight' and unit_preference == 'imperial':
-            return convert_kg_to_lb(progress)
-        return progress
+        fields = ['rank', 'user', 'stat_type', 'starting_value', 'current_value', 'progress']
+        list_serializer_class = UnitListSerializer
     
-class BattleInvitationSerializer(serializers.ModelSerializer):
+class BattleInvitationSerializer(SparseFieldsMixin, MeasuredSerializerMixin, serializers.ModelSerializer):
     inviting_user = serializers.ReadOnlyField(source='inviting_user.username')
     battle_name = serializers.ReadOnlyField(source='battle.name')
 
     class Meta:
         model = BattleInvitation
         fields = ['id', 'battle', 'battle_name', 'invited_user', 'inviting_user', 'status', 'created_at']
-        read_only_fields = ['status', 'created_at']
\ No newline at end of file
+        read_only_fields = ['status', 'created_at']
+        list_serializer_class = MeasuredListSerializer
\ No newline at end of file
@@ -1,9 +1,16 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete, m2m_changed
 from django.dispatch import receiver
 from django.contrib.auth.models import User
-from .models import Profile, WeightStat, BattleStatistic, Battle, BattleInvitation
-from django.utils import timezone
-from datetime import timedelta
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken
+from .models import Profile, WeightStat, Battle, BattleStatistic, BattleInvitation
+from .cache import invalidate_battles
+from .rollups import invalidate_rollups, touches_closed_buckets
+from .jobs import battle_update_queue
+from .search import forget_user_search
+from .live import leaderboards_changed
+from .authentication import user_claims_changed
+from .blacklist import bump_blacklist_generation
+from .popular import add_participant_counts, recount_participants, battles_changed
 
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
@@ -14,58 +21,98 @@ def create_user_profile(sender, instance, created, **kwargs):
 def save_user_profile(sender, instance, **kwargs):
     instance.profile.save()
 
-@receiver(post_save, sender=WeightStat)
-def update_battle_statistic(sender, instance, created, **kwargs):
+@receiver(post_save, sender=User)
+def reindex_username(sender, instance, update_fields=None, **kwargs):
+    # Logins save last_login only; anything else may have changed the username
+    if update_fields is None or 'username' in update_fields:
+        forget_user_search(instance.id, instance.username)
+
+@receiver(post_save, sender=Profile)
+def expire_user_claims(sender, instance, created, update_fields=None, **kwargs):
+    # Saving a user saves its profile too, so this covers username changes
+    if not created and (update_fields is None or 'unit_preference' in update_fields):
+        user_claims_changed(instance.user_id)
+
+@receiver(post_save, sender=User)
+def expire_user_claims_on_user_change(sender, instance, created, update_fields=None, **kwargs):
+    # Deactivation and password changes must reach tokens issued before them
+    if not created and (update_fields is None or {'username', 'is_active', 'password'} & set(update_fields)):
+        user_claims_changed(instance.id)
+
+@receiver(post_delete, sender=User)
+def expire_deleted_user_claims(sender, instance, **kwargs):
+    # Writes through a deleted user's token would fail on its foreign keys
+    user_claims_changed(instance.id)
+
+@receiver(post_save, sender=BlacklistedToken)
+def count_blacklisted_token(sender, instance, created, **kwargs):
+    # Every way of blacklisting saves the row, so every process's filter hears of it
     if created:
-        # Get all in-progress battles for this user
-        active_battles = BattleStatistic.objects.filter(user=instance.user, battle__status='in_progress')
-
-        for battle_stat in active_battles:
-            if battle_stat.stat_type == 'weight' and instance.weight is not None:
-                battle_stat.current_value = instance.weight
-            elif battle_stat.stat_type == 'bmi' and instance.bmi is not None:
-                battle_stat.current_value = instance.bmi
-            elif battle_stat.stat_type == 'body_fat' and instance.body_fat is not None:
-                battle_stat.current_value = instance.body_fat
-            elif battle_stat.stat_type == 'muscle_mass' and instance.muscle_mass is not None:
-                battle_stat.current_value = instance.muscle_mass
-            elif battle_stat.stat_type == 'body_water' and instance.body_water is not None:
-                battle_stat.current_value = instance.body_water
-            elif battle_stat.stat_type == 'bone_mass' and instance.bone_mass is not None:
-                battle_stat.current_value = instance.bone_mass
-
-            # Save the updated BattleStatistic
-            battle_stat.save()
+        bump_blacklist_generation()
+
+@receiver(post_delete, sender=User)
+def unindex_username(sender, instance, **kwargs):
+    forget_user_search(instance.id)
 
 @receiver(post_save, sender=WeightStat)
-def check_battle_completion(sender, instance, **kwargs):
-    user = instance.user
-    battles = Battle.objects.filter(
-        participants=user,
-        status='in_progress'
-    )
-
-    for battle in battles:
-        if battle.type == 'stat_goal':
-            # Check if the user's current stat has reached or exceeded the goal
-            current_value = getattr(instance, battle.weight_param)
-            if current_value is not None and current_value >= battle.goal_value:
-                battle.status = 'finished'
-                battle.winner = user  # Set the user as the winner
-                battle.save()
-        
-        elif battle.type == 'duration':
-            # Check if the duration has expired
-            end_date = battle.created_at + timedelta(days=battle.duration)
-            if timezone.now() >= end_date:
-                # Determine the winner based on the highest progress in the stat parameter
-                top_stat = BattleStatistic.objects.filter(battle=battle).order_by('-current_value').first()
-                if top_stat:
-                    battle.winner = top_stat.user
-                battle.status = 'finished'
-                battle.save()
+def update_battles_on_weight_stat(sender, instance, created, **kwargs):
+    # Starting values, current values and battle completion for every battle
+    # the user is in are refreshed in one set-based pass, off the request path
+    battle_update_queue.enqueue(instance.user_id, created=created)
+
+@receiver(post_save, sender=WeightStat)
+@receiver(post_delete, sender=WeightStat)
+def invalidate_weight_rollups(sender, instance, created=False, **kwargs):
+    # A fresh reading only lands in today's open buckets, which are never cached
+    if not created or touches_closed_buckets(instance.date):
+        invalidate_rollups([instance.user_id])
 
 @receiver(post_save, sender=Battle)
 def delete_invitations_on_battle_status_change(sender, instance, **kwargs):
     if instance.status in ['deleted', 'finished']:
-        BattleInvitation.objects.filter(battle=instance).delete()
\ No newline at end of file
+        BattleInvitation.objects.filter(battle=instance).delete()
+
+# Battle.participant_count and the popular feed
+@receiver(post_save, sender=Battle)
+@receiver(post_delete, sender=Battle)
+def refresh_popular_feed(sender, instance, **kwargs):
+    # Status and visibility decide what the feed may show
+    battles_changed()
+
+@receiver(m2m_changed, sender=Battle.participants.through)
+def update_participant_count(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'post_add':
+        # pk_set holds only the rows actually inserted, so the increment is exact
+        if reverse:
+            add_participant_counts(pk_set, 1)
+        else:
+            add_participant_counts([instance.id], len(pk_set))
+    elif action == 'post_remove':
+        # pk_set may name users who were not participants; count what is left
+        recount_participants(pk_set if reverse else [instance.id])
+    elif action == 'pre_clear' and reverse:
+        instance._cleared_battle_ids = list(instance.battles.values_list('id', flat=True))
+    elif action == 'post_clear':
+        recount_participants(instance.__dict__.pop('_cleared_battle_ids', []) if reverse else [instance.id])
+
+# Cached battle detail/leaderboard responses
+@receiver(post_save, sender=Battle)
+@receiver(post_delete, sender=Battle)
+def invalidate_battle_cache(sender, instance, **kwargs):
+    invalidate_battles([instance.id])
+
+@receiver(post_save, sender=BattleStatistic)
+@receiver(post_delete, sender=BattleStatistic)
+def invalidate_battle_statistic_cache(sender, instance, **kwargs):
+    invalidate_battles([instance.battle_id])
+    leaderboards_changed([instance.battle_id])
+
+@receiver(m2m_changed, sender=Battle.participants.through)
+def invalidate_participants_cache(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            invalidate_battles([instance.id])
+    elif action in ('post_add', 'post_remove'):
+        invalidate_battles(pk_set)
+    elif action == 'pre_clear':
+        invalidate_battles(instance.battles.values_list('id', flat=True))
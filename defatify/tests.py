@@ -1,3 +1,1701 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import re
+import tempfile
+from unittest import mock
+from datetime import datetime, timedelta, timezone as dt_timezone
+from io import StringIO
+from decimal import Decimal
+from asgiref.sync import async_to_sync, sync_to_async
+from django.test import TestCase, TransactionTestCase, AsyncClient, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import connection, OperationalError
+from django.contrib.auth.models import User
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.urls import reverse
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from rest_framework import serializers
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient, APIRequestFactory, force_authenticate
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+from rest_framework_simplejwt.tokens import RefreshToken, AccessToken
+from rest_framework_simplejwt.token_blacklist.models import OutstandingToken, BlacklistedToken
+from .benchmarks import endpoints as endpoints_benchmark, export as export_benchmark
+from .benchmarks.endpoints import Meter
+from . import metrics
+from .battle_updates import sweep_expired_battles, sync_user_battles
+from .jobs import BattleUpdateQueue
+from .checks import check_shared_cache
+from .blacklist import BloomFilter, blacklist_filter
+from .authentication import access_token_for
+from .live import (
+    hub as live_hub, Subscriber, RESYNC, LIVE_QUEUE_SIZE, leaderboard_rows, aleaderboard_version, as_state,
+)
+from .search import restore_battle_fts_triggers, forget_user_search, matching_user_ids, username_index, _db_user_ids
+from .serializers import ProfileSerializer, RowSerializer, WeightStatSerializer, FriendshipSerializer, FriendRequestSerializer, BattleInvitationSerializer, UserSearchSerializer
+from .views import WeightStatImportView
+from .models import Profile, WeightStat, FriendRequest, Friendship, Battle, BattleStatistic, BattleInvitation
 
-# Create your tests here.
+
+def make_battles(user, count, **fields):
+    """Bulk-create `count` battles the user takes part in, each with a BattleStatistic."""
+    fields.setdefault('type', 'stat_goal')
+    fields.setdefault('weight_param', 'weight')
+    fields.setdefault('goal_value', Decimal('50.00'))
+    fields.setdefault('participant_count', 1)
+    battles = Battle.objects.bulk_create([
+        Battle(name=f'Battle {i}', creator=user, **fields) for i in range(count)
+    ])
+    Battle.participants.through.objects.bulk_create([
+        Battle.participants.through(battle=battle, user=user) for battle in battles
+    ])
+    BattleStatistic.objects.bulk_create([
+        BattleStatistic(battle=battle, user=user, stat_type=battle.weight_param,
+                        starting_value=Decimal('90.00'), current_value=Decimal('90.00'))
+        for battle in battles
+    ])
+    return battles
+
+
+class BattleFanOutTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='scale_user')
+
+    def queries_for_reading(self, battle_count):
+        user = User.objects.create(username=f'user_{battle_count}')
+        make_battles(user, battle_count, status='not_started')
+        make_battles(user, battle_count, status='in_progress')
+        make_battles(user, battle_count, status='in_progress', type='duration', goal_value=None, duration=30)
+        with CaptureQueriesContext(connection) as ctx:
+            WeightStat.objects.create(user=user, weight=Decimal('88.50'))
+        return len(ctx)
+
+    def test_query_count_is_flat_in_battle_count(self):
+        self.assertEqual(self.queries_for_reading(1), self.queries_for_reading(500))
+
+    def test_not_started_battles_take_the_reading_as_starting_value(self):
+        battle = make_battles(self.user, 1, status='not_started')[0]
+        WeightStat.objects.create(user=self.user, weight=Decimal('85.20'))
+
+        stat = BattleStatistic.objects.get(battle=battle, user=self.user)
+        self.assertEqual(stat.starting_value, Decimal('85.20'))
+        self.assertEqual(stat.current_value, Decimal('85.20'))
+
+    def test_missing_not_started_statistic_is_created(self):
+        battle = Battle.objects.create(name='Fresh', creator=self.user, type='stat_goal',
+                                       weight_param='body_fat', goal_value=Decimal('30.00'))
+        battle.participants.add(self.user)
+        WeightStat.objects.create(user=self.user, body_fat=Decimal('22.00'))
+
+        stat = BattleStatistic.objects.get(battle=battle, user=self.user)
+        self.assertEqual(stat.stat_type, 'body_fat')
+        self.assertEqual(stat.starting_value, Decimal('22.00'))
+
+    def test_in_progress_battles_only_move_current_value(self):
+        battle = make_battles(self.user, 1, status='in_progress')[0]
+        WeightStat.objects.create(user=self.user, weight=Decimal('87.00'), body_fat=Decimal('20.00'))
+
+        stat = BattleStatistic.objects.get(battle=battle, user=self.user)
+        self.assertEqual(stat.starting_value, Decimal('90.00'))
+        self.assertEqual(stat.current_value, Decimal('87.00'))
+
+    def test_reaching_goal_finishes_battle_and_drops_invitations(self):
+        battle = make_battles(self.user, 1, status='in_progress', goal_value=Decimal('80.00'))[0]
+        other = User.objects.create(username='invitee')
+        BattleInvitation.objects.create(battle=battle, invited_user=other, inviting_user=self.user)
+        WeightStat.objects.create(user=self.user, weight=Decimal('79.00'))
+
+        battle.refresh_from_db()
+        self.assertEqual(battle.status, 'finished')
+        self.assertEqual(battle.winner, self.user)
+        self.assertFalse(BattleInvitation.objects.filter(battle=battle).exists())
+
+    def test_goals_are_reached_in_the_battle_direction(self):
+        weight, muscle = make_battles(self.user, 2, status='in_progress', goal_value=Decimal('80.00'))
+        Battle.objects.filter(id=muscle.id).update(weight_param='muscle_mass')
+        BattleStatistic.objects.filter(battle=muscle).update(stat_type='muscle_mass')
+        # Gaining weight or losing muscle wins nothing
+        WeightStat.objects.create(user=self.user, weight=Decimal('95.00'), muscle_mass=Decimal('40.00'))
+        self.assertEqual(set(Battle.objects.values_list('status', flat=True)), {'in_progress'})
+
+        WeightStat.objects.create(user=self.user, weight=Decimal('80.00'), muscle_mass=Decimal('80.00'))
+        self.assertEqual(dict(Battle.objects.values_list('id', 'winner_id')), {weight.id: self.user.id, muscle.id: self.user.id})
+
+    def test_expired_duration_battle_is_left_to_the_sweeper(self):
+        battle = make_battles(self.user, 1, status='in_progress', type='duration', goal_value=None, duration=7)[0]
+        Battle.objects.filter(id=battle.id).update(created_at=timezone.now() - timedelta(days=8))
+        WeightStat.objects.create(user=self.user, weight=Decimal('89.00'))
+
+        battle.refresh_from_db()
+        self.assertEqual(battle.status, 'in_progress')
+
+
+class ExpiredBattleSweepTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='sweeper')
+
+    def expired_battles(self, count, days_ago=8, duration=7):
+        battles = make_battles(self.user, count, status='in_progress', type='duration', goal_value=None, duration=duration)
+        Battle.objects.filter(id__in=[b.id for b in battles]).update(created_at=timezone.now() - timedelta(days=days_ago))
+        return battles
+
+    def test_best_scoring_participant_wins(self):
+        battle = self.expired_battles(1)[0]
+        rival = User.objects.create(username='rival')
+        battle.participants.add(rival)
+        BattleStatistic.objects.create(battle=battle, user=rival, stat_type='weight',
+                                       starting_value=Decimal('95.00'), current_value=Decimal('91.00'))
+        BattleInvitation.objects.create(battle=battle, invited_user=User.objects.create(username='late'),
+                                        inviting_user=self.user)
+
+        self.assertEqual(sweep_expired_battles(), 1)
+        battle.refresh_from_db()
+        self.assertEqual(battle.status, 'finished')
+        self.assertEqual(battle.winner, rival)
+        self.assertFalse(BattleInvitation.objects.filter(battle=battle).exists())
+
+    def test_winner_is_the_best_score_not_the_highest_value(self):
+        weight, muscle, tied = self.expired_battles(3)
+        Battle.objects.filter(id=muscle.id).update(weight_param='muscle_mass')
+        gainer = User.objects.create(username='gainer')
+        for battle in (weight, muscle, tied):
+            battle.participants.add(gainer)
+        # self.user stays at 90.00 in every battle
+        BattleStatistic.objects.bulk_create([
+            BattleStatistic(battle=weight, user=gainer, stat_type='weight',
+                            starting_value=Decimal('90.00'), current_value=Decimal('94.00')),
+            BattleStatistic(battle=muscle, user=gainer, stat_type='muscle_mass',
+                            starting_value=Decimal('90.00'), current_value=Decimal('94.00')),
+            BattleStatistic(battle=tied, user=gainer, stat_type='weight',
+                            starting_value=Decimal('95.00'), current_value=Decimal('95.00')),
+        ])
+
+        sweep_expired_battles(batch_size=2)
+        winners = dict(Battle.objects.values_list('id', 'winner_id'))
+        # Weight battles are won by going down, muscle mass by going up, ties by the lower user id
+        self.assertEqual(winners, {weight.id: self.user.id, muscle.id: gainer.id, tied.id: self.user.id})
+
+    def test_running_and_goal_battles_are_untouched(self):
+        running = self.expired_battles(1, days_ago=3)[0]
+        goal = make_battles(self.user, 1, status='in_progress')[0]
+        Battle.objects.filter(id=goal.id).update(created_at=timezone.now() - timedelta(days=400))
+
+        self.assertEqual(sweep_expired_battles(), 0)
+        self.assertEqual(Battle.objects.filter(id__in=[running.id, goal.id], status='in_progress').count(), 2)
+
+    def test_query_count_is_flat_in_battle_count(self):
+        def queries(count):
+            battle_ids = [b.id for b in self.expired_battles(count)]
+            with CaptureQueriesContext(connection) as ctx:
+                sweep_expired_battles()
+            self.assertEqual(Battle.objects.filter(id__in=battle_ids, status='finished').count(), count)
+            return len(ctx)
+
+        self.assertEqual(queries(1), queries(300))
+
+    def test_command_reports_runtime(self):
+        self.expired_battles(2)
+        out = StringIO()
+        call_command('finish_expired_battles', stdout=out)
+        self.assertIn('Finished 2 expired battles', out.getvalue())
+
+def reading(date, weight='85.00'):
+    return {'date': date, 'weight': weight, 'bmi': '24.00', 'body_fat': '20.00',
+            'muscle_mass': '40.00', 'body_water': '55.00', 'bone_mass': '3.00'}
+
+
+class WeightStatBulkCreateTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='syncer')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.url = reverse('weight_stat_bulk_create')
+
+    def test_reports_each_item(self):
+        WeightStat.objects.create(user=self.user, date=parse_datetime('2024-01-01T08:00:00Z'), weight=Decimal('90.00'))
+        response = self.client.post(self.url, [
+            reading('2024-01-02T08:00:00Z'),
+            reading('2024-01-03T08:00:00Z', weight='1234.56'),
+            reading('2024-01-01T08:00:00Z'),
+            reading('2024-01-04T08:00:00Z'),
+            reading('2024-01-04T08:00:00Z'),
+        ], format='json')
+
+        self.assertEqual(response.status_code, 207)
+        self.assertEqual(response.data['created'], 2)
+        results = response.data['results']
+        self.assertIn('id', results[0])
+        self.assertIn('weight', results[1]['errors'])
+        self.assertIn('date', results[2]['errors'])
+        self.assertIn('id', results[3])
+        self.assertIn('date', results[4]['errors'])
+        self.assertEqual(WeightStat.objects.filter(user=self.user).count(), 3)
+
+    def test_battles_take_the_newest_reading_of_the_batch(self):
+        battle = make_battles(self.user, 1, status='in_progress')[0]
+        response = self.client.post(self.url, [
+            reading('2024-02-03T08:00:00Z', weight='86.00'),
+            reading('2024-02-01T08:00:00Z', weight='88.00'),
+        ], format='json')
+
+        self.assertEqual(response.status_code, 201)
+        stat = BattleStatistic.objects.get(battle=battle, user=self.user)
+        self.assertEqual(stat.current_value, Decimal('86.00'))
+
+    def test_backfill_older_than_history_leaves_battles_alone(self):
+        WeightStat.objects.create(user=self.user, date=parse_datetime('2024-03-01T08:00:00Z'), weight=Decimal('80.00'))
+        battle = make_battles(self.user, 1, status='in_progress')[0]
+        self.client.post(self.url, [reading('2024-01-01T08:00:00Z', weight='99.00')], format='json')
+
+        stat = BattleStatistic.objects.get(battle=battle, user=self.user)
+        self.assertEqual(stat.current_value, Decimal('90.00'))
+
+    def test_rejects_non_list_payload(self):
+        response = self.client.post(self.url, reading('2024-01-01T08:00:00Z'), format='json')
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(BATTLE_UPDATES_EAGER=False)
+class DeferredBattleUpdateTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='queued')
+        self.battle = make_battles(self.user, 1, status='in_progress')[0]
+        self.queue = BattleUpdateQueue(workers=2, delay=0.2)
+        patcher = mock.patch('defatify.signals.battle_update_queue', self.queue)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def current_value(self):
+        return BattleStatistic.objects.get(battle=self.battle, user=self.user).current_value
+
+    def test_posting_a_reading_leaves_battles_to_the_queue(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        with mock.patch.object(self.queue, '_schedule') as schedule:
+            response = client.post(reverse('weight_stat_list_create'), reading('2024-05-01T08:00:00Z', '86.00'))
+        self.assertEqual(response.status_code, 201)
+        schedule.assert_called_once_with(self.user.id, True)
+        self.assertEqual(self.current_value(), Decimal('90.00'))
+
+    def test_a_burst_of_readings_is_applied_once(self):
+        with mock.patch('defatify.jobs.sync_user_battles', wraps=sync_user_battles) as sync:
+            for i in range(10):
+                WeightStat.objects.create(user=self.user, weight=Decimal('89.00') - i, date=timezone.now() + timedelta(minutes=i))
+            self.assertTrue(self.queue.join())
+        sync.assert_called_once_with(self.user.id, created=True)
+        self.assertEqual(self.current_value(), Decimal('80.00'))
+        self.assertEqual((self.queue.stats['queued'], self.queue.stats['coalesced']), (1, 9))
+
+    def test_failed_jobs_are_retried(self):
+        self.queue.delay = 0.01
+        failures = [OperationalError('database is locked')]
+
+        def flaky(user_id, created):
+            if failures:
+                raise failures.pop()
+            return sync_user_battles(user_id, created=created)
+
+        with mock.patch('defatify.jobs.sync_user_battles', flaky), self.assertLogs('defatify.jobs', 'WARNING'):
+            WeightStat.objects.create(user=self.user, weight=Decimal('84.00'))
+            self.assertTrue(self.queue.join())
+        self.assertEqual(self.current_value(), Decimal('84.00'))
+        self.assertEqual((self.queue.stats['retried'], self.queue.stats['completed']), (1, 1))
+
+
+class ColumnarWeightStatTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='charter')
+        Profile.objects.filter(user=self.user).update(unit_preference='imperial')
+        self.user.refresh_from_db()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        start = parse_datetime('2024-04-01T07:30:00.250Z')
+        self.dates = [start + timedelta(days=day, minutes=day % 7) for day in range(150)]
+        WeightStat.objects.bulk_create([
+            WeightStat(user=self.user, date=date, weight=Decimal('80.00'), bmi=Decimal('24.50')) for date in self.dates
+        ])
+
+    def decode_dates(self, columns):
+        moments, moment = [], columns['date_start']
+        for delta in columns['date_deltas']:
+            moment += delta
+            moments.append(datetime.fromtimestamp(moment / 1000, dt_timezone.utc))
+        return moments
+
+    def test_query_param_returns_columns(self):
+        response = self.client.get(reverse('weight_stat_list_create'), {'format': 'columns', 'page_size': 1000})
+        self.assertEqual(response['Content-Type'], 'application/vnd.defatify.columns+json')
+        columns = json.loads(response.content)['results']
+        self.assertEqual(columns['count'], 150)
+        self.assertEqual(self.decode_dates(columns), self.dates[::-1])
+        self.assertEqual((columns['weight'][0], columns['bmi'][0], columns['body_fat'][0]), (176.4, 24.5, None))
+        self.assertEqual(columns['id'], list(WeightStat.objects.order_by('-date').values_list('id', flat=True)))
+
+    def test_accept_header_pages_like_the_rows(self):
+        url = reverse('weight_stat_list_create')
+        first = self.client.get(url, HTTP_ACCEPT='application/vnd.defatify.columns+json').data
+        rows = self.client.get(url).data
+        self.assertEqual(first['results']['id'], [row['id'] for row in rows['results']])
+        following = self.client.get(first['next'], HTTP_ACCEPT='application/vnd.defatify.columns+json').data
+        self.assertEqual(following['results']['id'], [row['id'] for row in self.client.get(rows['next']).data['results']])
+
+    def test_async_view(self):
+        response = async_to_sync(AsyncClient().get)(
+            reverse('async_weight_stat_list'), {'format': 'columns', 'page_size': 200},
+            headers={'Authorization': f'Bearer {RefreshToken.for_user(self.user).access_token}'},
+        )
+        columns = response.json()['results']
+        self.assertEqual(response['Content-Type'], 'application/vnd.defatify.columns+json')
+        self.assertEqual((columns['count'], columns['unit_preference']), (150, 'imperial'))
+        self.assertEqual(self.decode_dates(columns), self.dates[::-1])
+
+    def test_columns_are_smaller(self):
+        url = reverse('weight_stat_list_create')
+        rows = self.client.get(url, {'page_size': 100})
+        columns = self.client.get(url, {'page_size': 100, 'format': 'columns'})
+        self.assertLess(len(columns.content), len(rows.content) / 2)
+
+
+class WeightStatImportTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='importer')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.url = reverse('weight_stat_import')
+
+    def post_csv(self, body):
+        return self.client.post(self.url, body.encode(), content_type='text/csv')
+
+    def test_reports_and_skips_bad_and_duplicate_rows(self):
+        WeightStat.objects.create(user=self.user, date=parse_datetime('2024-01-01T08:00:00Z'), weight=Decimal('90.00'))
+        response = self.post_csv(
+            'Date,Weight,Body_Fat\n'
+            '2024-01-01T08:00:00Z,90.00,20.00\n'  # already stored
+            '2024-01-02T08:00:00Z,1234.56,20.00\n'  # more than max_digits
+            '2024-01-03T08:00:00Z,89.50,\n'
+            '2024-01-03T08:00:00Z,89.40,19.00\n'  # repeats the row above
+            'yesterday,89.00,19.00\n'
+        )
+        self.assertEqual(response.status_code, 207)
+        self.assertEqual({key: response.data[key] for key in ('rows', 'created', 'duplicates', 'invalid')},
+                         {'rows': 5, 'created': 1, 'duplicates': 2, 'invalid': 2})
+        self.assertEqual([(error['line'], list(error['errors'])) for error in response.data['errors']],
+                         [(3, ['weight']), (6, ['date'])])
+        self.assertIn('rows_per_second', response.data)
+        reading = WeightStat.objects.get(user=self.user, date=parse_datetime('2024-01-03T08:00:00Z'))
+        self.assertEqual((reading.weight, reading.body_fat), (Decimal('89.50'), None))
+
+    def test_batches_update_battles_once(self):
+        battle = make_battles(self.user, 1, status='in_progress')[0]
+        body = 'date,weight\n' + ''.join(f'2024-02-{day:02d}T08:00:00Z,{90 - day}.00\n' for day in range(1, 26))
+        with mock.patch('defatify.ingest.battle_update_queue.enqueue') as enqueue, \
+                mock.patch('defatify.ingest.IMPORT_BATCH_SIZE', 10), CaptureQueriesContext(connection) as ctx:
+            response = self.client.post(self.url, {'file': SimpleUploadedFile('scale.csv', body.encode())})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(sum(query['sql'].startswith('INSERT') for query in ctx.captured_queries), 3)
+        self.assertEqual(response.data['created'], 25)
+        enqueue.assert_called_once_with(self.user.id)
+
+        sync_user_battles(self.user.id)
+        self.assertEqual(BattleStatistic.objects.get(battle=battle, user=self.user).current_value, Decimal('65.00'))
+
+    def test_uploads_are_imported_as_they_arrive(self):
+        body = ('date,weight\n'
+                '2024-04-01T08:00:00Z,80.00\n'
+                '"2024-04-02T08:00:00Z","79,\n50"\n'  # a quoted newline does not end the record
+                '2024-04-03T08:00:00Z,79.00')
+        # Chunks far smaller than a record: each one is imported before the next is read
+        with mock.patch('defatify.ingest.CSVImportUploadHandler.chunk_size', 7), \
+                mock.patch('django.core.files.uploadhandler.MemoryFileUploadHandler.receive_data_chunk') as spooled:
+            response = self.client.post(self.url, {'file': SimpleUploadedFile('scale.csv', body.encode())})
+        spooled.assert_not_called()
+        self.assertEqual(response.status_code, 207)
+        self.assertEqual((response.data['created'], response.data['invalid']), (2, 1))
+        self.assertEqual([error['line'] for error in response.data['errors']], [4])
+        self.assertEqual(WeightStat.objects.get(user=self.user, date=parse_datetime('2024-04-03T08:00:00Z')).weight,
+                         Decimal('79.00'))
+
+    def test_uploads_without_a_date_column_are_rejected(self):
+        response = self.client.post(self.url, {'file': SimpleUploadedFile('scale.csv', b'when,weight\n2024-01-01,80\n')})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('date column', response.data['detail'])
+        self.assertEqual(self.client.post(self.url, {'other': 'x'}).status_code, 400)
+
+    def test_csv_body_without_a_length_is_411(self):
+        request = APIRequestFactory().post(self.url, b'date,weight\n2024-01-01,80.00\n', content_type='text/csv')
+        del request.META['CONTENT_LENGTH']
+        force_authenticate(request, self.user)
+        response = WeightStatImportView.as_view()(request)
+        self.assertEqual(response.status_code, 411)
+        self.assertFalse(WeightStat.objects.exists())
+
+    def test_rejects_files_without_a_date_column(self):
+        response = self.post_csv('when,weight\n2024-01-01,80.00\n')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(WeightStat.objects.exists())
+
+    def test_command(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as file:
+            file.write('date,weight\n2024-03-01,80.00\n2024-03-02,79.00\n')
+        self.addCleanup(os.remove, file.name)
+        out = StringIO()
+        call_command('import_readings', 'importer', file.name, stdout=out)
+        self.assertEqual(json.loads(out.getvalue())['created'], 2)
+        self.assertEqual(WeightStat.objects.filter(user=self.user).count(), 2)
+
+
+class BattleLeaderboardTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='viewer')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def make_battle(self, weight_param, changes):
+        """A battle whose participants moved by the given amounts from a 80.00 start."""
+        battle = Battle.objects.create(name='Board', creator=self.user, type='duration',
+                                       weight_param=weight_param, duration=30, status='in_progress')
+        users = User.objects.bulk_create([User(username=f'p{battle.id}_{i}') for i in range(len(changes))])
+        Profile.objects.bulk_create([Profile(user=user) for user in users])
+        BattleStatistic.objects.bulk_create([
+            BattleStatistic(battle=battle, user=user, stat_type=weight_param,
+                            starting_value=Decimal('80.00'), current_value=Decimal('80.00') + Decimal(change))
+            for user, change in zip(users, changes)
+        ])
+        return battle, users
+
+    def get(self, battle, **params):
+        return self.client.get(reverse('battle_leaderboard', args=[battle.id]), params)
+
+    def test_weight_battles_rank_biggest_loss_first(self):
+        battle, users = self.make_battle('weight', ['-1.00', '-5.00', '2.00', '-5.00'])
+        results = self.get(battle).data['results']
+
+        self.assertEqual([row['user'] for row in results], [users[1].username, users[3].username,
+                                                             users[0].username, users[2].username])
+        self.assertEqual([row['rank'] for row in results], [1, 1, 3, 4])
+        self.assertEqual(results[0]['progress'], Decimal('-5.00'))
+
+    def test_muscle_battles_rank_biggest_gain_first(self):
+        battle, users = self.make_battle('muscle_mass', ['1.00', '3.00', '-2.00'])
+        results = self.get(battle).data['results']
+        self.assertEqual([row['user'] for row in results], [users[1].username, users[0].username, users[2].username])
+
+    def test_any_page_is_a_single_query(self):
+        battle, users = self.make_battle('weight', [f'-{i % 50}.00' for i in range(250)])
+        self.user.profile  # noqa: B018 -- keep the unit preference lookup out of the count
+        with self.assertNumQueries(1):
+            response = self.get(battle, page=20)
+        self.assertEqual(response.data['count'], 250)
+        self.assertEqual(len(response.data['results']), 10)
+        self.assertEqual(response.data['results'][0]['rank'], 191)
+
+    def test_around_me_returns_neighbours(self):
+        battle, users = self.make_battle('weight', [f'-{i}.00' for i in range(20)])
+        me = users[10]
+        self.client.force_authenticate(me)
+        response = self.get(battle, around_me=1, neighbours=2)
+
+        self.assertEqual(response.data['position'], 10)
+        self.assertEqual([row['user'] for row in response.data['results']],
+                         [users[i].username for i in (12, 11, 10, 9, 8)])
+
+    def test_around_me_positions_ties_and_outsiders(self):
+        battle, users = self.make_battle('weight', ['-5.00', '-5.00', '-1.00'])
+        for user, position in zip(users, [1, 2, 3]):
+            self.assertEqual(list(BattleStatistic.objects.filter(battle=battle).position_of(user.id)),
+                             [{'position': position}])
+        self.client.force_authenticate(users[0])
+        with self.assertNumQueries(2):  # position, rows
+            response = self.get(battle, around_me=1, neighbours=1)
+        self.assertEqual([row['user'] for row in response.data['results']], [users[0].username, users[1].username])
+
+        self.client.force_authenticate(User.objects.create(username='outsider'))
+        self.assertEqual(self.get(battle, around_me=1).status_code, 404)
+
+    def test_unknown_battle_is_404(self):
+        self.assertEqual(self.client.get(reverse('battle_leaderboard', args=[999])).status_code, 404)
+
+
+class BattleCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='poller')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.battle = make_battles(self.user, 1, status='in_progress')[0]
+        self.leaderboard_url = reverse('battle_leaderboard', args=[self.battle.id])
+        self.detail_url = reverse('battle_detail', args=[self.battle.id])
+
+    def test_repeated_polls_are_served_from_cache(self):
+        self.assertEqual(self.client.get(self.leaderboard_url)['X-Cache'], 'MISS')
+        with self.assertNumQueries(0):
+            response = self.client.get(self.leaderboard_url)
+        self.assertEqual(response['X-Cache'], 'HIT')
+        self.assertEqual(self.client.get(self.leaderboard_url, {'page': 1})['X-Cache'], 'MISS')
+
+    def test_new_reading_invalidates_leaderboard(self):
+        self.client.get(self.leaderboard_url)
+        WeightStat.objects.create(user=self.user, weight=Decimal('88.00'))
+        response = self.client.get(self.leaderboard_url)
+
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.data['results'][0]['current_value'], Decimal('88.00'))
+
+    def test_participant_changes_invalidate_detail(self):
+        self.client.get(self.detail_url)
+        self.battle.participants.add(User.objects.create(username='joiner'))
+        response = self.client.get(self.detail_url)
+
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertIn('joiner', response.data['participants'])
+
+    def test_unit_preference_is_part_of_the_key(self):
+        self.client.get(self.detail_url)
+        self.user.profile.unit_preference = 'imperial'
+        self.user.profile.save()
+        self.assertEqual(self.client.get(self.detail_url)['X-Cache'], 'MISS')
+
+    def test_deploy_check_requires_a_shared_cache(self):
+        self.assertEqual([error.id for error in check_shared_cache(None)], ['defatify.E001'])
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+                                                   'LOCATION': 'redis://localhost:6379/1'}}):
+            self.assertEqual(check_shared_cache(None), [])
+
+
+class UnitConversionTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='imperial_user')
+        self.user.profile.unit_preference = 'imperial'
+        self.user.profile.save()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_lists_convert_every_row(self):
+        WeightStat.objects.create(user=self.user, date=parse_datetime('2024-01-01T08:00:00Z'), weight=Decimal('80.00'))
+        WeightStat.objects.create(user=self.user, date=parse_datetime('2024-01-02T08:00:00Z'), weight=Decimal('79.50'))
+        results = self.client.get(reverse('weight_stat_list_create')).data['results']
+        self.assertEqual(sorted(row['weight'] for row in results), [Decimal('175.3'), Decimal('176.4')])
+
+    def test_leaderboard_converts_weight_but_not_body_fat(self):
+        weight_battle = make_battles(self.user, 1, status='in_progress')[0]
+        fat_battle = make_battles(self.user, 1, status='in_progress', weight_param='body_fat')[0]
+
+        row = self.client.get(reverse('battle_leaderboard', args=[weight_battle.id])).data['results'][0]
+        self.assertEqual(row['starting_value'], Decimal('198.4'))
+        row = self.client.get(reverse('battle_leaderboard', args=[fat_battle.id])).data['results'][0]
+        self.assertEqual(row['starting_value'], Decimal('90.00'))
+
+    def test_detail_converts_goal(self):
+        battle = make_battles(self.user, 1, status='not_started', goal_value=Decimal('70.00'))[0]
+        response = self.client.get(reverse('battle_detail', args=[battle.id]))
+        self.assertEqual(response.data['goal_value'], Decimal('154.3'))
+
+
+
+def query_plan(sql):
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            # Tiny test tables would otherwise always be scanned sequentially
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            cursor.execute('EXPLAIN ' + sql)
+        else:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+        return '\n'.join(str(row[-1]) for row in cursor.fetchall())
+
+
+class QueryPlanTests(TestCase):
+    """Each endpoint's main query must be answered from an index, never a full table scan."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='planner')
+        friend = User.objects.create(username='planner_friend')
+        WeightStat.objects.create(user=cls.user, weight=Decimal('80.00'))
+        Friendship.objects.create(user=cls.user, friend=friend)
+        FriendRequest.objects.create(from_user=friend, to_user=cls.user)
+        cls.battle = make_battles(cls.user, 3, status='in_progress', is_private=False)[0]
+        BattleInvitation.objects.create(battle=cls.battle, invited_user=cls.user, inviting_user=friend)
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def assert_uses_index(self, url, table, index=None, contains=''):
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        queries = [q['sql'] for q in ctx.captured_queries
+                   if q['sql'].startswith('SELECT') and f'FROM "{table}"' in q['sql'] and contains in q['sql']]
+        self.assertTrue(queries, f'No query on {table}')
+
+        plan = query_plan(queries[-1])
+        full_scan = rf'Seq Scan on {table}\b' if connection.vendor == 'postgresql' else rf'SCAN {table}(?! USING)\b'
+        self.assertIsNone(re.search(full_scan, plan), f'Full scan of {table}:\n{queries[-1]}\n{plan}')
+        if index:
+            self.assertIn(index, plan)
+
+    def test_weight_history(self):
+        self.assert_uses_index(reverse('weight_stat_list_create'), 'defatify_weightstat', 'weightstat_user_date_idx')
+
+    def test_friends_list(self):
+        self.assert_uses_index(reverse('friends_list'), 'defatify_friendship')
+
+    def test_friend_requests(self):
+        self.assert_uses_index(reverse('friend_requests_list'), 'defatify_friendrequest')
+
+    def test_pending_invitations(self):
+        self.assert_uses_index(reverse('pending_invitations'), 'defatify_battleinvitation', 'invitation_user_status_idx')
+
+    def test_leaderboard(self):
+        self.assert_uses_index(reverse('battle_leaderboard', args=[self.battle.id]), 'defatify_battlestatistic')
+
+    def test_popular_battles(self):
+        self.assert_uses_index(reverse('top_popular_battles'), 'defatify_battle', 'battle_popular_idx', contains='participant_count" DESC')
+
+    def test_battle_detail(self):
+        self.assert_uses_index(reverse('battle_detail', args=[self.battle.id]), 'defatify_battle')
+
+
+class WeightStatExportTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='exporter')
+        Profile.objects.filter(user=self.user).update(unit_preference='imperial')
+        self.user.refresh_from_db()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        for day in (3, 1, 2):
+            WeightStat.objects.create(user=self.user, date=parse_datetime(f'2024-03-0{day}T08:00:00Z'),
+                                      weight=Decimal('80.00'), bmi=Decimal('24.50'))
+
+    def export(self, **params):
+        response = self.client.get(reverse('weight_stat_export'), params)
+        return response, b''.join(response.streaming_content).decode()
+
+    def test_csv_matches_the_json_api(self):
+        response, body = self.export()
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        self.assertIn('weight-history.csv', response['Content-Disposition'])
+        lines = body.splitlines()
+        self.assertEqual(lines[0], 'id,date,weight,bmi,body_fat,muscle_mass,body_water,bone_mass')
+        self.assertEqual([line.split(',')[1:4] for line in lines[1:]],
+                         [[f'2024-03-0{day}T08:00:00Z', '176.4', '24.50'] for day in (1, 2, 3)])
+
+    def test_ndjson_by_accept_header_and_date_range(self):
+        response = self.client.get(reverse('weight_stat_export'), {'start_date': '2024-03-02'},
+                                   HTTP_ACCEPT='application/x-ndjson')
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([(row['date'], row['weight'], row['body_fat']) for row in rows],
+                         [('2024-03-02T08:00:00Z', '176.4', None), ('2024-03-03T08:00:00Z', '176.4', None)])
+
+    def test_asgi_streams_from_an_async_iterator(self):
+        headers = {'Authorization': f'Bearer {access_token_for(self.user)}'}
+        response = async_to_sync(AsyncClient().get)(reverse('weight_stat_export'), headers=headers)
+
+        async def body():
+            return b''.join([chunk async for chunk in response])
+        # A sync iterator would be read to the end into a list before the first byte went out
+        self.assertTrue(response.is_async)
+        self.assertEqual(async_to_sync(body)().decode(), self.export()[1])
+
+    def test_invalid_dates_are_rejected(self):
+        response = self.client.get(reverse('weight_stat_export'), {'format': 'ndjson', 'end_date': 'soon'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('end_date', json.loads(response.content)['detail'])
+
+    def test_memory_stays_flat_as_the_history_grows(self):
+        # Small chunks, so a tenth of the rows already spans several
+        with mock.patch('defatify.exports.EXPORT_CHUNK_SIZE', 200):
+            results = export_benchmark.run(rows=4000)
+        self.assertEqual(set(results), {'csv', 'ndjson', 'csv-asgi', 'ndjson-asgi'})
+        for export_format, result in results.items():
+            self.assertEqual(result['full']['rows'], 4000)
+            # Ten times the rows, not ten times the memory
+            self.assertLess(result['peak_growth'], 2, export_format)
+
+
+class WeightStatRollupTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='charter')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        for date, weight, fat in [('2024-01-01T07:00:00Z', '82.00', '25.00'),
+                                  ('2024-01-01T20:00:00Z', '81.00', None),
+                                  ('2024-01-03T07:00:00Z', '80.50', '24.00'),
+                                  ('2024-02-10T07:00:00Z', '79.00', '23.00')]:
+            WeightStat.objects.create(user=self.user, date=parse_datetime(date), weight=Decimal(weight),
+                                      body_fat=Decimal(fat) if fat else None)
+
+    def get(self, **params):
+        return self.client.get(reverse('weight_stat_rollups'), params)
+
+    def test_daily_buckets(self):
+        buckets = self.get(period='day').data['buckets']
+        self.assertEqual(len(buckets), 3)
+        first = buckets[0]
+        self.assertEqual(first['count'], 2)
+        self.assertEqual(first['weight'], {'min': Decimal('81.00'), 'max': Decimal('82.00'),
+                                           'avg': Decimal('81.50'), 'last': Decimal('81.00')})
+        self.assertEqual(first['body_fat']['last'], None)
+        self.assertEqual(first['body_fat']['avg'], Decimal('25.00'))
+
+    def test_monthly_buckets_honour_date_range(self):
+        buckets = self.get(period='month', start_date='2024-01-02', end_date='2024-02-10').data['buckets']
+        self.assertEqual([b['count'] for b in buckets], [1, 1])
+        self.assertEqual(buckets[0]['weight']['min'], Decimal('80.50'))
+
+    def test_imperial_users_get_pounds(self):
+        self.user.profile.unit_preference = 'imperial'
+        self.user.profile.save()
+        bucket = self.get(period='week').data['buckets'][0]
+        self.assertEqual(bucket['weight']['max'], Decimal('180.8'))
+        self.assertEqual(bucket['body_fat']['max'], Decimal('25.00'))
+
+    def test_closed_buckets_are_cached_until_backfilled(self):
+        self.get(period='month')
+        self.user.profile  # noqa: B018 -- keep the unit preference lookup out of the count
+        with self.assertNumQueries(1):
+            self.assertEqual(len(self.get(period='month').data['buckets']), 2)
+
+        WeightStat.objects.create(user=self.user, date=parse_datetime('2023-12-15T07:00:00Z'), weight=Decimal('84.00'))
+        self.assertEqual(len(self.get(period='month').data['buckets']), 3)
+
+    def test_rejects_unknown_period(self):
+        self.assertEqual(self.get(period='hour').status_code, 400)
+
+
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='scroller')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        now = timezone.now()
+        WeightStat.objects.bulk_create([
+            WeightStat(user=self.user, date=now - timedelta(hours=i), weight=Decimal('80.00')) for i in range(25)
+        ])
+
+    def test_walks_history_newest_first_without_counting(self):
+        url, ids = reverse('weight_stat_list_create') + '?page_size=10', []
+        while url:
+            data = self.client.get(url).data
+            self.assertNotIn('count', data)
+            ids.extend(row['id'] for row in data['results'])
+            url = data['next']
+
+        expected = list(WeightStat.objects.filter(user=self.user).order_by('-date', '-id').values_list('id', flat=True))
+        self.assertEqual(ids, expected)
+
+    def test_page_size_is_capped(self):
+        WeightStat.objects.bulk_create([WeightStat(user=self.user, weight=Decimal('80.00')) for _ in range(100)])
+        data = self.client.get(reverse('weight_stat_list_create'), {'page_size': 1000}).data
+        self.assertEqual(len(data['results']), 100)
+
+
+class BattleSearchTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='seeker')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def battle(self, name, description='', **fields):
+        fields.setdefault('is_private', False)
+        return Battle.objects.create(name=name, description=description, creator=self.user,
+                                     type='stat_goal', weight_param='weight', goal_value=Decimal('70.00'), **fields)
+
+    def search(self, query):
+        return [row['name'] for row in self.client.get(reverse('battle_search'), {'query': query}).data['results']]
+
+    def test_prefix_matching_and_ranking(self):
+        self.battle('Morning walkers', 'Run before breakfast')
+        self.battle('Summer shred', 'Morning runs and evening walks')
+        self.battle('Chess club')
+        self.assertEqual(self.search('morn'), ['Morning walkers', 'Summer shred'])
+        self.assertEqual(self.search('walk morning'), ['Morning walkers', 'Summer shred'])
+
+    def test_triggers_dropped_by_a_migration_are_restored(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('The FTS triggers only exist on SQLite')
+        self.battle('Early riser')
+        with connection.cursor() as cursor:
+            cursor.execute('DROP TRIGGER defatify_battle_fts_insert')
+        self.battle('Late riser')
+        self.assertEqual(self.search('riser'), ['Early riser'])
+
+        restore_battle_fts_triggers()
+        self.battle('Night riser')
+        self.assertEqual(sorted(self.search('riser')), ['Early riser', 'Late riser', 'Night riser'])
+
+    def test_keeps_public_and_unfinished_filter(self):
+        self.battle('Private cut', is_private=True)
+        self.battle('Finished cut', status='finished')
+        self.battle('Deleted cut', status='deleted')
+        self.battle('Open cut')
+        self.assertEqual(self.search('cut'), ['Open cut'])
+
+    def test_index_follows_renames_and_deletes(self):
+        battle = self.battle('Lean January')
+        battle.name = 'Lean February'
+        battle.save()
+        self.assertEqual(self.search('january'), [])
+        self.assertEqual(self.search('febr'), ['Lean February'])
+        battle.delete()
+        self.assertEqual(self.search('lean'), [])
+
+    def test_punctuation_is_not_query_syntax(self):
+        self.battle('Team "A" -- OR NOT')
+        self.assertEqual(self.search('"team" OR*'), ['Team "A" -- OR NOT'])
+
+
+class UserSearchTests(TestCase):
+    def setUp(self):
+        forget_user_search()
+        self.user = User.objects.create(username='searcher')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        for username in ['annabel', 'ann', 'joanna', 'anne', 'bob']:
+            User.objects.create(username=username)
+
+    def search(self, query):
+        return self.client.get(reverse('user_search'), {'query': query}).data['results']
+
+    def test_exact_then_prefix_then_substring(self):
+        self.assertEqual([row['username'] for row in self.search('Ann')], ['ann', 'annabel', 'anne', 'joanna'])
+
+    def test_database_ranking_matches_the_in_process_index(self):
+        self.assertEqual(_db_user_ids('ann'), username_index.search('ann'))
+
+    def test_excludes_the_viewer(self):
+        self.assertEqual(self.search('search'), [])
+
+    def test_viewer_does_not_shorten_a_full_page(self):
+        ann, anne, annabel = (User.objects.get(username=name).id for name in ['ann', 'anne', 'annabel'])
+        self.assertEqual(_db_user_ids('ann', limit=2, exclude_id=ann), [annabel, anne])
+        self.assertEqual(username_index.search('ann', limit=2, exclude_id=ann), [annabel, anne])
+
+    def test_pages_go_past_the_cached_results(self):
+        with mock.patch('defatify.search.USER_SEARCH_LIMIT', 2):
+            response = self.client.get(reverse('user_search'), {'query': 'ann'})
+        self.assertEqual(response.data['count'], 4)
+        self.assertEqual([row['username'] for row in response.data['results']], ['ann', 'annabel', 'anne', 'joanna'])
+
+    def test_relations_come_with_the_results(self):
+        ann, anne, annabel = (User.objects.get(username=name) for name in ['ann', 'anne', 'annabel'])
+        Friendship.objects.create(user=self.user, friend=ann)
+        FriendRequest.objects.create(from_user=self.user, to_user=anne)
+        FriendRequest.objects.create(from_user=annabel, to_user=self.user)
+        FriendRequest.objects.create(from_user=self.user, to_user=annabel, status='rejected')
+        with self.assertNumQueries(3):  # profile, count, page
+            rows = {row['username']: row for row in self.search('ann')}
+        self.assertEqual(rows['ann']['is_friend'], True)
+        self.assertEqual(rows['anne']['friend_request'], 'sent')
+        self.assertEqual(rows['annabel']['friend_request'], 'received')
+        self.assertEqual(rows['joanna']['is_friend'], False)
+        self.assertIsNone(rows['joanna']['friend_request'])
+
+    def test_recent_results_are_cached(self):
+        bob = User.objects.get(username='bob')
+        self.search('bo')
+        with self.assertNumQueries(0):
+            self.assertEqual(matching_user_ids('BO', exclude_id=self.user.id), [bob.id])
+
+    def test_new_renamed_and_deleted_users_show_up(self):
+        self.assertEqual([row['username'] for row in self.search('bo')], ['bob'])
+        User.objects.create(username='bobby')
+        self.assertEqual([row['username'] for row in self.search('bo')], ['bob', 'bobby'])
+        bob = User.objects.get(username='bob')
+        bob.username = 'robert'
+        bob.save()
+        self.assertEqual([row['username'] for row in self.search('bo')], ['bobby'])
+        User.objects.get(username='bobby').delete()
+        self.assertEqual(self.search('bo'), [])
+
+    def test_login_does_not_flush_the_cache(self):
+        self.search('bo')
+        self.user.save(update_fields=['last_login'])
+        with self.assertNumQueries(0):
+            matching_user_ids('bo', exclude_id=self.user.id)
+
+
+class ParticipantCountTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='host')
+        self.others = [User.objects.create(username=f'guest{i}') for i in range(3)]
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def create_battle(self, name, **fields):
+        data = {'name': name, 'type': 'stat_goal', 'weight_param': 'weight', 'goal_value': '70.00', 'is_private': False}
+        data.update(fields)
+        return Battle.objects.get(id=self.client.post(reverse('battle_list'), data).data['id'])
+
+    def count(self, battle):
+        return Battle.objects.values_list('participant_count', flat=True).get(id=battle.id)
+
+    def popular(self):
+        return [row['name'] for row in self.client.get(reverse('top_popular_battles')).data['results']]
+
+    def test_join_leave_and_accept_keep_the_count(self):
+        battle = self.create_battle('Spring cut')
+        self.assertEqual(self.count(battle), 1)
+
+        guest = APIClient()
+        guest.force_authenticate(self.others[0])
+        guest.post(reverse('battle_join', args=[battle.id]))
+        guest.post(reverse('battle_join', args=[battle.id]))  # Rejected, already in
+        self.assertEqual(self.count(battle), 2)
+
+        invitation = BattleInvitation.objects.create(battle=battle, invited_user=self.others[1], inviting_user=self.user)
+        invited = APIClient()
+        invited.force_authenticate(self.others[1])
+        invited.post(reverse('accept_invitation', args=[invitation.id]))
+        self.assertEqual(self.count(battle), 3)
+
+        guest.delete(reverse('battle_leave', args=[battle.id]))
+        self.assertEqual(self.count(battle), 2)
+
+    def test_reverse_and_bulk_changes(self):
+        first, second = self.create_battle('First'), self.create_battle('Second')
+        self.others[0].battles.add(first, second)
+        first.participants.add(*self.others[1:])
+        self.assertEqual((self.count(first), self.count(second)), (4, 2))
+
+        first.participants.remove(self.others[1], self.others[0], self.user)
+        self.assertEqual(self.count(first), 1)
+        self.others[0].battles.clear()
+        self.assertEqual((self.count(first), self.count(second)), (1, 1))
+        second.participants.clear()
+        self.assertEqual(self.count(second), 0)
+
+    def test_popular_feed_is_precomputed_and_follows_changes(self):
+        small, big = self.create_battle('Small'), self.create_battle('Big')
+        big.participants.add(*self.others)
+        self.create_battle('Hidden', is_private=True).participants.add(*self.others)
+        self.assertEqual(self.popular(), ['Big', 'Small'])
+
+        with CaptureQueriesContext(connection) as ctx:
+            self.popular()
+        self.assertFalse([q for q in ctx.captured_queries if 'participant_count" DESC' in q['sql']])
+
+        small.participants.add(*self.others, User.objects.create(username='latecomer'))
+        self.assertEqual(self.popular(), ['Small', 'Big'])
+        small.status = 'deleted'
+        small.save()
+        self.assertEqual(self.popular(), ['Big'])
+
+    def test_reconcile_command_repairs_drift(self):
+        battle = self.create_battle('Drifted')
+        battle.participants.add(*self.others)
+        untouched = self.create_battle('Untouched')
+        Battle.objects.filter(id=battle.id).update(participant_count=1)
+
+        out = StringIO()
+        call_command('reconcile_participant_counts', stdout=out)
+        self.assertIn('Repaired 1 participant counts', out.getvalue())
+        self.assertEqual((self.count(battle), self.count(untouched)), (4, 1))
+
+
+class BattleSerializationQueryTests(TestCase):
+    """Battle endpoints cost a fixed number of queries, however many battles and participants there are."""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='lister')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def populate(self, battles, participants):
+        users = User.objects.bulk_create([User(username=f'p{participants}_{i}') for i in range(participants)])
+        for battle in battles:
+            battle.participants.add(self.user, *users)
+        battles[0].winner = users[0]
+        battles[0].save()
+
+    def assert_constant_queries(self, url, expected):
+        for battle_count, participant_count in [(2, 2), (10, 12)]:
+            battles = make_battles(self.user, battle_count, is_private=False)
+            # Battles created by someone else reach the list through the participation table
+            battles += make_battles(User.objects.create(username=f'other{battle_count}'), 2, is_private=False)
+            self.populate(battles[-2:], participant_count)
+            cache.clear()
+            with self.assertNumQueries(expected):
+                response = self.client.get(url(battles))
+            self.assertEqual(response.status_code, 200)
+            Battle.objects.all().delete()
+        return response
+
+    def test_battle_list(self):
+        response = self.assert_constant_queries(lambda battles: reverse('battle_list'), 2)
+        rows = response.data['results']
+        self.assertEqual(len(rows), 10)
+        busy = next(row for row in rows if row['creator'] != 'lister')
+        self.assertEqual(busy['participant_count'], 14)
+        self.assertEqual(len(busy['participants_preview']), Battle.PARTICIPANT_PREVIEW_SIZE)
+        self.assertNotIn('participants', busy)
+
+    def test_battle_list_has_no_duplicates(self):
+        battle = make_battles(self.user, 1)[0]
+        Battle.objects.filter(id=battle.id).update(creator=self.user)
+        rows = self.client.get(reverse('battle_list')).data['results']
+        self.assertEqual([row['id'] for row in rows], [battle.id])
+
+    def test_battle_detail(self):
+        response = self.assert_constant_queries(lambda battles: reverse('battle_detail', args=[battles[-1].id]), 2)
+        self.assertEqual(len(response.data['participants']), 14)
+        self.assertEqual(response.data['creator'], 'other10')
+
+    def test_battle_search(self):
+        self.assert_constant_queries(lambda battles: reverse('battle_search') + '?query=battle', 3)
+
+    def test_popular_battles(self):
+        self.assert_constant_queries(lambda battles: reverse('top_popular_battles'), 4)
+
+
+class RowSerializerTests(TestCase):
+    """The values_list() list endpoints return exactly what their ModelSerializers would."""
+
+    def setUp(self):
+        self.user = User.objects.create(username='rower')
+        self.friends = User.objects.bulk_create([User(username=f'rower_friend{i}') for i in range(3)])
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def expected(self, serializer_class, instances):
+        request = APIClient().get('/').wsgi_request
+        request.user = self.user
+        return json.loads(JSONRenderer().render(serializer_class(instances, many=True, context={'request': request}).data))
+
+    def assert_same_rows(self, url, serializer_class, queryset):
+        rows = self.client.get(url).json()['results']
+        ids = [row['id'] for row in rows]
+        instances = sorted(queryset.filter(id__in=ids), key=lambda instance: ids.index(instance.id))
+        self.assertEqual(len(rows), queryset.count())
+        self.assertEqual(rows, self.expected(serializer_class, instances))
+
+    def test_weight_history(self):
+        for unit_preference in ('metric', 'imperial'):
+            Profile.objects.update_or_create(user=self.user, defaults={'unit_preference': unit_preference})
+            self.user.refresh_from_db()
+            WeightStat.objects.create(user=self.user, weight=Decimal('81.25'), bmi=Decimal('24.10'))
+            WeightStat.objects.create(user=self.user, body_fat=Decimal('19.50'))
+            self.assert_same_rows(reverse('weight_stat_list_create'), WeightStatSerializer, WeightStat.objects.all())
+
+    def test_friends(self):
+        Friendship.objects.bulk_create([Friendship(user=self.user, friend=friend) for friend in self.friends])
+        with self.assertNumQueries(2):
+            self.client.get(reverse('friends_list'))
+        self.assert_same_rows(reverse('friends_list'), FriendshipSerializer, Friendship.objects.all())
+
+    def test_friend_requests(self):
+        FriendRequest.objects.create(from_user=self.friends[0], to_user=self.user)
+        FriendRequest.objects.create(from_user=self.user, to_user=self.friends[1], status='rejected')
+        self.assert_same_rows(reverse('friend_requests_list'), FriendRequestSerializer, FriendRequest.objects.all())
+
+    def test_pending_invitations(self):
+        battle = make_battles(self.friends[0], 1)[0]
+        for friend in self.friends:
+            BattleInvitation.objects.create(battle=battle, invited_user=self.user, inviting_user=friend)
+        # Battle and inviting user come joined into the one values_list() query
+        with self.assertNumQueries(1):
+            self.client.get(reverse('pending_invitations'))
+        self.assert_same_rows(reverse('pending_invitations'), BattleInvitationSerializer, BattleInvitation.objects.all())
+
+    def test_cursor_pages_match_the_model_path(self):
+        now = timezone.now()
+        WeightStat.objects.bulk_create([WeightStat(user=self.user, date=now - timedelta(hours=i % 3), weight=Decimal('80.00'))
+                                        for i in range(7)])
+        url, ids = reverse('weight_stat_list_create') + '?page_size=2', []
+        while url:
+            data = self.client.get(url).data
+            ids.extend(row['id'] for row in data['results'])
+            url = data['next']
+        expected = list(WeightStat.objects.filter(user=self.user).order_by('-date', '-id').values_list('id', flat=True))
+        self.assertEqual(ids, expected)
+
+    def test_rejects_computed_fields(self):
+        with self.assertRaises(ImproperlyConfigured):
+            RowSerializer(UserSearchSerializer).plan
+
+
+class SparseFieldsetTests(TestCase):
+    """`?fields=` / `?exclude=` trim the response and the queries behind it."""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='sparse')
+        Profile.objects.filter(user=self.user).update(unit_preference='imperial')
+        self.user.refresh_from_db()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.battles = make_battles(self.user, 3, is_private=False, description='A long description')
+        self.battles[0].participants.add(*User.objects.bulk_create([User(username=f'sparse{i}') for i in range(3)]))
+
+    def get(self, name, params, *args):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse(name, args=args), params)
+        self.assertEqual(response.status_code, 200)
+        return response.data, [query['sql'] for query in queries]
+
+    def test_battle_list(self):
+        data, queries = self.get('battle_list', {'fields': 'id,name,status'})
+        self.assertEqual([set(row) for row in data['results']], [{'id', 'name', 'status'}] * 3)
+        # No preview prefetch, no user join and no unrequested columns
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('auth_user', queries[0])
+        self.assertNotIn('description', queries[0])
+        following = self.client.get(reverse('battle_list'), {'fields': 'id', 'page_size': 2}).data
+        self.assertEqual(len(self.client.get(following['next']).data['results']), 1)
+
+    def test_battle_detail_and_popular(self):
+        battle = self.battles[0]
+        data, queries = self.get('battle_detail', {'exclude': 'participants,description'}, battle.id)
+        self.assertNotIn('participants', data)
+        self.assertEqual(data['creator'], 'sparse')
+        self.assertFalse(any('defatify_battle_participants' in query for query in queries))
+        # goal_value's units depend on weight_param, so it comes along
+        data, _ = self.get('battle_detail', {'fields': 'goal_value'}, battle.id)
+        self.assertEqual(data, {'weight_param': 'weight', 'goal_value': Decimal('110.2')})
+        full, _ = self.get('battle_detail', {}, battle.id)
+        self.assertEqual(len(full['participants']), 4)
+        async_data = async_to_sync(AsyncClient().get)(
+            reverse('async_battle_detail', args=[battle.id]), {'exclude': 'participants,description'},
+            headers={'Authorization': f'Bearer {RefreshToken.for_user(self.user).access_token}'},
+        ).json()
+        self.assertEqual(set(async_data), set(full) - {'participants', 'description'})
+        data, _ = self.get('top_popular_battles', {'fields': 'name,participants_preview'})
+        self.assertEqual(set(data['results'][0]), {'name', 'participants_preview'})
+
+    def test_leaderboard(self):
+        data, queries = self.get('battle_leaderboard', {'fields': 'rank,progress'}, self.battles[0].id)
+        self.assertEqual(data['results'], [{'rank': 1, 'stat_type': 'weight', 'progress': Decimal('0.00')}])
+        self.assertNotIn('auth_user', queries[0])
+        data, _ = self.get('battle_leaderboard', {'exclude': 'stat_type,progress', 'around_me': 1}, self.battles[0].id)
+        self.assertEqual(set(data['results'][0]), {'rank', 'user', 'stat_type', 'starting_value', 'current_value'})
+
+    def test_row_lists(self):
+        now = timezone.now()
+        WeightStat.objects.bulk_create([WeightStat(user=self.user, date=now - timedelta(hours=i), weight=Decimal('80.00'))
+                                        for i in range(3)])
+        data, queries = self.get('weight_stat_list_create', {'fields': 'weight', 'page_size': 2})
+        self.assertEqual(data['results'], [{'weight': Decimal('176.4')}] * 2)
+        self.assertNotIn('bmi', queries[-1])
+        self.assertEqual(len(self.client.get(data['next']).data['results']), 1)
+        data, _ = self.get('weight_stat_list_create', {'fields': 'weight', 'format': 'columns'})
+        self.assertEqual(set(data['results']), {'count', 'unit_preference', 'weight'})
+
+        Friendship.objects.create(user=self.user, friend=User.objects.get(username='sparse0'))
+        data, queries = self.get('friends_list', {'exclude': 'friend_username'})
+        self.assertEqual(set(data['results'][0]), {'id', 'friend', 'created_at'})
+        self.assertFalse(any('INNER JOIN' in query for query in queries))
+
+    def test_unknown_fields(self):
+        response = self.client.get(reverse('battle_list'), {'fields': 'id,password'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('password', response.data['detail'])
+        # Writes answer in full whatever the query string
+        response = self.client.post(reverse('battle_list') + '?fields=id', {
+            'name': 'Full', 'type': 'duration', 'weight_param': 'weight', 'duration': 30,
+        })
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['name'], 'Full')
+
+
+class EndpointBenchmarkTests(TestCase):
+    def test_every_route_is_driven_successfully(self):
+        with mock.patch('defatify.metrics.SLOW_REQUEST_MS', float('inf')):
+            results = endpoints_benchmark.run(users=80, readings=3, battles=60, requests=1)
+
+        self.assertEqual(results['data']['users'], 80)
+        self.assertIn('GET battle_leaderboard around_me', results['endpoints'])
+        for label, row in results['endpoints'].items():
+            self.assertLessEqual(row['p50_ms'], row['p99_ms'], label)
+        self.assertGreater(results['endpoints']['POST weight_stat_list_create']['queries'], 0)
+        # Served from the cache, with the user taken from the token
+        self.assertEqual(results['endpoints']['GET battle_detail']['queries'], 0)
+        # Rolled back: the writes left the generated data as it was
+        self.assertFalse(User.objects.filter(username='bench_new').exists())
+        self.assertFalse(Battle.objects.filter(name='New battle').exists())
+
+    def test_meter_counts_fetched_rows(self):
+        User.objects.bulk_create([User(username=f'metered{i}') for i in range(3)])
+        meter = Meter()
+        with connection.execute_wrapper(meter):
+            list(User.objects.filter(username__startswith='metered'))
+            User.objects.filter(username__startswith='metered').count()
+        self.assertEqual((meter.queries, meter.rows), (2, 4))
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        metrics.reset()
+        self.user = User.objects.create(username='measured')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        WeightStat.objects.create(user=self.user, weight=Decimal('80.00'))
+
+    def series(self, name, route, method='GET'):
+        match = re.search(rf'^{name}{{route="{route}",method="{method}"}} (\S+)$', metrics.exposition(), re.M)
+        return float(match.group(1)) if match else None
+
+    def test_requests_are_recorded_per_route(self):
+        for _ in range(2):
+            self.client.get(reverse('weight_stat_list_create'))
+
+        self.assertEqual(self.series('defatify_request_duration_seconds_count', 'weight_stat_list_create'), 2)
+        self.assertGreater(self.series('defatify_request_queries_sum', 'weight_stat_list_create'), 0)
+        self.assertGreater(self.series('defatify_request_db_seconds_sum', 'weight_stat_list_create'), 0)
+        self.assertGreater(self.series('defatify_request_serializer_seconds_sum', 'weight_stat_list_create'), 0)
+        self.assertIn('defatify_requests_total{route="weight_stat_list_create",method="GET",status="200"} 2',
+                      metrics.exposition())
+
+    def test_async_views_are_recorded(self):
+        token = RefreshToken.for_user(self.user).access_token
+        async_to_sync(AsyncClient().get)(reverse('async_get_profile'), headers={'Authorization': f'Bearer {token}'})
+        self.assertEqual(self.series('defatify_request_queries_sum', 'async_get_profile'), 1)
+
+    def test_duplicate_queries(self):
+        request_metrics = metrics.RequestMetrics()
+        token = metrics._current.set(request_metrics)
+        try:
+            for user_id in (self.user.id, self.user.id, self.user.id + 1):
+                User.objects.filter(id=user_id).first()
+        finally:
+            metrics._current.reset(token)
+        self.assertEqual((request_metrics.queries, request_metrics.duplicate_queries), (3, 1))
+
+    def test_only_the_repos_serializers_are_timed(self):
+        class ThirdPartySerializer(serializers.Serializer):
+            name = serializers.CharField()
+
+        request_metrics = metrics.RequestMetrics()
+        token = metrics._current.set(request_metrics)
+        try:
+            ThirdPartySerializer({'name': 'untimed'}).data
+            self.assertEqual(request_metrics.serializer_seconds, 0)
+            ProfileSerializer(self.user.profile).data
+            self.assertGreater(request_metrics.serializer_seconds, 0)
+        finally:
+            metrics._current.reset(token)
+
+    def test_model_serializer_lists_are_timed(self):
+        make_battles(self.user, 3)
+        self.client.get(reverse('battle_list'))
+        self.assertGreater(self.series('defatify_request_serializer_seconds_sum', 'battle_list'), 0)
+
+    def test_slow_requests_are_logged_with_their_sql(self):
+        with mock.patch('defatify.metrics.SLOW_REQUEST_MS', 0), self.assertLogs('defatify.slow_requests') as logs:
+            self.client.get(reverse('weight_stat_list_create'))
+        self.assertIn('(weight_stat_list_create)', logs.output[0])
+        self.assertIn('defatify_weightstat', logs.output[0])
+
+    def test_metrics_endpoint(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 404)
+        with self.settings(METRICS_TOKEN='scrape-secret'):
+            self.assertEqual(self.client.get(reverse('metrics')).status_code, 401)
+            response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Token scrape-secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.assertIn('# TYPE defatify_request_duration_seconds histogram', response.content.decode())
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class ClaimsAuthenticationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='claimed', password='claims-password')
+        Profile.objects.filter(user=self.user).update(unit_preference='imperial', bio='Cutting')
+        WeightStat.objects.create(user=self.user, weight=Decimal('80.00'))
+        # Signed up long ago: no profile change within the token lifetime
+        cache.clear()
+
+    def login(self):
+        data = APIClient().post(reverse('login'), {'username': 'claimed', 'password': 'claims-password'}).data
+        return data['access'], data['refresh']
+
+    def client_for(self, access):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {access}')
+        return client
+
+    def issued_earlier(self, access):
+        token = AccessToken(access)
+        token.set_iat(at_time=timezone.now() - timedelta(seconds=10))
+        return str(token)
+
+    def test_login_tokens_carry_the_claims(self):
+        access, _ = self.login()
+        token = AccessToken(access)
+        self.assertEqual((token['username'], token['unit_preference']), ('claimed', 'imperial'))
+
+    def test_requests_read_no_user_or_profile_rows(self):
+        client = self.client_for(self.login()[0])
+        with self.assertNumQueries(1):
+            response = client.get(reverse('weight_stat_list_create'))
+        self.assertEqual(response.data['results'][0]['weight'], Decimal('176.4'))
+        with self.assertNumQueries(1):
+            self.assertEqual(client.get(reverse('get_profile')).data['bio'], 'Cutting')
+
+    def test_tokens_without_claims_still_load_the_user(self):
+        client = self.client_for(RefreshToken.for_user(self.user).access_token)
+        with self.assertNumQueries(3):
+            response = client.get(reverse('weight_stat_list_create'))
+        self.assertEqual(response.data['results'][0]['weight'], Decimal('176.4'))
+
+    def test_profile_update_retires_older_tokens(self):
+        access, refresh = self.login()
+        client = self.client_for(self.issued_earlier(access))
+        response = client.patch(reverse('update_profile'), {'unit_preference': 'metric'})
+        self.assertEqual(response.status_code, 200)
+
+        stale = client.get(reverse('weight_stat_list_create'))
+        self.assertEqual(stale.status_code, 401)
+        self.assertEqual(stale.data['code'], 'token_stale')
+
+        # The updating client gets a fresh token, every other one refreshes
+        fresh = self.client_for(response['X-Access-Token']).get(reverse('weight_stat_list_create'))
+        self.assertEqual(fresh.data['results'][0]['weight'], '80.00')
+        refreshed = APIClient().post(reverse('token_refresh'), {'refresh': refresh}).data['access']
+        self.assertEqual(AccessToken(refreshed)['unit_preference'], 'metric')
+
+    def test_claims_users_are_read_only(self):
+        client = self.client_for(self.login()[0])
+        request = client.get(reverse('weight_stat_list_create')).wsgi_request
+        self.assertRaises(NotImplementedError, request.user.save)
+        self.assertRaises(NotImplementedError, request.user.profile.save)
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.has_usable_password())
+
+    def test_deactivated_and_deleted_users_are_refused(self):
+        access, refresh = self.login()
+        client = self.client_for(self.issued_earlier(access))
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(client.get(reverse('weight_stat_list_create')).status_code, 401)
+        self.assertEqual(APIClient().post(reverse('token_refresh'), {'refresh': refresh}).status_code, 401)
+
+        self.user.is_active = True
+        self.user.save()
+        access, refresh = self.login()
+        client = self.client_for(self.issued_earlier(access))
+        self.user.delete()
+        self.assertEqual(client.post(reverse('weight_stat_list_create'), {'weight': '79.00'}).status_code, 401)
+        self.assertEqual(APIClient().post(reverse('token_refresh'), {'refresh': refresh}).status_code, 401)
+
+    def test_inactive_claims_are_refused(self):
+        token = AccessToken(self.login()[0])
+        token['is_active'] = False
+        self.assertEqual(self.client_for(str(token)).get(reverse('weight_stat_list_create')).status_code, 401)
+
+    @mock.patch.object(jwt_settings, 'CHECK_REVOKE_TOKEN', True)
+    def test_revoke_check_loads_the_user(self):
+        client = self.client_for(self.login()[0])
+        self.assertEqual(client.get(reverse('weight_stat_list_create')).status_code, 200)
+        User.objects.filter(id=self.user.id).update(password='changed')
+        self.assertEqual(client.get(reverse('weight_stat_list_create')).data['code'], 'password_changed')
+
+    def test_async_views(self):
+        access = self.login()[0]
+        headers = {'Authorization': f'Bearer {access}'}
+        with self.assertNumQueries(1):
+            response = async_to_sync(AsyncClient().get)(reverse('async_get_profile'), headers=headers)
+        self.assertEqual((response.json()['bio'], response.json()['unit_preference']), ('Cutting', 'imperial'))
+
+        self.user.profile.save()
+        stale = async_to_sync(AsyncClient().get)(reverse('async_get_profile'),
+                                                  headers={'Authorization': f'Bearer {self.issued_earlier(access)}'})
+        self.assertEqual(stale.status_code, 401)
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class TokenBlacklistTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='leaving', password='blacklist-password')
+        cache.clear()
+        blacklist_filter.clear()
+
+    def login(self):
+        return APIClient().post(reverse('login'), {'username': 'leaving', 'password': 'blacklist-password'}).data
+
+    def refresh(self, refresh):
+        return APIClient().post(reverse('token_refresh'), {'refresh': refresh})
+
+    def test_bloom_filter_has_no_false_negatives(self):
+        bloom = BloomFilter(capacity=1000)
+        for i in range(1000):
+            bloom.add(f'jti-{i}')
+        self.assertTrue(all(f'jti-{i}' in bloom for i in range(1000)))
+        false_positives = sum(f'other-{i}' in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+    def test_refreshing_skips_the_blacklist_query(self):
+        refresh = self.login()['refresh']
+        self.refresh(refresh)
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(self.refresh(refresh).status_code, 200)
+        # Stock simplejwt looks the token up in the blacklist tables on every refresh
+        self.assertFalse([query for query in ctx.captured_queries if 'token_blacklist' in query['sql']])
+        self.assertEqual(len(ctx), 1)  # The user with its profile, for the active check and the claims
+        self.assertGreater(blacklist_filter.lookups['filtered'], 0)
+
+    def test_logged_out_tokens_are_refused(self):
+        tokens = self.login()
+        self.refresh(tokens['refresh'])
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {tokens["access"]}')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(client.post(reverse('logout'), {'refresh': tokens['refresh']}).status_code, 205)
+        self.assertEqual(self.refresh(tokens['refresh']).status_code, 401)
+        self.assertEqual(blacklist_filter.lookups['confirmed'], 1)
+
+    def test_tokens_blacklisted_by_another_process_are_refused(self):
+        refresh = self.login()['refresh']
+        self.refresh(refresh)
+        # Another process writes the row; this filter only hears of it through the shared generation
+        with self.captureOnCommitCallbacks(execute=True):
+            BlacklistedToken.objects.create(token=OutstandingToken.objects.get(jti=RefreshToken(refresh)['jti']))
+        self.assertEqual(self.refresh(refresh).status_code, 401)
+
+    def test_a_lost_generation_bump_is_caught_up_within_the_sync_interval(self):
+        refresh = self.login()['refresh']
+        self.refresh(refresh)
+        # The row commits but the cache never counts it
+        BlacklistedToken.objects.create(token=OutstandingToken.objects.get(jti=RefreshToken(refresh)['jti']))
+        self.assertEqual(self.refresh(refresh).status_code, 200)
+        with mock.patch.object(blacklist_filter, 'sync_interval', 0):
+            self.assertEqual(self.refresh(refresh).status_code, 401)
+
+    def test_prune_deletes_expired_tokens_in_batches(self):
+        tokens = [RefreshToken.for_user(self.user) for _ in range(5)]
+        tokens[0].blacklist()
+        tokens[1].blacklist()
+        OutstandingToken.objects.filter(jti__in=[token['jti'] for token in tokens[:4]]).update(
+            expires_at=timezone.now() - timedelta(minutes=1))
+
+        out = StringIO()
+        call_command('prune_token_blacklist', '--batch-size', '3', stdout=out)
+        self.assertIn('Deleted 4 expired tokens', out.getvalue())
+        self.assertEqual(list(OutstandingToken.objects.values_list('jti', flat=True)), [tokens[4]['jti']])
+        self.assertFalse(BlacklistedToken.objects.exists())
+
+
+class AsyncReadEndpointTests(TestCase):
+    """The async endpoints answer exactly like the DRF views they mirror."""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='async_reader')
+        self.rival = User.objects.create(username='async_rival')
+        self.headers = {'Authorization': f'Bearer {RefreshToken.for_user(self.user).access_token}'}
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=self.headers['Authorization'])
+
+        now = timezone.now()
+        WeightStat.objects.bulk_create([
+            WeightStat(user=self.user, date=now - timedelta(days=i), weight=Decimal('80.00') + i) for i in range(5)
+        ])
+        self.battle = make_battles(self.user, 1, status='in_progress')[0]
+        self.battle.participants.add(self.rival)
+        BattleStatistic.objects.create(battle=self.battle, user=self.rival, stat_type='weight',
+                                       starting_value=Decimal('90.00'), current_value=Decimal('85.00'))
+        BattleInvitation.objects.create(battle=make_battles(self.rival, 1)[0], invited_user=self.user, inviting_user=self.rival)
+
+    def async_get(self, url, headers=None, **params):
+        return async_to_sync(AsyncClient().get)(url, params, headers=self.headers if headers is None else headers)
+
+    def assert_same(self, name, async_name, args=(), **params):
+        expected = self.client.get(reverse(name, args=args), params)
+        response = self.async_get(reverse(async_name, args=args), **params)
+        self.assertEqual(response.status_code, expected.status_code)
+        expected, actual = expected.json(), response.json()
+        if isinstance(expected, dict):
+            expected, actual = dict(expected), dict(actual)
+        for link in ('next', 'previous'):
+            # Links only differ by the endpoint path
+            if isinstance(expected, dict) and expected.get(link):
+                self.assertEqual(actual[link].replace('/api/async/', '/api/'), expected[link])
+                expected.pop(link), actual.pop(link)
+        self.assertEqual(actual, expected)
+        return response
+
+    def test_profile(self):
+        self.user.profile.unit_preference = 'imperial'
+        self.user.profile.save()
+        self.assert_same('get_profile', 'async_get_profile')
+        with self.assertNumQueries(1):  # The user and its profile
+            self.async_get(reverse('async_get_profile'))
+
+    def test_weight_history_pages(self):
+        response = self.assert_same('weight_stat_list_create', 'async_weight_stat_list', page_size=2)
+        cursor = response.json()['next'].split('cursor=')[1].split('&')[0]
+        self.assert_same('weight_stat_list_create', 'async_weight_stat_list', page_size=2, cursor=cursor)
+
+    def test_battle_detail_is_cached(self):
+        self.assertEqual(self.assert_same('battle_detail', 'async_battle_detail', args=[self.battle.id])['X-Cache'], 'MISS')
+        self.assertEqual(self.async_get(reverse('async_battle_detail', args=[self.battle.id]))['X-Cache'], 'HIT')
+        self.assert_same('battle_detail', 'async_battle_detail', args=[0])
+
+    def test_leaderboard(self):
+        self.assert_same('battle_leaderboard', 'async_battle_leaderboard', args=[self.battle.id], page_size=1)
+        self.assert_same('battle_leaderboard', 'async_battle_leaderboard', args=[self.battle.id], around_me=1, neighbours=1)
+        self.assert_same('battle_leaderboard', 'async_battle_leaderboard', args=[self.battle.id], page=9)
+        self.assert_same('battle_leaderboard', 'async_battle_leaderboard', args=[0])
+
+    def test_pending_invitations(self):
+        self.assert_same('pending_invitations', 'async_pending_invitations')
+
+    def test_authentication(self):
+        url = reverse('async_get_profile')
+        response = self.async_get(url, headers={})
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response['WWW-Authenticate'], 'Bearer realm="api"')
+        self.assertEqual(self.async_get(url, headers={'Authorization': 'Bearer nonsense'}).status_code, 401)
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.async_get(url).status_code, 401)
+
+
+class LiveLeaderboardTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='live_leader')
+        self.rival = User.objects.create(username='live_rival')
+        self.battle = make_battles(self.user, 1, status='in_progress')[0]
+        self.battle.participants.add(self.rival)
+        BattleStatistic.objects.create(battle=self.battle, user=self.rival, stat_type='weight',
+                                       starting_value=Decimal('90.00'), current_value=Decimal('89.00'))
+        self.headers = {'Authorization': f'Bearer {RefreshToken.for_user(self.user).access_token}'}
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def subscribe(self):
+        subscriber = Subscriber(self.loop)
+        live_hub.subscribe(self.battle.id, subscriber)
+        self.addCleanup(live_hub.unsubscribe, self.battle.id, subscriber)
+        live_hub.snapshot(self.battle.id, as_state(leaderboard_rows(self.battle.id)))
+        return subscriber
+
+    def received(self, subscriber):
+        # Run the callbacks the hub scheduled on the subscriber's loop
+        self.loop.run_until_complete(asyncio.sleep(0))
+        events = []
+        while not subscriber.queue.empty():
+            events.append(subscriber.queue.get_nowait())
+        return events
+
+    def test_weight_reading_pushes_only_changed_rows(self):
+        subscriber = self.subscribe()
+        with self.captureOnCommitCallbacks(execute=True):
+            WeightStat.objects.create(user=self.user, weight=Decimal('80.00'))
+        [event] = self.received(subscriber)
+        self.assertEqual(event.kind, 'delta')
+        # Both rows changed rank, only the leader's values moved
+        self.assertEqual([(row['user'], row['rank']) for row in event.rows], [('live_leader', 1), ('live_rival', 2)])
+        self.assertEqual(event.rows[0]['current_value'], Decimal('80.00'))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            WeightStat.objects.create(user=self.user, weight=Decimal('79.00'))
+        [event] = self.received(subscriber)
+        self.assertEqual([row['user'] for row in event.rows], ['live_leader'])
+
+    def test_unwatched_battles_cost_nothing(self):
+        with mock.patch.object(live_hub, 'publish_changes') as publish_changes:
+            with self.captureOnCommitCallbacks(execute=True):
+                WeightStat.objects.create(user=self.user, weight=Decimal('80.00'))
+        publish_changes.assert_not_called()
+        # Only the shared version moves, for streams in other processes
+        self.assertIsNotNone(async_to_sync(aleaderboard_version)(self.battle.id))
+
+    def test_changes_from_other_processes_are_polled(self):
+        subscriber = self.subscribe()
+        follow = async_to_sync(live_hub.afollow)
+        with self.assertNumQueries(0):
+            follow(self.battle.id)
+        self.assertEqual(self.received(subscriber), [])
+
+        # Another worker commits a reading: it only moves the rows and the shared version
+        with mock.patch.object(live_hub, 'watched', return_value=[]):
+            with self.captureOnCommitCallbacks(execute=True):
+                WeightStat.objects.create(user=self.user, weight=Decimal('80.00'))
+        self.assertEqual(self.received(subscriber), [])
+
+        with mock.patch('defatify.live.LIVE_POLL_SECONDS', 0):
+            with self.assertNumQueries(1):
+                follow(self.battle.id)
+            [event] = self.received(subscriber)
+            self.assertEqual(event.rows[0]['current_value'], Decimal('80.00'))
+            # Caught up: the next checks only read the cache
+            with self.assertNumQueries(0):
+                follow(self.battle.id)
+        self.assertEqual(self.received(subscriber), [])
+
+    def test_slow_subscriber_is_resynced(self):
+        subscriber = self.subscribe()
+        for seq in range(LIVE_QUEUE_SIZE + 1):
+            subscriber.offer(seq)
+        self.assertEqual(self.received(subscriber), [RESYNC])
+
+    def test_replay_since_last_event_id(self):
+        self.subscribe()
+        BattleStatistic.objects.filter(user=self.rival).update(current_value=Decimal('70.00'))
+        first = live_hub.publish(self.battle.id, as_state(leaderboard_rows(self.battle.id)))
+        BattleStatistic.objects.filter(user=self.rival).update(current_value=Decimal('60.00'))
+        second = live_hub.publish(self.battle.id, as_state(leaderboard_rows(self.battle.id)))
+
+        self.assertEqual(live_hub.replay_since(self.battle.id, live_hub.event_id(first.seq)), [second])
+        self.assertEqual(live_hub.replay_since(self.battle.id, live_hub.event_id(second.seq)), [])
+        self.assertIsNone(live_hub.replay_since(self.battle.id, f'otherepoch-{first.seq}'))
+        self.assertIsNone(live_hub.replay_since(self.battle.id, live_hub.event_id(second.seq + 5)))
+
+    def test_stream(self):
+        async def scenario():
+            response = await AsyncClient().get(reverse('leaderboard_stream', args=[self.battle.id]), headers=self.headers)
+            self.assertEqual(response['Content-Type'], 'text/event-stream')
+            chunks = aiter(response.streaming_content)
+            opening = (await anext(chunks)).decode()
+            self.assertIn('event: snapshot', opening)
+            self.assertIn('"user":"live_rival"', opening)
+
+            await sync_to_async(BattleStatistic.objects.filter(user=self.rival).update)(current_value=Decimal('70.00'))
+            await sync_to_async(live_hub.publish_changes)([self.battle.id])
+            delta = (await anext(chunks)).decode()
+            self.assertIn('event: delta', delta)
+            self.assertIn('"current_value":70.0', delta)
+            self.assertEqual(await anext(chunks), b': heartbeat\n\n')
+            # A dropped connection releases its subscription once the server closes the response
+            await chunks.aclose()
+            response.close()
+            self.assertEqual(live_hub.watched([self.battle.id]), [])
+
+        with mock.patch('defatify.async_views.HEARTBEAT_SECONDS', 0.05):
+            async_to_sync(scenario)()
+
+    def test_stream_rejects_missing_battles(self):
+        response = async_to_sync(AsyncClient().get)(reverse('leaderboard_stream', args=[0]), headers=self.headers)
+        self.assertEqual(response.status_code, 404)
+        response = async_to_sync(AsyncClient().get)(reverse('leaderboard_stream', args=[self.battle.id]))
+        self.assertEqual(response.status_code, 401)
+
+    def test_browsers_use_a_single_use_ticket_not_the_token(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        self.assertEqual(client.post(reverse('leaderboard_stream_ticket', args=[0])).status_code, 404)
+        ticket = client.post(reverse('leaderboard_stream_ticket', args=[self.battle.id])).data['ticket']
+        other = make_battles(self.user, 1)[0]
+
+        def stream(battle_id, params):
+            response = async_to_sync(AsyncClient().get)(reverse('leaderboard_stream', args=[battle_id]), params)
+            if response.streaming:
+                response.close()
+            return response.status_code
+
+        self.assertEqual(stream(self.battle.id, {'token': self.headers['Authorization'].split()[1]}), 401)
+        self.assertEqual(stream(other.id, {'ticket': ticket}), 401)
+        ticket = client.post(reverse('leaderboard_stream_ticket', args=[self.battle.id])).data['ticket']
+        self.assertEqual(stream(self.battle.id, {'ticket': ticket}), 200)
+        self.assertEqual(stream(self.battle.id, {'ticket': ticket}), 401)
@@ -4,6 +4,10 @@ from .views import (RegisterView,
                     GetProfileView,
                     UpdateProfileView,
                     WeightStatListCreateView,
+                    WeightStatBulkCreateView,
+                    WeightStatExportView,
+                    WeightStatImportView,
+                    WeightStatRollupView,
                     FriendsListView,
                     FriendRequestCreateView,
                     FriendRequestListView,
@@ -15,6 +19,7 @@ from .views import (RegisterView,
                     BattleJoinView,
                     BattleLeaveView,
                     BattleLeaderboardView,
+                    LeaderboardStreamTicketView,
                     BattleInviteView,
                     PendingBattleInvitationsView,
                     AcceptBattleInvitationView,
@@ -25,6 +30,14 @@ from .views import (RegisterView,
                     TopPopularBattlesView,
                     BattleSearchView
                 )
+from .async_views import (AsyncProfileView,
+                          AsyncWeightStatListView,
+                          AsyncBattleDetailView,
+                          AsyncBattleLeaderboardView,
+                          AsyncLeaderboardStreamView,
+                          AsyncPendingBattleInvitationsView
+                )
+from .metrics import metrics_view
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 
 urlpatterns = [
@@ -35,6 +48,10 @@ urlpatterns = [
     path('api/profile/', GetProfileView.as_view(), name='get_profile'),
     path('api/profile/update/', UpdateProfileView.as_view(), name='update_profile'),
     path('api/weight-stats/', WeightStatListCreateView.as_view(), name='weight_stat_list_create'),
+    path('api/weight-stats/bulk/', WeightStatBulkCreateView.as_view(), name='weight_stat_bulk_create'),
+    path('api/weight-stats/export/', WeightStatExportView.as_view(), name='weight_stat_export'),
+    path('api/weight-stats/import/', WeightStatImportView.as_view(), name='weight_stat_import'),
+    path('api/weight-stats/rollups/', WeightStatRollupView.as_view(), name='weight_stat_rollups'),
     path('api/friends/', FriendsListView.as_view(), name='friends_list'),
     path('api/friends/request/send/', FriendRequestCreateView.as_view(), name='friend_request_send'),
     path('api/friends/requests/', FriendRequestListView.as_view(), name='friend_requests_list'),
@@ -46,6 +63,7 @@ urlpatterns = [
     path('api/battles/<int:pk>/join/', BattleJoinView.as_view(), name='battle_join'),
     path('api/battles/<int:pk>/leave/', BattleLeaveView.as_view(), name='battle_leave'),
     path('api/battles/<int:pk>/leaderboard/', BattleLeaderboardView.as_view(), name='battle_leaderboard'),
+    path('api/battles/<int:pk>/leaderboard/stream-ticket/', LeaderboardStreamTicketView.as_view(), name='leaderboard_stream_ticket'),
     path('api/battles/<int:pk>/invite/', BattleInviteView.as_view(), name='battle_invite'),
     path('api/battles/invitations/pending/', PendingBattleInvitationsView.as_view(), name='pending_invitations'),
     path('api/battles/invitations/<int:invitation_id>/accept/', AcceptBattleInvitationView.as_view(), name='accept_invitation'),
@@ -55,4 +73,12 @@ urlpatterns = [
     path('api/battles/<int:pk>/update/', BattleUpdateView.as_view(), name='battle_update'),
     path('api/battles/popular/', TopPopularBattlesView.as_view(), name='top_popular_battles'),
     path('api/battles/search/', BattleSearchView.as_view(), name='battle_search'),
+    path('api/metrics/', metrics_view, name='metrics'),  # Prometheus scrapes
+    # Async read endpoints (same responses as above), for ASGI deployments
+    path('api/async/profile/', AsyncProfileView.as_view(), name='async_get_profile'),
+    path('api/async/weight-stats/', AsyncWeightStatListView.as_view(), name='async_weight_stat_list'),
+    path('api/async/battles/<int:pk>/', AsyncBattleDetailView.as_view(), name='async_battle_detail'),
+    path('api/async/battles/<int:pk>/leaderboard/', AsyncBattleLeaderboardView.as_view(), name='async_battle_leaderboard'),
+    path('api/async/battles/<int:pk>/leaderboard/stream/', AsyncLeaderboardStreamView.as_view(), name='leaderboard_stream'),
+    path('api/async/battles/invitations/pending/', AsyncPendingBattleInvitationsView.as_view(), name='async_pending_invitations'),
 ]
\ No newline at end of file
@@ -1,5 +1,89 @@
+import threading
+import time
+from collections import OrderedDict
 from decimal import Decimal, ROUND_HALF_UP
 
+KG_TO_LB = Decimal('2.20462')
+LB_QUANTUM = Decimal('0.0')
+
 def convert_kg_to_lb(value_in_kg):
-    pounds = value_in_kg * Decimal(2.20462)
-    return pounds.quantize(Decimal('0.0'), rounding=ROUND_HALF_UP)
\ No newline at end of file
+    pounds = value_in_kg * KG_TO_LB
+    return pounds.quantize(LB_QUANTUM, rounding=ROUND_HALF_UP)
+
+
+class UnitConverter:
+    """
+    Converts serialized kilogram values to a user's preferred units.
+
+    Resolve it once per request with `for_request()`; every serializer of that
+    request then shares the same instance instead of walking
+    request.user.profile for each field of each row.
+    """
+
+    def __init__(self, unit_preference):
+        self.unit_preference = unit_preference
+        self.imperial = unit_preference == 'imperial'
+
+    @classmethod
+    def for_request(cls, request):
+        converter = getattr(request, '_unit_converter', None)
+        if converter is None:
+            converter = cls(request.user.profile.unit_preference)
+            request._unit_converter = converter
+        return converter
+
+    def weight(self, value):
+        if not self.imperial or value is None:
+            return value
+        return convert_kg_to_lb(Decimal(value) if isinstance(value, str) else value)
+
+    def convert_rows(self, rows, fields, stat_field=None):
+        """
+        Convert `fields` of serialized rows in place, in one pass over the list.
+
+        With `stat_field` set, only rows whose stat is 'weight' are converted
+        (body fat etc. are percentages). Metric users cost nothing.
+        """
+        if not self.imperial:
+            return rows
+        for row in rows:
+            if stat_field is not None and row.get(stat_field) != 'weight':
+                continue
+            for field in fields:
+                value = row.get(field)
+                if value is not None:
+                    row[field] = convert_kg_to_lb(Decimal(value) if isinstance(value, str) else value)
+        return rows
+
+
+class TTLCache:
+    """A small thread-safe LRU cache whose entries also expire after `ttl` seconds."""
+
+    def __init__(self, maxsize=1024, ttl=30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
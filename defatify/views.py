@@ -1,21 +1,72 @@
+import csv
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.generics import ListAPIView
-from django.db.models import Count, Q
+from rest_framework.parsers import MultiPartParser
+from rest_framework.settings import api_settings
+from django.db.models import Q
 from rest_framework import status, generics
 from django.contrib.auth.models import User
 from django.contrib.auth import authenticate
 from rest_framework.permissions import AllowAny
 from django.contrib.auth.hashers import make_password
 from rest_framework.permissions import IsAuthenticated
-from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework.generics import RetrieveAPIView, UpdateAPIView, GenericAPIView
 from .models import Profile, WeightStat, FriendRequest, Friendship, Battle, BattleStatistic, BattleInvitation
-from .serializers import ProfileSerializer, WeightStatSerializer, FriendRequestSerializer, FriendshipSerializer, UserSearchSerializer, BattleSerializer, LeaderboardSerializer, BattleInvitationSerializer
+from .serializers import sparse_fields, RowSerializer, ProfileSerializer, WeightStatSerializer, WeightStatBulkItemSerializer, FriendRequestSerializer, FriendshipSerializer, UserSearchSerializer, BattleSerializer, BattleListSerializer, LeaderboardSerializer, BattleInvitationSerializer
 from django.utils.dateparse import parse_date
 from django.contrib.auth.models import User
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
+from django.utils.functional import cached_property
+from django.http import StreamingHttpResponse
+from django.core.handlers.asgi import ASGIRequest
+from .ingest import CSVImportError, CSVImportUploadHandler, csv_lines, import_readings, ingest_readings
+from .columnar import COLUMNAR_FORMAT, COLUMNAR_MAX_PAGE_SIZE, ColumnarJSONRenderer, weight_columns
+from .exports import CSVRenderer, NDJSONRenderer, aexport_chunks, aexport_stream, export_chunks, export_stream
+from .pagination import LeaderboardPagination, KeysetPagination, WeightStatPagination, FriendRequestPagination
+from .cache import BattleCacheMixin
+from .rollups import PERIODS, weight_rollups
+from .utils import UnitConverter
+from .search import search_battles, search_users
+from .popular import popular_battles
+from .authentication import STREAM_TICKET_LIFETIME, ClaimsRefreshToken, access_token_for, issue_stream_ticket
+
+class SparseFieldsetMixin:
+    """
+    `?fields=` / `?exclude=` on GET: serializers get the kept field names
+    (`sparse_fields`), which get_queryset() passes on so that the columns and
+    relations of dropped fields are never fetched. Writes answer in full.
+    """
+
+    @cached_property
+    def sparse_fields(self):
+        if self.request.method != 'GET':
+            return None
+        return sparse_fields(self.request, self.get_serializer_class())
+
+    def get_serializer(self, *args, **kwargs):
+        kwargs.setdefault('fields', self.sparse_fields)
+        return super().get_serializer(*args, **kwargs)
+
+class RowListMixin(SparseFieldsetMixin):
+    """
+    Serve list() through RowSerializer(serializer_class): the same JSON,
+    built from values_list() tuples of only the kept fields' columns instead
+    of model instances.
+    """
+
+    def list(self, request, *args, **kwargs):
+        serializer = RowSerializer.for_class(self.get_serializer_class())
+        fields = self.sparse_fields
+        queryset = serializer.rows(self.filter_queryset(self.get_queryset()), fields,
+                                   getattr(self.paginator, 'ordering_columns', ()))
+        kept = serializer.plan_for(fields)[0]
+        units = UnitConverter.for_request(request) if any(name in kept for name in serializer.unit_fields) else None
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(serializer.serialize(page, units, fields))
+        return Response(serializer.serialize(queryset, units, fields))
 
 # REGISTER
 class RegisterView(APIView):
@@ -53,7 +104,7 @@ class LogoutView(APIView):
     def post(self, request):
         try:
             refresh_token = request.data["refresh"]
-            token = RefreshToken(refresh_token)
+            token = ClaimsRefreshToken(refresh_token)
             token.blacklist()
             return Response(status=status.HTTP_205_RESET_CONTENT)
         except Exception as e:
@@ -75,22 +126,45 @@ class UpdateProfileView(UpdateAPIView):
 
     def get_object(self):
         return Profile.objects.get(user=self.request.user)
+
+    def perform_update(self, serializer):
+        self.request.user.profile = serializer.save()
+
+    def update(self, request, *args, **kwargs):
+        response = super().update(request, *args, **kwargs)
+        # The save made the caller's token stale (signals.py), so hand over a fresh one
+        response['X-Access-Token'] = str(access_token_for(request.user))
+        return response
     
+def weight_history(user, params):
+    """The user's readings, optionally limited by the `start_date`/`end_date` query parameters."""
+    queryset = WeightStat.objects.filter(user=user)
+    start_date = params.get('start_date')
+    end_date = params.get('end_date')
+    if start_date:
+        queryset = queryset.filter(date__gte=parse_date(start_date))
+    if end_date:
+        queryset = queryset.filter(date__lte=parse_date(end_date))
+    return queryset
+
 # POST WEIGHTS
-class WeightStatListCreateView(generics.ListCreateAPIView):
+class WeightStatListCreateView(RowListMixin, generics.ListCreateAPIView):
     permission_classes = [IsAuthenticated]
     serializer_class = WeightStatSerializer
+    pagination_class = WeightStatPagination
+    renderer_classes = [*api_settings.DEFAULT_RENDERER_CLASSES, ColumnarJSONRenderer]
 
     def get_queryset(self):
-        user = self.request.user
-        queryset = WeightStat.objects.filter(user=user)
-        start_date = self.request.query_params.get('start_date')
-        end_date = self.request.query_params.get('end_date')
-        if start_date:
-            queryset = queryset.filter(date__gte=parse_date(start_date))
-        if end_date:
-            queryset = queryset.filter(date__lte=parse_date(end_date))
-        return queryset
+        return weight_history(self.request.user, self.request.query_params)
+
+    def list(self, request, *args, **kwargs):
+        if request.accepted_renderer.format != COLUMNAR_FORMAT:
+            return super().list(request, *args, **kwargs)
+        self.paginator.max_page_size = COLUMNAR_MAX_PAGE_SIZE
+        fields = self.sparse_fields
+        rows = RowSerializer.for_class(WeightStatSerializer).rows(self.get_queryset(), fields, self.paginator.ordering_columns)
+        page = self.paginate_queryset(rows)
+        return self.get_paginated_response(weight_columns(page, UnitConverter.for_request(request), fields))
 
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
@@ -100,8 +174,132 @@ class WeightStatListCreateView(generics.ListCreateAPIView):
         context['request'] = self.request
         return context
 
+# POST WEIGHTS IN BULK (smart-scale syncs)
+class WeightStatBulkCreateView(APIView):
+    permission_classes = [IsAuthenticated]
+    max_items = 1000
+
+    def post(self, request):
+        items = request.data
+        if not isinstance(items, list) or not items:
+            return Response({"detail": "Expected a non-empty list of readings."}, status=status.HTTP_400_BAD_REQUEST)
+        if len(items) > self.max_items:
+            return Response({"detail": f"At most {self.max_items} readings can be uploaded at once."},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        results = [None] * len(items)
+        valid = []
+        for index, item in enumerate(items):
+            serializer = WeightStatBulkItemSerializer(data=item)
+            if serializer.is_valid():
+                valid.append((index, serializer.validated_data))
+            else:
+                results[index] = {'index': index, 'errors': serializer.errors}
+
+        # Timestamps must be unique within the batch and against the stored history
+        existing = set(WeightStat.objects.filter(
+            user=request.user, date__in=[data['date'] for _, data in valid]
+        ).values_list('date', flat=True))
+        readings, indexes = [], []
+        for index, data in valid:
+            if data['date'] in existing:
+                results[index] = {'index': index, 'errors': {'date': ['A reading with this timestamp already exists.']}}
+                continue
+            existing.add(data['date'])
+            readings.append(WeightStat(user=request.user, **data))
+            indexes.append(index)
+
+        created = ingest_readings(request.user, readings)
+        for index, reading in zip(indexes, created):
+            results[index] = {'index': index, 'id': reading.id}
+
+        failed = len(items) - len(created)
+        if not created:
+            response_status = status.HTTP_400_BAD_REQUEST
+        elif failed:
+            response_status = status.HTTP_207_MULTI_STATUS
+        else:
+            response_status = status.HTTP_201_CREATED
+        return Response({'created': len(created), 'failed': failed, 'results': results}, status=response_status)
+
+# IMPORT WEIGHT HISTORY (CSV from other apps)
+class WeightStatImportView(APIView):
+    permission_classes = [IsAuthenticated]
+    parser_classes = [MultiPartParser]
+
+    def post(self, request):
+        # Both kinds of body are imported as they are read off the socket, a batch at a time
+        if request.content_type.startswith('text/csv'):
+            if not request.META.get('CONTENT_LENGTH'):
+                return Response({"detail": "A text/csv body needs a Content-Length header."},
+                                status=status.HTTP_411_LENGTH_REQUIRED)
+            try:
+                report = import_readings(request.user, csv_lines(request.stream or ()))
+            except (CSVImportError, csv.Error, UnicodeDecodeError) as exc:
+                return Response({"detail": str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+        else:
+            handler = CSVImportUploadHandler(request.user)
+            request.upload_handlers = [handler]
+            request.FILES  # noqa: B018 -- parsing the upload runs the import
+            if handler.error is not None:
+                return Response({"detail": str(handler.error)}, status=status.HTTP_400_BAD_REQUEST)
+            if handler.report is None:
+                return Response({"detail": "Upload a CSV file as `file` or send it as a text/csv body."},
+                                status=status.HTTP_400_BAD_REQUEST)
+            report = handler.report
+
+        if report['created']:
+            response_status = status.HTTP_207_MULTI_STATUS if report['invalid'] else status.HTTP_201_CREATED
+        else:
+            response_status = status.HTTP_400_BAD_REQUEST if report['invalid'] else status.HTTP_200_OK
+        return Response(report, status=response_status)
+
+# EXPORT WEIGHT HISTORY (CSV or NDJSON, streamed)
+class WeightStatExportView(APIView):
+    permission_classes = [IsAuthenticated]
+    renderer_classes = [CSVRenderer, NDJSONRenderer]
+
+    def get(self, request):
+        for param in ('start_date', 'end_date'):
+            value = request.query_params.get(param)
+            if value and parse_date(value) is None:
+                return Response({"detail": f"{param} must be a date (YYYY-MM-DD)."}, status=status.HTTP_400_BAD_REQUEST)
+
+        renderer = request.accepted_renderer
+        history, units = weight_history(request.user, request.query_params), UnitConverter.for_request(request)
+        if isinstance(request._request, ASGIRequest):
+            body = aexport_stream(renderer.format, aexport_chunks(history, units))
+        else:
+            body = export_stream(renderer.format, export_chunks(history, units))
+        response = StreamingHttpResponse(body, content_type=f'{renderer.media_type}; charset={renderer.charset}')
+        response['Content-Disposition'] = f'attachment; filename="weight-history.{renderer.format}"'
+        return response
+
+# WEIGHT HISTORY ROLLUPS (charts)
+class WeightStatRollupView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        period = request.query_params.get('period', 'day')
+        if period not in PERIODS:
+            return Response({"detail": f"period must be one of: {', '.join(PERIODS)}."}, status=status.HTTP_400_BAD_REQUEST)
+
+        dates = {}
+        for param in ('start_date', 'end_date'):
+            value = request.query_params.get(param)
+            dates[param] = parse_date(value) if value else None
+            if value and dates[param] is None:
+                return Response({"detail": f"{param} must be a date (YYYY-MM-DD)."}, status=status.HTTP_400_BAD_REQUEST)
+
+        units = UnitConverter.for_request(request)
+        buckets = []
+        for bucket in weight_rollups(request.user, period, **dates):
+            weight = bucket['weight']
+            buckets.append({**bucket, 'weight': {key: units.weight(value) for key, value in weight.items()}})
+        return Response({'period': period, 'unit_preference': units.unit_preference, 'buckets': buckets})
+
 # Get friends list
-class FriendsListView(generics.ListAPIView):
+class FriendsListView(RowListMixin, generics.ListAPIView):
     permission_classes = [IsAuthenticated]
     serializer_class = FriendshipSerializer
 
@@ -121,9 +319,10 @@ class FriendRequestCreateView(generics.CreateAPIView):
         return Response(FriendRequestSerializer(friend_request).data, status=status.HTTP_201_CREATED)
 
 # Get received and sent friend requests
-class FriendRequestListView(generics.ListAPIView):
+class FriendRequestListView(RowListMixin, generics.ListAPIView):
     permission_classes = [IsAuthenticated]
     serializer_class = FriendRequestSerializer
+    pagination_class = FriendRequestPagination
 
     def get_queryset(self):
         user = self.request.user
@@ -142,8 +341,9 @@ class FriendRequestUpdateView(generics.UpdateAPIView):
         
         if action == 'accept':
             friend_request.status = 'accepted'
-            Friendship.objects.create(user=request.user, friend=friend_request.from_user)
-            Friendship.objects.create(user=friend_request.from_user, friend=request.user)
+            # Requests may have crossed, so either side of the pair can exist already
+            Friendship.objects.get_or_create(user=request.user, friend=friend_request.from_user)
+            Friendship.objects.get_or_create(user=friend_request.from_user, friend=request.user)
         elif action == 'reject':
             friend_request.status = 'rejected'
         
@@ -170,18 +370,24 @@ class UserSearchView(generics.ListAPIView):
 
     def get_queryset(self):
         query = self.request.query_params.get('query', '')
-        return User.objects.filter(username__icontains=query).exclude(id=self.request.user.id)
+        return search_users(self.request.user, query)
     
 # Battles
     
 # List and create battles
-class BattleListView(generics.ListCreateAPIView):
+class BattleListView(SparseFieldsetMixin, generics.ListCreateAPIView):
     permission_classes = [IsAuthenticated]
     serializer_class = BattleSerializer
+    pagination_class = KeysetPagination
 
     def get_queryset(self):
         user = self.request.user
-        return Battle.objects.filter(participants=user).distinct() | Battle.objects.filter(creator=user).distinct()
+        # One semi-join on the participation table instead of two DISTINCT joins
+        joined = Battle.participants.through.objects.filter(user=user).values('battle_id')
+        return Battle.objects.filter(Q(id__in=joined) | Q(creator=user)).for_list(self.sparse_fields)
+
+    def get_serializer_class(self):
+        return BattleListSerializer if self.request.method == 'GET' else BattleSerializer
 
     def perform_create(self, serializer):
         # Create the battle and set the creator
@@ -236,10 +442,13 @@ class StartBattleView(APIView):
                         status=status.HTTP_200_OK)
 
 # Get details of a specific battle
-class BattleDetailView(generics.RetrieveAPIView):
+class BattleDetailView(BattleCacheMixin, SparseFieldsetMixin, generics.RetrieveAPIView):
     permission_classes = [IsAuthenticated]
     serializer_class = BattleSerializer
-    queryset = Battle.objects.all()
+    cache_scope = 'detail'
+
+    def get_queryset(self):
+        return Battle.objects.for_detail(self.sparse_fields)
 
     def get_serializer_context(self):
         context = super().get_serializer_context()
@@ -247,28 +456,23 @@ class BattleDetailView(generics.RetrieveAPIView):
         return context
     
 # Get top 10 public battles
-class TopPopularBattlesView(ListAPIView):
+class TopPopularBattlesView(SparseFieldsetMixin, ListAPIView):
     permission_classes = [IsAuthenticated]
-    serializer_class = BattleSerializer
+    serializer_class = BattleListSerializer
 
     def get_queryset(self):
-        # Fetch the top 10 public battles sorted by the number of participants in descending order
-        return Battle.objects.filter(is_private=False).exclude(status__in=['deleted', 'finished']).annotate(
-            participant_count=Count('participants')
-        ).order_by('-participant_count')[:10]
+        # The top 10 open public battles by participant count, precomputed in popular.py
+        return popular_battles().for_list(self.sparse_fields)
     
-# Search battle by name
-class BattleSearchView(generics.ListAPIView):
+# Search battle by name and description, best matches first
+class BattleSearchView(SparseFieldsetMixin, generics.ListAPIView):
     permission_classes = [IsAuthenticated]
-    serializer_class = BattleSerializer
+    serializer_class = BattleListSerializer
     queryset = Battle.objects.filter(is_private=False).exclude(status__in=['deleted', 'finished'])
 
     def get_queryset(self):
         query = self.request.query_params.get('query', '')
-        return Battle.objects.filter(
-            Q(name__icontains=query) | Q(description__icontains=query),
-            is_private=False
-        ).exclude(status__in=['deleted', 'finished']).distinct()
+        return search_battles(super().get_queryset(), query).for_list(self.sparse_fields)
 
 #Join a battle
 class BattleJoinView(generics.GenericAPIView):
@@ -289,6 +493,10 @@ class BattleJoinView(generics.GenericAPIView):
         if battle.is_private:
             return Response({"detail": "You cannot join a private battle directly. Accept the invitation to join."}, status=status.HTTP_403_FORBIDDEN)
 
+        # Check if the user is already in the battle
+        if battle.participants.filter(id=request.user.id).exists():
+            return Response({"detail": "You are already a participant in this battle."}, status=status.HTTP_400_BAD_REQUEST)
+
         # Fetch the user's latest weight or relevant stat as the starting value
         user_stat = WeightStat.objects.filter(user=request.user).order_by('-date').first()
         
@@ -372,19 +580,60 @@ class BattleUpdateView(generics.UpdateAPIView):
         return self.update(request, *args, **kwargs, partial=True)
 
 # Leaderboard for a specific battle
-class BattleLeaderboardView(generics.ListAPIView):
+class BattleLeaderboardView(BattleCacheMixin, SparseFieldsetMixin, generics.ListAPIView):
     permission_classes = [IsAuthenticated]
     serializer_class = LeaderboardSerializer
+    pagination_class = LeaderboardPagination
+    cache_scope = 'leaderboard'
+    max_neighbours = 50
+
+    def cache_per_user(self, request):
+        return bool(request.query_params.get('around_me'))
 
     def get_queryset(self):
-        battle = get_object_or_404(Battle, id=self.kwargs['pk'])
-        return BattleStatistic.objects.filter(battle=battle)
+        # Ranking, progress and the total count all come back with the page in one query
+        return BattleStatistic.objects.filter(battle_id=self.kwargs['pk']).for_leaderboard(self.sparse_fields).ranked()
+
+    def list(self, request, *args, **kwargs):
+        if request.query_params.get('around_me'):
+            return self.around_me(request)
+
+        response = super().list(request, *args, **kwargs)
+        if not response.data['count']:
+            get_object_or_404(Battle, id=self.kwargs['pk'])
+        return response
+
+    def around_me(self, request):
+        """The requesting user's row plus `neighbours` rows on either side of it."""
+        try:
+            neighbours = min(int(request.query_params.get('neighbours', 5)), self.max_neighbours)
+        except ValueError:
+            return Response({"detail": "neighbours must be an integer."}, status=status.HTTP_400_BAD_REQUEST)
+        neighbours = max(neighbours, 0)
+
+        mine = BattleStatistic.objects.filter(battle_id=self.kwargs['pk']).position_of(request.user.id).first()
+        if mine is None:
+            return Response({"detail": "You are not on this leaderboard."}, status=status.HTTP_404_NOT_FOUND)
+
+        position = mine['position']
+        rows = list(self.get_queryset().around(position, neighbours))
+        serializer = self.get_serializer(rows, many=True)
+        return Response({'count': rows[0].total_count if rows else 0, 'position': position, 'results': serializer.data})
 
     def get_serializer_context(self):
         context = super().get_serializer_context()
         context['request'] = self.request
         return context
     
+# Ticket for the live leaderboard stream, whose EventSource cannot send the access token
+class LeaderboardStreamTicketView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, pk):
+        get_object_or_404(Battle, id=pk)
+        return Response({'ticket': issue_stream_ticket(request.user.id, pk), 'expires_in': STREAM_TICKET_LIFETIME},
+                        status=status.HTTP_201_CREATED)
+
 # Send an invitation to join a battle
 class BattleInviteView(generics.CreateAPIView):
     permission_classes = [IsAuthenticated]
@@ -440,12 +689,15 @@ class AcceptBattleInvitationView(GenericAPIView):
         # Initialize BattleStatistic for the user with their latest stats
         latest_weight_stat = WeightStat.objects.filter(user=request.user).order_by('-date').first()
         if latest_weight_stat:
-            BattleStatistic.objects.create(
+            # The user may have joined a public battle before accepting
+            BattleStatistic.objects.get_or_create(
                 battle=battle,
                 user=request.user,
-                stat_type=battle.weight_param,
-                starting_value=getattr(latest_weight_stat, battle.weight_param, None),
-                current_value=getattr(latest_weight_stat, battle.weight_param, None)
+                defaults={
+                    'stat_type': battle.weight_param,
+                    'starting_value': getattr(latest_weight_stat, battle.weight_param, None),
+                    'current_value': getattr(latest_weight_stat, battle.weight_param, None),
+                }
             )
 
         return Response({"detail": "Invitation accepted and joined the battle."}, status=status.HTTP_200_OK)
@@ -461,9 +713,11 @@ class RejectBattleInvitationView(generics.GenericAPIView):
         return Response({"detail": "Invitation rejected."}, status=status.HTTP_200_OK)
 
 # List pending invitations for the authenticated user
-class PendingBattleInvitationsView(generics.ListAPIView):
+class PendingBattleInvitationsView(RowListMixin, generics.ListAPIView):
     permission_classes = [IsAuthenticated]
     serializer_class = BattleInvitationSerializer
+    pagination_class = KeysetPagination
 
     def get_queryset(self):
+        # RowListMixin reads values_list() rows, whose related columns are joined by their lookups
         return BattleInvitation.objects.filter(invited_user=self.request.user, status='pending')
\ No newline at end of file
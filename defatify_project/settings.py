@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -32,12 +33,18 @@ ALLOWED_HOSTS = []
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'defatify.authentication.ClaimsJWTAuthentication',
     ),
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 10
 }
 
+# Access tokens carry the user's username and unit preference (defatify/authentication.py)
+SIMPLE_JWT = {
+    'TOKEN_OBTAIN_SERIALIZER': 'defatify.authentication.ClaimsTokenObtainPairSerializer',
+    'TOKEN_REFRESH_SERIALIZER': 'defatify.authentication.ClaimsTokenRefreshSerializer',
+}
+
 INSTALLED_APPS = [
     'django.contrib.admin',
     'django.contrib.auth',
@@ -51,6 +58,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'defatify.metrics.MetricsMiddleware',  # First, so it times the whole stack
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -96,6 +104,55 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/5.1/topics/cache/
+# Battle response versions, rollup versions, token claim freshness marks and
+# live leaderboard versions are invalidated through the cache, so every
+# worker process must share it: with a per-process cache (LocMemCache) the
+# workers that did not handle a write keep serving stale entries, and their
+# leaderboard streams miss the change. Deployments set REDIS_URL, e.g.
+# redis://localhost:6379/1 (the `redis` package is in requirements.txt).
+# Without it, local runs fall back to LocMemCache, which
+# `manage.py check --deploy` refuses. The test suite always runs with
+# LocMemCache (defatify_project/test_settings.py).
+
+REDIS_URL = os.environ.get('REDIS_URL')
+
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'defatify',
+        }
+    }
+
+# Lifetime of cached battle detail/leaderboard responses, in seconds
+BATTLE_CACHE_TIMEOUT = 300
+
+
+# Battle updates after new readings (defatify/jobs.py)
+# Worker threads applying queued updates, and seconds a job waits for more readings of the same user
+BATTLE_UPDATE_WORKERS = 4
+BATTLE_UPDATE_DELAY = 0.5
+# Run the updates inline, as soon as they are queued; on in test_settings.py
+BATTLE_UPDATES_EAGER = False
+
+
+# Metrics
+# Prometheus scrapes /api/metrics/ with `Authorization: Token <METRICS_TOKEN>`;
+# unset, the endpoint only answers with DEBUG on
+METRICS_TOKEN = None
+# Requests slower than this (ms) are logged with their SQL to `defatify.slow_requests`
+SLOW_REQUEST_MS = 500
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 
@@ -0,0 +1,18 @@
+"""
+Settings for the test suite:
+
+    python manage.py test --settings=defatify_project.test_settings
+"""
+
+from .settings import *  # noqa: F401,F403
+
+# Everything under test runs in one process, so a per-process cache is shared by all of it
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'defatify',
+    }
+}
+
+# Battle updates run inline, as soon as they are queued, instead of on worker threads
+BATTLE_UPDATES_EAGER = True